@@ -27,9 +27,9 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-from alpha_vantage.timeseries import TimeSeries
 import argparse
-import pandas as pd
+
+import alpha_vantage_update
 
 
 #def parse_args():
@@ -53,12 +53,6 @@ import pandas as pd
 
 #print(args)
 
-# Submit our API and create a session
-alpha_ts = TimeSeries(key='X2YNJWH7QSF0OY2C', output_format='pandas')
-
-# Get the data
-#data, meta_data = alpha_ts.get_daily(symbol=args.symbol, outputsize='compact')
-data, meta_data = alpha_ts.get_daily(symbol="PETR4.SA", outputsize='compact')
-
-# Save the data
-data.to_csv("test_alpha")
\ No newline at end of file
+# Get the data and save it (only the missing bars are downloaded)
+#alpha_vantage_update.update(args.outfile, symbol=args.symbol)
+alpha_vantage_update.update("test_alpha", symbol="PETR4.SA")
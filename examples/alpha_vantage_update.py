@@ -0,0 +1,202 @@
+'''
+Incremental Alpha Vantage daily downloader
+
+Instead of downloading the whole history (``outputsize='full'``) on every
+run, the last date stored in the CSV file is read and only the ``compact``
+window (the latest 100 bars) is requested. Bars newer than the stored ones
+are appended; the last stored bar is refreshed with the downloaded values,
+because it may have been saved while the session was still open. A ``full``
+download is only done when the file does not exist yet or when the stored
+history is older than the compact window.
+
+The file keeps the layout written by ``pandas.DataFrame.to_csv`` in the
+original scripts (ascending dates, ``date,5. volume,4. close,2. high,1.
+open,3. low``), so the ``GenericCSVData`` column indices used in
+bollinger_bands_with_alphavantage.py remain valid. Updates are written to a
+temporary file which then replaces the original one.
+
+The HTTP access goes through a ``transport`` callable (``transport(url,
+params) -> bytes``), so tests can point ``url`` to a local stub server or
+pass a function serving canned responses.
+
+Usage::
+
+    python alpha_vantage_update.py --symbol VALE3.SA --outfile test_alpha.csv
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+
+URL = 'https://www.alphavantage.co/query'
+APIKEY = 'X2YNJWH7QSF0OY2C'
+
+HEADER = ['date', '5. volume', '4. close', '2. high', '1. open', '3. low']
+SERIES = 'Time Series (Daily)'
+
+
+def urllib_transport(url, params, timeout=30):
+    '''Default transport: HTTP GET of ``url`` with ``params``'''
+    f = urlopen(url + '?' + urlencode(params), timeout=timeout)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def fetch(symbol, outputsize='compact', apikey=APIKEY, url=URL,
+          transport=urllib_transport):
+    '''
+    Requests TIME_SERIES_DAILY for ``symbol`` and returns a dict
+    ``date -> {field: value}`` (fields named as in the API, i.e. ``1.
+    open``)
+    '''
+    params = dict(function='TIME_SERIES_DAILY', symbol=symbol,
+                  outputsize=outputsize, apikey=apikey, datatype='json')
+
+    body = transport(url, params)
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    reply = json.loads(body)
+
+    if SERIES not in reply:
+        # Errors and the free-tier limit come back as a single message
+        msg = (reply.get('Error Message') or reply.get('Note') or
+               reply.get('Information') or body[:200])
+        raise RuntimeError('Alpha Vantage: %s' % msg)
+
+    return reply[SERIES]
+
+
+def lastline(path):
+    '''
+    Returns ``(header, lastline, offset)`` for the CSV file in ``path``, where
+    ``offset`` is the byte position at which the last line starts. Only the
+    head and the tail of the file are read
+    '''
+    with open(path, 'rb') as f:
+        header = f.readline().decode('utf-8').strip()
+        hdrsize = f.tell()
+
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        block = 4096
+        while True:
+            start = max(hdrsize, end - block)
+            f.seek(start)
+            tail = f.read(end - start)
+            stripped = tail.rstrip(b'\r\n')
+            pos = stripped.rfind(b'\n')
+            if pos >= 0 or start == hdrsize:
+                break
+            block *= 2
+
+        line = stripped[pos + 1:].decode('utf-8')
+        return header, line, start + pos + 1
+
+
+def formatrow(dt, bar, header):
+    tokens = [dt]
+    tokens.extend('%s' % float(bar[name]) for name in header[1:])
+    return ','.join(tokens) + '\n'
+
+
+def update(path, symbol, apikey=APIKEY, url=URL, transport=urllib_transport):
+    '''
+    Brings the CSV file in ``path`` up to date with the daily bars of
+    ``symbol``. Returns the number of bars written (new + refreshed)
+    '''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        series = fetch(symbol, 'full', apikey, url, transport)
+        header, lastdt, offset = HEADER, '', None
+    else:
+        header, stored, offset = lastline(path)
+        header = header.split(',')
+        lastdt = stored.split(',')[0]
+
+        series = fetch(symbol, 'compact', apikey, url, transport)
+        if lastdt and series and lastdt < min(series):
+            # Gap between the stored history and the compact window
+            series = fetch(symbol, 'full', apikey, url, transport)
+
+        if not lastdt:  # only a header in the file
+            offset = None
+
+    # Dates are unique keys in the reply. The last stored bar is refreshed
+    dates = sorted(dt for dt in series if dt >= lastdt)
+    if lastdt and lastdt not in series:
+        offset = None  # keep the stored bar if it cannot be refreshed
+        dates = [dt for dt in dates if dt > lastdt]
+
+    if not dates:
+        return 0
+
+    if dates == [lastdt] and formatrow(lastdt, series[lastdt], header) == \
+            stored.rstrip('\r') + '\n':
+        return 0  # already up to date
+
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if offset is None and not lastdt:
+            with open(tmppath, 'w') as f:
+                f.write(','.join(header) + '\n')
+        else:
+            shutil.copyfile(path, tmppath)
+
+        with open(tmppath, 'r+b') as f:
+            if offset is not None:
+                f.truncate(offset)  # drop the bar which will be refreshed
+            else:
+                f.seek(0, os.SEEK_END)
+                # make sure the last stored line is terminated
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+
+            f.seek(0, os.SEEK_END)
+            f.write(''.join(formatrow(dt, series[dt], header)
+                            for dt in dates).encode('utf-8'))
+
+        os.replace(tmppath, path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    return len(dates)
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Incremental Alpha Vantage daily downloader')
+
+    parser.add_argument('--symbol', required=False, default='VALE3.SA',
+                        help='The Symbol of the Instrument to Download')
+
+    parser.add_argument('--outfile', required=False, default='test_alpha.csv',
+                        help='The CSV file to create or update')
+
+    parser.add_argument('--apikey', required=False,
+                        default=os.environ.get('ALPHAVANTAGE_API_KEY', APIKEY),
+                        help='Alpha Vantage API key')
+
+    parser.add_argument('--url', required=False, default=URL,
+                        help='API endpoint (i.e.: a local stub server)')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    n = update(args.outfile, args.symbol, apikey=args.apikey, url=args.url)
+    print('%s: %d bars written to %s' % (args.symbol, n, args.outfile))
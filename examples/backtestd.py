@@ -0,0 +1,327 @@
+'''
+Warm backtest daemon
+
+Most of the time of a short backtest goes into starting Python and
+importing backtrader, matplotlib (charts) or pandas before the first bar.
+The daemon pays that once: it imports everything up front, makes a warm-up
+run, keeps the parsed data files in memory and then serves run requests
+over a Unix socket (see btclient.py for the client)::
+
+    python backtestd.py --address /tmp/backtestd.sock &
+
+    python btclient.py auto --strat trail=3,buy_limit=0.005 \\
+        --fromdate 2017-10-01 --todate 2018-09-14
+
+A request is one JSON line with the strategy (``module:Class`` or the name
+of an approach in the ``APPROACHES`` of a preloaded module, as in
+``stop-trading.py``), the data file, the dates and the ``key=value``
+strings of the strat/broker/sizer/cerebro kwargs. The reply is one JSON
+line with what the strategy printed and the results.
+
+Each run is made in a process forked from the daemon: it starts with
+everything imported, it can not leave state behind for the next runs and
+several clients are served at the same time. The data files given with
+``--data`` are parsed in the daemon at start and inherited already parsed;
+any other file (or one which changed on disk since) is parsed in the
+forked process, so that a large file never holds up the other clients.
+A client has ``--timeout`` seconds to send its request.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import collections
+import datetime
+import importlib
+import io
+import json
+import os
+import os.path
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# Import the backtrader platform
+import backtrader as bt
+
+import feedcache
+import memfeed
+import runmatrix
+import stratlog
+import universe
+
+
+ADDRESS = '/tmp/backtestd.sock'
+
+TIMEOUT = 10.0  # seconds to receive a request
+
+# Strategy modules imported at start, by default
+PRELOAD = ('stop-trading',)
+
+# Imported at start if installed: the charts and the Alpha Vantage scripts
+WARM = ('chartrender', 'pandas', 'alpha_vantage.timeseries')
+
+
+class _Warmup(bt.Strategy):
+    def __init__(self):
+        self.cross = bt.ind.CrossOver(bt.ind.EMA(period=5), bt.ind.SMA())
+
+    def next(self):
+        if self.cross > 0:
+            self.buy()
+        elif self.cross < 0:
+            self.close()
+
+
+def parsedate(a):
+    '''Date[time] in YYYY-MM-DD[THH:MM:SS] format (or None) to datetime'''
+    if not a:
+        return None
+    dtfmt, tmfmt = '%Y-%m-%d', 'T%H:%M:%S'
+    return datetime.datetime.strptime(a, dtfmt + tmfmt * ('T' in a))
+
+
+class Daemon(object):
+    '''
+    Serves run requests on the Unix socket ``address``. ``modules`` are
+    the strategy modules to import up front, up to ``maxfeeds`` parsed
+    data files are kept and a request must be received in ``timeout``
+    seconds
+    '''
+    def __init__(self, address=ADDRESS, modules=PRELOAD, maxfeeds=16,
+                 timeout=TIMEOUT):
+        self.address = address
+        self.maxfeeds = maxfeeds
+        self.timeout = timeout
+        self.feeds = collections.OrderedDict()  # least recently used first
+
+        self.modules = []
+        for name in list(modules) + list(WARM):
+            try:
+                module = importlib.import_module(name)
+            except ImportError as e:
+                if name in modules:
+                    raise
+                print('Not preloaded %s: %s' % (name, e))
+                continue
+            if name in modules:
+                self.modules.append(module)
+
+    def strategy(self, spec):
+        '''The class for ``module:Class`` or the name of an approach'''
+        if ':' in spec:
+            return universe.loadclass(spec)
+
+        for module in self.modules:
+            approaches = getattr(module, 'APPROACHES', {})
+            if spec in approaches:
+                return approaches[spec]
+
+        raise ValueError('Unknown strategy %s' % spec)
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def cached(self, path):
+        '''The parsed columns of ``path`` if kept (and still current)'''
+        key = self._key(path)
+        columns = self.feeds.pop(key, None)
+        if columns is None:
+            for stale in [k for k in self.feeds if k[0] == key[0]]:
+                del self.feeds[stale]  # older versions of the file
+            return None
+
+        self.feeds[key] = columns  # most recently used
+        return columns
+
+    def feed(self, path):
+        '''The columns of the data file in ``path``, parsed once and kept'''
+        columns = self.cached(path)
+        if columns is None:
+            columns = load(path)
+            self.feeds[self._key(path)] = columns
+            while len(self.feeds) > self.maxfeeds:
+                self.feeds.popitem(last=False)
+        return columns
+
+    def warmup(self):
+        '''A first run paying for what is only loaded when used'''
+        bars = 100
+        closes = [10.0 + abs(i % 40 - 20) for i in range(bars)]
+        dt0 = bt.date2num(datetime.datetime(2000, 1, 1))
+        columns = dict(datetime=[dt0 + i for i in range(bars)], open=closes,
+                       high=closes, low=closes, close=closes,
+                       volume=[1000.0] * bars, openinterest=[0.0] * bars)
+        request = dict(strategy='', data='')
+        with stratlog.configure(level=stratlog.ERROR):
+            run(request, _Warmup, columns)
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # stale socket of a previous daemon
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.address)
+        os.chmod(self.address, 0o600)  # runs import code: owner only
+        sock.listen(64)
+
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # no zombies
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    if not self.handle(conn, sock):
+                        break
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.remove(self.address)
+
+    def handle(self, conn, sock):
+        '''Serves a connection. Returns False to shut down'''
+        conn.settimeout(self.timeout)  # a silent client blocks everyone
+        rfile = conn.makefile('rb')
+        try:
+            request = json.loads(rfile.readline().decode('utf-8') or '{}')
+        except socket.timeout:
+            return True  # gone or stuck: nobody to reply to
+        except ValueError as e:
+            reply(conn, dict(error='Bad request: %s' % e))
+            return True
+        finally:
+            rfile.close()
+
+        if request.get('command') == 'shutdown':
+            reply(conn, dict(output='Shutting down\n'))
+            return False
+
+        try:
+            cls = self.strategy(request.get('strategy', ''))
+            columns = self.cached(request['data'])
+        except Exception as e:
+            reply(conn, dict(error='%s: %s' % (type(e).__name__, e)))
+            return True
+
+        if os.fork():
+            return True  # the child replies
+
+        # Child: run and exit, whatever happens
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            sock.close()
+            conn.settimeout(None)
+            try:
+                if columns is None:  # not kept by the daemon
+                    columns = load(request['data'])
+                result = run(request, cls, columns)
+            except Exception:
+                result = dict(error=traceback.format_exc())
+            reply(conn, result)
+        finally:
+            os._exit(0)
+
+
+def load(path):
+    '''The columns of the (Yahoo) data file ``path``'''
+    return feedcache.load(path, schema='yahoo')
+
+
+def reply(conn, result):
+    conn.sendall((json.dumps(result) + '\n').encode('utf-8'))
+
+
+def run(request, cls, columns):
+    '''
+    Runs a request on ``columns`` capturing what is printed. Returns the
+    reply
+    '''
+    t0 = time.perf_counter()
+    kwargs = dict((name, runmatrix.parse_kwargs(request.get(name, '')))
+                  for name in ('strat', 'broker', 'sizer', 'cerebro'))
+
+    cerebro = bt.Cerebro(stdstats=bool(request.get('chart')))
+    data = memfeed.MemoryData(dataname=columns,
+                              fromdate=parsedate(request.get('fromdate')),
+                              todate=parsedate(request.get('todate')))
+    cerebro.adddata(data)
+    cerebro.broker = bt.brokers.BackBroker(**kwargs['broker'])
+    cerebro.addsizer(bt.sizers.FixedSize, **kwargs['sizer'])
+    cerebro.addstrategy(cls, **kwargs['strat'])
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        strat = cerebro.run(**kwargs['cerebro'])[0]
+        stratlog.logger.flush()
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+    if request.get('chart'):
+        import chartrender
+        chartrender.render(
+            chartrender.capture(strat, title=universe.symbolname(
+                request['data'])),
+            request['chart'])
+
+    trades = strat.analyzers.trades.get_analysis()
+    startvalue = cerebro.broker.startingcash
+    endvalue = cerebro.broker.getvalue()
+    result = dict(output=output, bars=len(data),
+                  trades=trades.get('total', {}).get('closed', 0),
+                  won=trades.get('won', {}).get('total', 0),
+                  startvalue=startvalue, endvalue=endvalue,
+                  pnl=endvalue - startvalue,
+                  elapsed=time.perf_counter() - t0)
+    result['return'] = endvalue / startvalue - 1.0
+    return result
+
+
+def runserver(args=None):
+    args = parse_args(args)
+
+    t0 = time.perf_counter()
+    daemon = Daemon(args.address, modules=[m for m in args.preload.split(',')
+                                           if m],
+                    maxfeeds=args.maxfeeds, timeout=args.timeout)
+    for path in args.data:
+        daemon.feed(path)
+    daemon.warmup()
+    print('Serving on %s (ready in %.2fs)' % (args.address,
+                                              time.perf_counter() - t0))
+    sys.stdout.flush()
+    daemon.serve_forever()
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Warm daemon running backtests for btclient.py')
+
+    parser.add_argument('--address', required=False, default=ADDRESS,
+                        help='Path of the Unix socket')
+
+    parser.add_argument('--preload', required=False,
+                        default=','.join(PRELOAD),
+                        help='Strategy modules to import at start')
+
+    parser.add_argument('--data', required=False, nargs='*', default=[],
+                        help='Data files to parse at start')
+
+    parser.add_argument('--maxfeeds', required=False, default=16, type=int,
+                        help='Parsed data files kept in memory')
+
+    parser.add_argument('--timeout', required=False, default=TIMEOUT,
+                        type=float,
+                        help='Seconds a client has to send its request')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runserver()
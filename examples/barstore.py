@@ -0,0 +1,344 @@
+'''
+Multi-symbol bar store partitioned by symbol and year
+
+A CSV feed parses the whole file even for a short ``fromdate``/``todate``
+window: a 2 year backtest on a 20 year file reads 20 years. The store keeps
+the bars of each symbol in a file per year, each column of it compressed
+on its own (a ``.npz`` with the ``memfeed.COLUMNS``), and a small index per
+symbol with the first and last date number of each year::
+
+    STORE/
+      ABEV3/
+        index.npy    # (year, rows, first, last) of each partition
+        2013.npz
+        ...
+        2018.npz
+
+``read`` looks the requested dates up in the index, opens only the years
+which overlap them, decompresses only the requested columns, and slices
+the first and last of those years with a binary search on their dates.
+
+Bars are added by symbol (new bars of a year are merged into it, those
+with the same date replace the stored ones)::
+
+    store = barstore.Store('store/')
+    store.ingest('../data/PETR4.SA.csv')  # parsed by fastcsv, as PETR4
+    store.write('PETR4', columns)  # memfeed columns
+
+    data = store.feed('PETR4', fromdate=datetime.datetime(2018, 1, 1))
+
+universe.py takes the symbols from a store with ``--store DIR``.
+
+From the command line, ingest CSV files into a store::
+
+    python barstore.py store/ ../data/*.csv
+
+or check and time the reads of a window of a synthetic archive::
+
+    python barstore.py --check --symbols 100 --years 20 \\
+        --fromdate 2016-01-01 --todate 2017-12-31
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import fastcsv
+import memfeed
+
+
+INDEX = 'index.npy'
+
+INDEX_FIELDS = (
+    ('year', 'i4'),
+    ('rows', 'i8'),
+    ('first', 'f8'),  # date number of the first bar
+    ('last', 'f8'),  # date number of the last bar
+)
+
+
+def years(dtnums):
+    '''The calendar year of each date number'''
+    days = np.floor(np.asarray(dtnums, dtype=np.float64)) - fastcsv.EPOCH
+    return days.astype('M8[D]').astype('M8[Y]').astype(np.int64) + 1970
+
+
+def _replace(path, write):
+    '''Calls ``write(file)`` on a file aside and renames it to ``path``'''
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmppath, 'wb') as f:
+            write(f)
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+class Store(object):
+    '''
+    The bars of many symbols under the directory ``root``. ``stats``
+    counts the ``partitions`` opened and the compressed ``bytes`` of the
+    columns read by this process
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.stats = dict(partitions=0, bytes=0)
+
+    def _dir(self, symbol):
+        if not symbol or os.sep in symbol or symbol.startswith('.'):
+            raise ValueError('Invalid symbol: %r' % symbol)
+        return os.path.join(self.root, symbol)
+
+    def _partition(self, symbol, year):
+        return os.path.join(self._dir(symbol), '%d.npz' % year)
+
+    def symbols(self):
+        '''The symbols in the store'''
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, INDEX)))
+
+    def index(self, symbol):
+        '''The ``INDEX_FIELDS`` of the partitions of ``symbol``, by year'''
+        path = os.path.join(self._dir(symbol), INDEX)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=list(INDEX_FIELDS))
+        return np.load(path)
+
+    def _load(self, symbol, year, names):
+        '''The ``names`` columns of the partition ``year`` of ``symbol``'''
+        with zipfile.ZipFile(self._partition(symbol, year)) as zf:
+            cols = dict()
+            for name in names:
+                info = zf.getinfo(name + '.npy')
+                self.stats['bytes'] += info.compress_size
+                with zf.open(info) as f:
+                    cols[name] = np.lib.format.read_array(f)
+
+        self.stats['partitions'] += 1
+        return cols
+
+    def write(self, symbol, columns):
+        '''
+        Stores the bars in the ``memfeed.COLUMNS`` of ``columns`` (in any
+        order, the last of those with the same date kept), merged into those
+        already stored for ``symbol``
+        '''
+        if not len(columns['datetime']):
+            return
+
+        dirname = self._dir(symbol)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        index = dict((int(row['year']), row) for row in self.index(symbol))
+        new = self._sorted(dict(
+            (name, np.asarray(columns[name], dtype=np.float64))
+            for name in memfeed.COLUMNS))
+        byyear = years(new['datetime'])
+        for year in np.unique(byyear).tolist():
+            mask = byyear == year
+            cols = dict((name, col[mask]) for name, col in new.items())
+            if year in index:
+                cols = self._merge(
+                    self._load(symbol, year, memfeed.COLUMNS), cols)
+
+            _replace(self._partition(symbol, year),
+                     lambda f: np.savez_compressed(f, **cols))
+
+            first, last = cols['datetime'][0], cols['datetime'][-1]
+            index[year] = (year, len(cols['datetime']), first, last)
+
+        rows = np.array([tuple(index[y]) for y in sorted(index)],
+                        dtype=list(INDEX_FIELDS))
+        _replace(os.path.join(dirname, INDEX), lambda f: np.save(f, rows))
+
+    @staticmethod
+    def _sorted(cols):
+        '''The bars of ``cols`` by date, the last of each date kept'''
+        order = np.argsort(cols['datetime'], kind='stable')
+        dts = cols['datetime'][order]
+        keep = np.append(dts[1:] != dts[:-1], True)  # the last of each date
+        return dict((name, col[order][keep]) for name, col in cols.items())
+
+    @classmethod
+    def _merge(cls, old, new):
+        '''The bars of ``old`` and ``new`` by date, ``new`` replacing'''
+        return cls._sorted(dict(
+            (name, np.concatenate((old[name], new[name])))
+            for name in memfeed.COLUMNS))  # old first on equal dates
+
+    def read(self, symbol, fromdate=None, todate=None,
+             names=memfeed.COLUMNS):
+        '''
+        The ``names`` columns of ``symbol`` from ``fromdate`` to ``todate``
+        (both included, as the feeds take them), reading only the years in
+        between
+        '''
+        names = ['datetime'] + [n for n in names if n != 'datetime']
+        lo, hi = float('-inf'), float('inf')
+        if fromdate is not None:
+            lo = fastcsv.datelimit(fromdate, datetime.time.min)
+        if todate is not None:
+            hi = fastcsv.datelimit(todate, datetime.time(23, 59, 59, 999990))
+
+        index = self.index(symbol)
+        if not len(index):
+            raise ValueError('No bars stored for symbol %s' % symbol)
+
+        parts = []
+        for row in index[(index['last'] >= lo) & (index['first'] <= hi)]:
+            cols = self._load(symbol, int(row['year']), names)
+            if row['first'] < lo or row['last'] > hi:  # partly in the dates
+                dts = cols['datetime']
+                start = np.searchsorted(dts, lo, side='left')
+                end = np.searchsorted(dts, hi, side='right')
+                cols = dict((n, c[start:end]) for n, c in cols.items())
+            parts.append(cols)
+
+        return dict((n, np.concatenate([p[n] for p in parts])
+                     if parts else np.zeros(0)) for n in names)
+
+    def ingest(self, path, symbol=None, **kwargs):
+        '''
+        Stores the bars of the CSV file ``path`` (see ``fastcsv.read`` for
+        the ``kwargs``) as ``symbol`` (default: ``ABEV3`` for
+        ``ABEV3.SA.csv``). Returns the symbol
+        '''
+        if symbol is None:
+            import universe
+            symbol = universe.symbolname(path)
+
+        self.write(symbol, fastcsv.read(path, **kwargs))
+        return symbol
+
+    def feed(self, symbol, fromdate=None, todate=None, **kwargs):
+        '''
+        A ``memfeed.MemoryData`` feed (``kwargs``: its params) with the bars
+        of ``symbol`` from ``fromdate`` to ``todate``
+        '''
+        cols = self.read(symbol, fromdate=fromdate, todate=todate)
+        kwargs.setdefault('name', symbol)
+        return memfeed.MemoryData(dataname=cols, **kwargs)
+
+
+# Check
+def runcheck(args):
+    import synthdata
+
+    fromdate = datetime.datetime.strptime(args.fromdate, '%Y-%m-%d')
+    todate = datetime.datetime.strptime(args.todate, '%Y-%m-%d')
+    bars = args.years * 261  # weekdays
+
+    tmpdir = tempfile.mkdtemp(prefix='barstore-')
+    try:
+        store = Store(os.path.join(tmpdir, 'store'))
+        t0 = time.perf_counter()
+        for i in range(args.symbols):
+            store.write('SYM%04d' % i, synthdata.columns(bars, seed=i))
+        print('Archive: %d symbols x %d years (%d bars each), %.2f secs' % (
+            args.symbols, args.years, bars, time.perf_counter() - t0))
+
+        # The whole history of one symbol as a CSV file, for comparison
+        csvpath = os.path.join(tmpdir, 'SYM0000.csv')
+        synthdata.write(csvpath, bars, fmt='yahoo', seed=0)
+        t0 = time.perf_counter()
+        fastcsv.read(csvpath, schema='generic', fromdate=fromdate,
+                     todate=todate)
+        csvsecs = time.perf_counter() - t0
+
+        total = sum(os.path.getsize(os.path.join(dirpath, name))
+                    for dirpath, _, names in os.walk(store.root)
+                    for name in names)
+        t0 = time.perf_counter()
+        windows = [store.read(symbol, fromdate, todate)
+                   for symbol in store.symbols()]
+        secs = time.perf_counter() - t0
+
+        # The same bars as the window of the whole series
+        same = True
+        for i, cols in enumerate(windows[:3]):
+            full = synthdata.columns(bars, seed=i)
+            dts = np.asarray(full['datetime'])
+            mask = ((dts >= bt.date2num(fromdate)) &
+                    (dts <= bt.date2num(todate)))
+            same = same and all(np.array_equal(np.asarray(full[n])[mask],
+                                               cols[n])
+                                for n in memfeed.COLUMNS)
+
+        print('Window %s - %s: %d bars per symbol, same bars: %s' % (
+            args.fromdate, args.todate, len(windows[0]['datetime']), same))
+        print('Read: %d partitions, %.1f of %.1f MB compressed (%.1f%%), '
+              '%.3f secs (%.2f ms per symbol)' % (
+                  store.stats['partitions'], store.stats['bytes'] / 2 ** 20,
+                  total / 2 ** 20, 100.0 * store.stats['bytes'] / total, secs,
+                  1000.0 * secs / args.symbols))
+        print('One symbol from its CSV file (fastcsv): %.2f ms' % (
+            1000.0 * csvsecs))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def runingest(args=None):
+    args = parse_args(args)
+    if args.check:
+        return runcheck(args)
+
+    if not args.store:
+        raise SystemExit('A store directory is needed unless --check is given')
+
+    store = Store(args.store)
+    for path in args.files:
+        symbol = store.ingest(path)
+        index = store.index(symbol)
+        print('%-10s %6d bars, %d years (%d-%d)' % (
+            symbol, index['rows'].sum(), len(index), index['year'][0],
+            index['year'][-1]))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Ingest CSV files into a bar store (or check one)')
+
+    parser.add_argument('store', nargs='?', default='',
+                        help='Directory of the store')
+
+    parser.add_argument('files', nargs='*',
+                        help='CSV files (Yahoo or Alpha Vantage headers)')
+
+    parser.add_argument('--check', required=False, action='store_true',
+                        help='Check and time a synthetic archive instead')
+
+    parser.add_argument('--symbols', required=False, default=100, type=int,
+                        help='Symbols of the synthetic archive')
+
+    parser.add_argument('--years', required=False, default=20, type=int,
+                        help='Years of bars of each symbol')
+
+    parser.add_argument('--fromdate', required=False, default='2016-01-01',
+                        help='Start of the window read (YYYY-MM-DD)')
+
+    parser.add_argument('--todate', required=False, default='2017-12-31',
+                        help='End of the window read (YYYY-MM-DD)')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runingest()
@@ -0,0 +1,399 @@
+'''
+Benchmarks of the example strategies
+
+Every strategy class of the examples is run on synthetic and real feeds of
+10k, 100k and 1M bars, with ``runonce=True`` (vectorized indicators) and
+``runonce=False`` (bar by bar). For each case the following is recorded:
+
+  - ``wall``: seconds spent in ``cerebro.run()``
+  - ``bps``: bars per second
+  - ``peak_rss``: peak resident memory of the process (bytes)
+  - ``blocks``: Python memory blocks still allocated after the run
+  - ``alloc_peak``: peak of the memory traced by ``tracemalloc`` (bytes),
+    only with ``--allocs`` and measured in a separate run, because tracing
+    slows the run down
+
+Each case runs in a fresh worker process, one case at a time, so the
+peak RSS belongs to the case alone and the runs do not compete for cores.
+The feeds are built in memory (see memfeed.py) to time the strategies and
+not the CSV parsing:
+
+  - ``synthetic``: a synthdata.py series from a fixed seed
+  - ``real``: the bar to bar moves of a CSV in ``data/`` repeated until
+    the requested size is reached
+
+The strategies only log errors: the log output is not part of the
+measurements.
+
+Results are appended to a JSON history. ``compare`` checks the last run
+(or any run) against a previous one and flags the cases which got slower
+or bigger beyond a threshold, returning a non zero exit code::
+
+    python bench.py run --sizes 10000,100000 --label baseline
+    python bench.py run --sizes 10000,100000
+    python bench.py compare --threshold 0.10
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import array
+import collections
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import feedcache
+import memfeed
+import resample
+import stratlog
+import synthdata
+
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data')
+
+# name -> (module, class, kwargs for the strategy)
+STRATEGIES = collections.OrderedDict([
+    ('sma', ('petr4_backtrader_plot', 'TestStrategy', {})),
+    ('rsi_sma', ('petr4_backtrader', 'TestStrategy', {})),
+    ('macd', ('petr4_macd', 'TheStrategy', {})),
+    ('bbands', ('bollinger_bands_emuriba', 'TestStrategy', {})),
+    ('bbands_av', ('bollinger_bands_with_alphavantage', 'TestStrategy', {})),
+    ('pivot', ('pivot_point_example', 'St', {})),
+    ('stop_manual', ('stop-trading', 'ManualStopOrStopTrail', {})),
+    ('stop_manualcheat', ('stop-trading', 'ManualStopOrStopTrailCheat', {})),
+    ('stop_auto', ('stop-trading', 'AutoStopOrStopTrail', {})),
+])
+
+# Strategies needing more than the daily data (precomputed, see resample)
+RESAMPLED = dict(pivot=bt.TimeFrame.Months)
+
+FEEDS = ('synthetic', 'real')
+SIZES = (10000, 100000, 1000000)
+MODES = dict(once=True, next=False)
+
+# Repeated real bars are one day apart from here on (1M end in 4637)
+START = datetime.datetime(1900, 1, 1)
+
+METRICS = ('bps', 'peak_rss', 'alloc_peak')  # checked by compare
+
+
+def _columns(o, h, l, c, v):
+    dts = bt.date2num(START) + np.arange(len(c), dtype=np.float64)
+    cols = dict(datetime=dts, open=o, high=h, low=l, close=c, volume=v,
+                openinterest=np.zeros(len(c)))
+    return dict((name, array.array(str('d'), np.asarray(col, np.float64)))
+                for name, col in cols.items())
+
+
+def real(size, path=os.path.join(DATADIR, 'PETR4.SA.csv')):
+    '''
+    Columns of ``size`` daily bars repeating the moves of the Yahoo CSV in
+    ``path``: each bar keeps its open, high, low and close relative to the
+    previous close, so prices stay continuous across the repetitions
+    '''
+    cols = feedcache.load(path, schema='yahoo')
+    o, h, l, c, v = (np.asarray(cols[name]) for name in
+                     ('open', 'high', 'low', 'close', 'volume'))
+
+    prev = np.append(c[0], c[:-1])
+    moves = np.log(c / prev)
+    reps = -(-size // len(c))
+    moves = np.tile(moves, reps)[:size]
+    closes = c[0] * np.exp(np.cumsum(moves))
+    prevs = np.append(c[0], closes[:-1])
+
+    ratio = dict((name, np.tile(x / prev, reps)[:size])
+                 for name, x in (('open', o), ('high', h), ('low', l)))
+    return _columns(prevs * ratio['open'], prevs * ratio['high'],
+                    prevs * ratio['low'], closes, np.tile(v, reps)[:size])
+
+
+def makefeed(feed, size, seed=0):
+    if feed == 'synthetic':
+        return synthdata.columns(size, seed=seed)
+    if feed == 'real':
+        return real(size)
+    raise ValueError('Unknown feed: %s' % feed)
+
+
+def loadstrategy(name):
+    modname, clsname, kwargs = STRATEGIES[name]
+    return getattr(importlib.import_module(modname), clsname), kwargs
+
+
+def measure(case):
+    '''
+    Runs one ``case`` (dict with strategy, feed, size, mode, seed, trace) in
+    the calling process. Returns the dict of metrics or the ``error``
+    '''
+    name = case['strategy']
+    result = dict(case)
+    result.pop('trace')
+    try:
+        columns = makefeed(case['feed'], case['size'], case['seed'])
+        stcls, kwargs = loadstrategy(name)
+
+        cerebro = bt.Cerebro()
+        data = memfeed.MemoryData(dataname=columns)
+        cerebro.adddata(data)
+        if name in RESAMPLED:
+            cerebro.adddata(resample.ResampledData(columns, RESAMPLED[name]))
+
+        cerebro.addstrategy(stcls, **kwargs)
+        cerebro.broker.setcash(100000.0)
+        cerebro.addsizer(bt.sizers.FixedSize, stake=10)
+        cerebro.broker.setcommission(commission=0.001)
+
+        blocks = sys.getallocatedblocks()
+        if case['trace']:
+            tracemalloc.start()
+
+        t0 = time.perf_counter()
+        with stratlog.configure(level=stratlog.ERROR):
+            cerebro.run(runonce=MODES[case['mode']])
+        wall = time.perf_counter() - t0
+
+        if case['trace']:
+            result['alloc_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return result
+
+        result.update(
+            wall=wall, bps=case['size'] / wall,
+            blocks=sys.getallocatedblocks() - blocks,
+            # kilobytes on Linux
+            peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            value=cerebro.broker.getvalue())
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+
+    return result
+
+
+def casekey(result):
+    return '%(strategy)s/%(feed)s/%(size)d/%(mode)s' % result
+
+
+def run(strategies=None, feeds=FEEDS, sizes=SIZES, modes=('once', 'next'),
+        seed=0, allocs=False, callback=None):
+    '''
+    Measures every combination of the arguments, each in a fresh process.
+    Returns the list of results. ``callback(result)`` is called as each
+    case finishes
+    '''
+    cases = [dict(strategy=s, feed=f, size=n, mode=m, seed=seed, trace=False)
+             for n in sizes for f in feeds
+             for s in (strategies or list(STRATEGIES)) for m in modes]
+
+    results = []
+    # maxtasksperchild=1: a new process (and a new peak RSS) per case
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for case in cases:
+            result = pool.apply(measure, (case,))
+            if allocs and 'error' not in result:
+                traced = pool.apply(measure, (dict(case, trace=True),))
+                result['alloc_peak'] = traced.get('alloc_peak')
+
+            results.append(result)
+            if callback is not None:
+                callback(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def loadhistory(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def savehistory(path, history):
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+def gitcommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(base, head, threshold=0.10):
+    '''
+    Compares the results of two history entries. Returns a list of
+    ``(key, metric, basevalue, headvalue, change)`` for the regressions: a
+    ``bps`` drop or a ``peak_rss``/``alloc_peak`` growth beyond
+    ``threshold`` (a fraction) and cases which no longer run
+    '''
+    before = dict((casekey(r), r) for r in base['results'])
+    regressions = []
+    for r in head['results']:
+        key = casekey(r)
+        b = before.get(key)
+        if b is None or 'error' in b:
+            continue
+
+        if 'error' in r:
+            regressions.append((key, 'error', None, r['error'], None))
+            continue
+
+        for metric in METRICS:
+            if b.get(metric) is None or r.get(metric) is None:
+                continue
+
+            change = r[metric] / b[metric] - 1.0
+            if metric == 'bps':
+                worse = change < -threshold
+            else:
+                worse = change > threshold
+
+            if worse:
+                regressions.append((key, metric, b[metric], r[metric],
+                                    change))
+
+    return regressions
+
+
+def printresult(result):
+    if 'error' in result:
+        print('%-40s ERROR %s' % (casekey(result), result['error']))
+    else:
+        print('%-40s %9.3f %12.0f %10.1f %12s' % (
+            casekey(result), result['wall'], result['bps'],
+            result['peak_rss'] / 2.0 ** 20,
+            '%.1f' % (result['alloc_peak'] / 2.0 ** 20)
+            if result.get('alloc_peak') is not None else '-'))
+    sys.stdout.flush()
+
+
+def runbench(args=None):
+    args = parse_args(args)
+    history = loadhistory(args.history)
+
+    if args.command == 'compare':
+        if len(history) < 2:
+            print('Need at least 2 runs in %s' % args.history)
+            return 2
+
+        base, head = history[args.base], history[args.head]
+        regressions = compare(base, head, threshold=args.threshold)
+        print('Base: %s %s (%s)' % (base['date'], base['commit'],
+                                    base['label']))
+        print('Head: %s %s (%s)' % (head['date'], head['commit'],
+                                    head['label']))
+        for key, metric, b, h, change in regressions:
+            if metric == 'error':
+                print('%-40s error: %s' % (key, h))
+            else:
+                print('%-40s %-10s %14.1f -> %14.1f %+7.1f%%' % (
+                    key, metric, b, h, change * 100.0))
+
+        print('Regressions: %d (threshold %.1f%%)' % (
+            len(regressions), args.threshold * 100.0))
+        return 1 if regressions else 0
+
+    strategies = [s for s in args.strategies.split(',') if s]
+    for s in strategies:
+        if s not in STRATEGIES:
+            raise ValueError('Unknown strategy %s, choose from: %s' % (
+                s, ', '.join(STRATEGIES)))
+
+    print('%-40s %9s %12s %10s %12s' % (
+        'Case', 'Wall(s)', 'Bars/s', 'RSS(MB)', 'Alloc(MB)'))
+
+    results = run(strategies=strategies,
+                  feeds=[f for f in args.feeds.split(',') if f],
+                  sizes=[int(n) for n in args.sizes.split(',') if n],
+                  modes=[m for m in args.modes.split(',') if m],
+                  seed=args.seed, allocs=args.allocs, callback=printresult)
+
+    history.append(dict(
+        date=datetime.datetime.now().isoformat(timespec='seconds'),
+        commit=gitcommit(), label=args.label,
+        python=platform.python_version(), backtrader=bt.__version__,
+        machine=platform.machine(), cpus=multiprocessing.cpu_count(),
+        results=results))
+    savehistory(args.history, history)
+    print('Run %d saved to %s' % (len(history) - 1, args.history))
+    return 0
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Benchmark the example strategies')
+
+    parser.add_argument('command', choices=['run', 'compare'],
+                        help='Run the benchmarks or compare two runs')
+
+    parser.add_argument('--history', required=False,
+                        default='bench_history.json',
+                        help='JSON file with the results of every run')
+
+    # run
+    parser.add_argument('--strategies', required=False, default='',
+                        help='Comma separated subset of: %s' %
+                             ','.join(STRATEGIES))
+
+    parser.add_argument('--feeds', required=False, default=','.join(FEEDS),
+                        help='Comma separated feeds')
+
+    parser.add_argument('--sizes', required=False,
+                        default=','.join(str(n) for n in SIZES),
+                        help='Comma separated number of bars')
+
+    parser.add_argument('--modes', required=False, default='once,next',
+                        help='once: runonce=True, next: runonce=False')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the synthetic feed')
+
+    parser.add_argument('--allocs', required=False, action='store_true',
+                        help='Also trace the allocations (one more run per '
+                             'case)')
+
+    parser.add_argument('--label', required=False, default='',
+                        help='Label stored with the run')
+
+    # compare
+    parser.add_argument('--base', required=False, default=-2, type=int,
+                        help='Index of the run to compare against')
+
+    parser.add_argument('--head', required=False, default=-1, type=int,
+                        help='Index of the run to check')
+
+    parser.add_argument('--threshold', required=False, default=0.10,
+                        type=float,
+                        help='Allowed slowdown/growth as a fraction')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    sys.exit(runbench())
@@ -1,3 +1,4 @@
+import argparse
 import datetime  # For datetime objects
 import os.path  # To manage paths
 import sys  # To find out the script name (in argv[0])
@@ -5,15 +6,13 @@ import sys  # To find out the script name (in argv[0])
 # Import the backtrader platform
 import backtrader as bt
 
+import feedcache
+import stratlog
+
 # Create a Stratey
-class TestStrategy(bt.Strategy):
+class TestStrategy(stratlog.LoggerMixin, bt.Strategy):
     params = (('BBandsperiod', 20),)
 
-    def log(self, txt, dt=None):
-        ''' Logging function fot this strategy'''
-        dt = dt or self.datas[0].datetime.date(0)
-        print('%s, %s' % (dt.isoformat(), txt))
-
     def __init__(self):
         # Keep a reference to the "close" line in the data[0] dataseries
         self.dataclose = self.datas[0].close
@@ -37,19 +36,19 @@ class TestStrategy(bt.Strategy):
         # Attention: broker could reject order if not enougth cash
         if order.status in [order.Completed, order.Canceled, order.Margin]:
             if order.isbuy():
-                self.log(
-                    'BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f' %
-                    (order.executed.price,
-                     order.executed.value,
-                     order.executed.comm))
+                self.info(
+                    'BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f',
+                    order.executed.price,
+                    order.executed.value,
+                    order.executed.comm)
 
                 self.buyprice = order.executed.price
                 self.buycomm = order.executed.comm
             else:  # Sell
-                self.log('SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f' %
-                         (order.executed.price,
+                self.info('SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f',
+                          order.executed.price,
                           order.executed.value,
-                          order.executed.comm))
+                          order.executed.comm)
 
             self.bar_executed = len(self)
 
@@ -60,14 +59,14 @@ class TestStrategy(bt.Strategy):
         if not trade.isclosed:
             return
 
-        self.log('OPERATION PROFIT, GROSS %.2f, NET %.2f' %
-                 (trade.pnl, trade.pnlcomm))
+        self.info('OPERATION PROFIT, GROSS %.2f, NET %.2f',
+                  trade.pnl, trade.pnlcomm)
 
 
 
     def next(self):
         # Simply log the closing price of the series from the reference
-        self.log('Close, %.2f' % self.dataclose[0])
+        self.debug('Close, %.2f', self.dataclose[0])
 
         # Check if an order is pending ... if yes, we cannot send a 2nd one
         if self.order:
@@ -81,25 +80,41 @@ class TestStrategy(bt.Strategy):
 
         if self.dataclose[0] >= self.bband.lines.bot and not self.position and self.redline:
             # BUY, BUY, BUY!!! (with all possible default parameters)
-            self.log('BUY CREATE, %.2f' % self.dataclose[0])
+            self.info('BUY CREATE, %.2f', self.dataclose[0])
             # Keep track of the created order to avoid a 2nd order
             self.order = self.buy()
 
         #if self.dataclose[0] < self.bband.lines.top and self.position and self.blueline:
             # BUY, BUY, BUY!!! (with all possible default parameters)
-            #self.log('BUY CREATE, %.2f' % self.dataclose[0])
+            #self.info('BUY CREATE, %.2f', self.dataclose[0])
             # Keep track of the created order to avoid a 2nd order
             #self.order = self.buy()
 
         if self.dataclose[0] < self.bband.lines.top and self.position and self.blueline:
             # SELL, SELL, SELL!!! (with all possible default parameters)
-            self.log('SELL CREATE, %.2f' % self.dataclose[0])
+            self.info('SELL CREATE, %.2f', self.dataclose[0])
             self.blueline = False
             self.redline = False
             # Keep track of the created order to avoid a 2nd order
             self.order = self.sell()
 
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Bollinger Bands strategy on PETR4')
+
+    parser.add_argument('--render', required=False, default='',
+                        metavar='FILE',
+                        help='Write the chart to a png/svg/html file instead '
+                             'of opening an interactive plot')
+
+    return parser.parse_args(pargs)
+
+
 if __name__ == '__main__':
+    args = parse_args()
+
     # Create a cerebro entity
     cerebro = bt.Cerebro()
 
@@ -113,8 +128,8 @@ if __name__ == '__main__':
     #datapath = os.path.join(modpath, 'data/ABEV3.SA.csv')
     #datapath = os.path.join(modpath, 'data/VALE3.SA.csv')
 
-    # Create a Data Feed
-    data = bt.feeds.YahooFinanceCSVData(
+    # Create a Data Feed (parsed once, then from the binary cache)
+    data = feedcache.YahooFinanceCSVData(
         dataname=datapath,
         # Do not pass values before this date
         fromdate=datetime.datetime(2015, 1, 1),
@@ -139,10 +154,14 @@ if __name__ == '__main__':
     print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
     # Run over everything
-    cerebro.run()
+    strats = cerebro.run()
 
     # Print out the final result
     print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
     # Plot the result
-    cerebro.plot()
\ No newline at end of file
+    if args.render:
+        import chartrender
+        chartrender.render(chartrender.capture(strats[0]), args.render)
+    else:
+        cerebro.plot()
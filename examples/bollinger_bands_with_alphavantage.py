@@ -2,22 +2,20 @@ import datetime  # For datetime objects
 import os.path  # To manage paths
 import sys  # To find out the script name (in argv[0])
 
-from alpha_vantage.timeseries import TimeSeries
 import argparse
-import pandas as pd
 
 # Import the backtrader platform
 import backtrader as bt
 
+import alpha_vantage_update
+import fastcsv
+import fastind
+import stratlog
+
 # Create a Stratey
-class TestStrategy(bt.Strategy):
+class TestStrategy(stratlog.LoggerMixin, bt.Strategy):
     params = (('BBandsperiod', 20),)
 
-    def log(self, txt, dt=None):
-        ''' Logging function fot this strategy'''
-        dt = dt or self.datas[0].datetime.date(0)
-        print('%s, %s' % (dt.isoformat(), txt))
-
     def __init__(self):
         # Keep a reference to the "close" line in the data[0] dataseries
         self.dataclose = self.datas[0].close
@@ -30,7 +28,7 @@ class TestStrategy(bt.Strategy):
         self.blueline = None
 
         # Add a BBand indicator
-        self.bband = bt.indicators.BBands(self.datas[0], period=self.params.BBandsperiod)
+        self.bband = fastind.BBands(self.datas[0], period=self.params.BBandsperiod)
 
     def notify_order(self, order):
         if order.status in [order.Submitted, order.Accepted]:
@@ -41,19 +39,19 @@ class TestStrategy(bt.Strategy):
         # Attention: broker could reject order if not enougth cash
         if order.status in [order.Completed, order.Canceled, order.Margin]:
             if order.isbuy():
-                self.log(
-                    'BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f' %
-                    (order.executed.price,
-                     order.executed.value,
-                     order.executed.comm))
+                self.info(
+                    'BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f',
+                    order.executed.price,
+                    order.executed.value,
+                    order.executed.comm)
 
                 self.buyprice = order.executed.price
                 self.buycomm = order.executed.comm
             else:  # Sell
-                self.log('SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f' %
-                         (order.executed.price,
+                self.info('SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f',
+                          order.executed.price,
                           order.executed.value,
-                          order.executed.comm))
+                          order.executed.comm)
 
             self.bar_executed = len(self)
 
@@ -64,14 +62,14 @@ class TestStrategy(bt.Strategy):
         if not trade.isclosed:
             return
 
-        self.log('OPERATION PROFIT, GROSS %.2f, NET %.2f' %
-                 (trade.pnl, trade.pnlcomm))
+        self.info('OPERATION PROFIT, GROSS %.2f, NET %.2f',
+                  trade.pnl, trade.pnlcomm)
 
 
 
     def next(self):
         # Simply log the closing price of the series from the reference
-        self.log('Close, %.2f' % self.dataclose[0])
+        self.debug('Close, %.2f', self.dataclose[0])
 
         # Check if an order is pending ... if yes, we cannot send a 2nd one
         if self.order:
@@ -85,25 +83,47 @@ class TestStrategy(bt.Strategy):
 
         if self.dataclose > self.bband.lines.mid and not self.position and self.redline:
             # BUY, BUY, BUY!!! (with all possible default parameters)
-            self.log('BUY CREATE, %.2f' % self.dataclose[0])
+            self.info('BUY CREATE, %.2f', self.dataclose[0])
             # Keep track of the created order to avoid a 2nd order
             self.order = self.buy()
 
         if self.dataclose > self.bband.lines.top and not self.position:
             # BUY, BUY, BUY!!! (with all possible default parameters)
-            self.log('BUY CREATE, %.2f' % self.dataclose[0])
+            self.info('BUY CREATE, %.2f', self.dataclose[0])
             # Keep track of the created order to avoid a 2nd order
             self.order = self.buy()
 
         if self.dataclose < self.bband.lines.mid and self.position and self.blueline:
             # SELL, SELL, SELL!!! (with all possible default parameters)
-            self.log('SELL CREATE, %.2f' % self.dataclose[0])
+            self.info('SELL CREATE, %.2f', self.dataclose[0])
             self.blueline = False
             self.redline = False
             # Keep track of the created order to avoid a 2nd order
             self.order = self.sell()
 
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Bollinger Bands strategy on Alpha Vantage data')
+
+    parser.add_argument('--replay', required=False, default='',
+                        metavar='ADDRESS',
+                        help='Paper-trade the bars of a replay.py server '
+                             '(host:port or Unix socket) instead of the CSV')
+
+    parser.add_argument('--symbol', required=False, default='test_alpha',
+                        help='Symbol to request from the replay server')
+
+    parser.add_argument('--rate', required=False, default=0.0, type=float,
+                        help='Bars per second requested from the server')
+
+    return parser.parse_args(pargs)
+
+
 if __name__ == '__main__':
+    args = parse_args()
+
     # Create a cerebro entity
     cerebro = bt.Cerebro()
 
@@ -111,32 +131,36 @@ if __name__ == '__main__':
     cerebro.addstrategy(TestStrategy)
 
 
-    # Submit our API and create a session
-    alpha_ts = TimeSeries(key='X2YNJWH7QSF0OY2C', output_format='pandas')
-
-    # Get the data
-    #data, meta_data = alpha_ts.get_daily(symbol=args.symbol, outputsize='full or compact')
-    data, meta_data = alpha_ts.get_daily(symbol="VALE3.SA", outputsize='full')
-
-    # Save the data
-    data.to_csv("test_alpha.csv")
-
     modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
     datapath = os.path.join(modpath, 'test_alpha.csv')
 
-    #date,5. volume,4. close,2. high,1. open,3. low
-    data_to_analyse = bt.feeds.GenericCSVData(dataname=datapath,
-                                              datetime=0,
-                                              fromdate=datetime.datetime(2008, 5, 4),
-                                              todate=datetime.datetime(2018, 9, 21),
-                                              dtformat='%Y-%m-%d',
-                                              time=-1,
-                                              volume=1,
-                                              close=2,
-                                              high=3,
-                                              open=4,
-                                              low=5,
-                                              openinterest=-1)
+    if args.replay:
+        import replay
+        # Live feed: each bar is processed as it arrives from the server
+        data_to_analyse = replay.ReplayStore(args.replay, rate=args.rate) \
+            .getdata(args.symbol,
+                     fromdate=datetime.datetime(2008, 5, 4),
+                     todate=datetime.datetime(2018, 9, 21))
+        cerebro.addanalyzer(replay.Latency, _name='latency')
+    else:
+        # Get the data: only the bars missing in the file are downloaded
+        alpha_vantage_update.update(datapath, symbol="VALE3.SA")
+
+        #date,5. volume,4. close,2. high,1. open,3. low
+        # Parsed in bulk, the columns found by their names in the header
+        data_to_analyse = fastcsv.GenericCSVData(
+            dataname=datapath,
+            datetime=0,
+            fromdate=datetime.datetime(2008, 5, 4),
+            todate=datetime.datetime(2018, 9, 21),
+            dtformat='%Y-%m-%d',
+            time=-1,
+            volume=1,
+            close=2,
+            high=3,
+            open=4,
+            low=5,
+            openinterest=-1)
 
     # Add the Data Feed to Cerebro
     cerebro.adddata(data_to_analyse)
@@ -154,10 +178,14 @@ if __name__ == '__main__':
     print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
     # Run over everything
-    cerebro.run()
+    strats = cerebro.run()
 
     # Print out the final result
     print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
-    # Plot the result
-    cerebro.plot()
\ No newline at end of file
+    if args.replay:
+        print(replay.report(args.symbol,
+                            strats[0].analyzers.latency.get_analysis()))
+    else:
+        # Plot the result
+        cerebro.plot()
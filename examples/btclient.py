@@ -0,0 +1,129 @@
+'''
+Thin client of the warm backtest daemon (backtestd.py)
+
+Takes the arguments of ``stop-trading.py`` and has the daemon make the
+run, printing what the strategy printed and the results. Only the standard
+library is imported, so the client itself starts in a few milliseconds::
+
+    python btclient.py auto --strat trail=3,buy_limit=0.005 \\
+        --fromdate 2017-10-01 --todate 2018-09-14
+
+    python btclient.py petr4_macd:TheStrategy --data0 ../data/PETR4.SA.csv \\
+        --chart /tmp/petr4.png
+
+Without dates the whole data file is used.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import json
+import os.path
+import socket
+import sys
+import time
+
+
+ADDRESS = '/tmp/backtestd.sock'  # as in backtestd.py
+
+
+def request(address, payload):
+    '''Sends ``payload`` (a dict) to the daemon and returns its reply'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        sock.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def runclient(args=None):
+    args = parse_args(args)
+
+    if args.shutdown:
+        payload = dict(command='shutdown')
+    else:
+        # Datas are in a subfolder of the samples, relative to this script
+        modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+        payload = dict(strategy=args.strategy,
+                       data=os.path.join(modpath, args.data0),
+                       fromdate=args.fromdate, todate=args.todate,
+                       cerebro=args.cerebro, broker=args.broker,
+                       sizer=args.sizer, strat=args.strat,
+                       chart=args.chart and os.path.abspath(args.chart))
+
+    t0 = time.perf_counter()
+    reply = request(args.address, payload)
+    elapsed = time.perf_counter() - t0
+
+    sys.stdout.write(reply.get('output', ''))
+    if 'error' in reply:
+        sys.stderr.write(reply['error'] + '\n')
+        sys.exit(1)
+
+    if not args.shutdown:
+        print('Bars: %d, Trades: %d, Won: %d, Final value: %.2f, '
+              'PnL: %.2f (%.2f%%)' % (
+                  reply['bars'], reply['trades'], reply['won'],
+                  reply['endvalue'], reply['pnl'], reply['return'] * 100.0))
+        print('Run: %.1f ms, round trip: %.1f ms' % (
+            reply['elapsed'] * 1000.0, elapsed * 1000.0))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Run a backtest in the warm daemon (backtestd.py)')
+
+    parser.add_argument('strategy', nargs='?', default='',
+                        help=('Approach of stop-trading.py (i.e.: auto) or '
+                              'module:Class'))
+
+    parser.add_argument('--address', required=False, default=ADDRESS,
+                        help='Path of the Unix socket of the daemon')
+
+    parser.add_argument('--shutdown', required=False, action='store_true',
+                        help='Stop the daemon')
+
+    parser.add_argument('--data0', default='../data/ABEV3.SA.csv',
+                        required=False,
+                        help='Data to read in (relative to this script)')
+
+    parser.add_argument('--fromdate', required=False, default='',
+                        help='Date[time] in YYYY-MM-DD[THH:MM:SS] format')
+
+    parser.add_argument('--todate', required=False, default='',
+                        help='Date[time] in YYYY-MM-DD[THH:MM:SS] format')
+
+    parser.add_argument('--cerebro', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--broker', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--sizer', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--strat', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--chart', required=False, default='',
+                        help='Render the chart to this png/svg/html file')
+
+    args = parser.parse_args(pargs)
+    if not args.strategy and not args.shutdown:
+        parser.error('a strategy is needed unless --shutdown is given')
+
+    return args
+
+
+if __name__ == '__main__':
+    runclient()
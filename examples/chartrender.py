@@ -0,0 +1,233 @@
+'''
+Headless chart rendering for finished backtests
+
+``cerebro.plot()`` opens an interactive matplotlib window and draws every
+bar of every line. Here the lines of a finished strategy are captured into
+plain NumPy arrays (``capture``), reduced to at most one bucket per pixel
+column and written to a PNG, SVG or HTML file (``render``) with the
+non-interactive Agg backend:
+
+  - candles: open of the first bar, max high, min low, close of the last bar
+    in each bucket
+  - indicator and observer lines: the min and the max of each bucket, in the
+    order in which they happened, so spikes survive the reduction
+
+Captured charts are plain arrays which can be rendered away from the run.
+universe.py renders the chart of each symbol inside the worker which ran
+it (``--charts``), so the charts are rendered in parallel.
+
+Usage as a replacement for ``cerebro.plot()``::
+
+    strats = cerebro.run()
+    chartrender.render(chartrender.capture(strats[0]), 'petr4.png')
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import html
+import io
+import os.path
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')  # no windows: render to files only
+import matplotlib.pyplot as plt
+
+# Import the backtrader platform
+import backtrader as bt
+
+
+FORMATS = ('png', 'svg', 'html')
+
+
+def _array(line, size):
+    return np.array(line.get(size=size), dtype=np.float64)
+
+
+def _name(obj):
+    plotname = getattr(obj.plotinfo, 'plotname', '')
+    if plotname:
+        return plotname
+    try:
+        return obj.plotlabel()
+    except Exception:
+        return type(obj).__name__
+
+
+def capture(strategy, title=''):
+    '''
+    Returns a dict with the arrays needed to chart the first data feed of
+    ``strategy`` (after ``cerebro.run()``) and the indicators and observers
+    which have ``plotinfo.plot`` enabled
+    '''
+    data = strategy.datas[0]
+    size = len(data)
+
+    chart = dict(title=title or data._name or _name(data),
+                 datetime=_array(data.lines.datetime, size),
+                 ohlc=[_array(getattr(data.lines, name), size)
+                       for name in ('open', 'high', 'low', 'close')],
+                 overlays=[], panels=[], markers=[])
+
+    # A panel is a (name, [(label, array), ...]) entry. Indicators plotted on
+    # another indicator (i.e. SMMA of the RSI) join the panel of their host
+    hosts = dict()
+    for ind in strategy.getindicators():
+        plotinfo = getattr(ind, 'plotinfo', None)
+        if plotinfo is None or not plotinfo.plot or len(ind) != size:
+            continue
+
+        lines = [('%s %s' % (_name(ind), alias), _array(line, size))
+                 for alias, line in zip(ind.lines.getlinealiases(), ind.lines)]
+
+        host = hosts.get(id(plotinfo.plotmaster or ind.data))
+        if host is not None:
+            host[1].extend(lines)
+        elif plotinfo.subplot:
+            panel = (_name(ind), lines)
+            chart['panels'].append(panel)
+            hosts[id(ind)] = panel
+        else:
+            chart['overlays'].extend(lines)
+
+    for obs in strategy.getobservers():
+        if not obs.plotinfo.plot or len(obs) != size:
+            continue
+
+        aliases = obs.lines.getlinealiases()
+        if isinstance(obs, bt.observers.BuySell):
+            for alias, line in zip(aliases, obs.lines):
+                chart['markers'].append((alias, _array(line, size)))
+        else:
+            chart['panels'].append(
+                (_name(obs), [(alias, _array(line, size))
+                              for alias, line in zip(aliases, obs.lines)]))
+
+    return chart
+
+
+def buckets(size, width):
+    '''Start index of each bucket when reducing ``size`` bars to ``width``'''
+    if size <= width:
+        return np.arange(size)
+    return np.linspace(0, size, width, endpoint=False).astype(np.int64)
+
+
+def downsample_ohlc(o, h, l, c, starts):
+    '''OHLC of each bucket starting at ``starts``'''
+    ends = np.append(starts[1:], len(o)) - 1
+    return (o[starts], np.fmax.reduceat(h, starts),
+            np.fmin.reduceat(l, starts), c[ends])
+
+
+def downsample_line(y, starts):
+    '''
+    Min/max of each bucket as ``(x, y)`` with two points per bucket, placed
+    in the order in which min and max happened
+    '''
+    if len(starts) == len(y):
+        return np.arange(len(y), dtype=np.float64), y
+
+    # NaN (warm-up periods) must not win the reductions
+    valid = ~np.isnan(y)
+    lo = np.where(valid, y, np.inf)
+    hi = np.where(valid, y, -np.inf)
+    ymin = np.minimum.reduceat(lo, starts)
+    ymax = np.maximum.reduceat(hi, starts)
+
+    # position of min and max inside each bucket
+    idx = np.arange(len(y))
+    bucket = np.repeat(np.arange(len(starts)), np.diff(np.append(starts,
+                                                                 len(y))))
+    atmin = np.minimum.reduceat(np.where(lo == ymin[bucket], idx, len(y)),
+                                starts)
+    atmax = np.minimum.reduceat(np.where(hi == ymax[bucket], idx, len(y)),
+                                starts)
+
+    first = np.minimum(atmin, atmax)
+    second = np.maximum(atmin, atmax)
+    fval = np.where(atmin <= atmax, ymin, ymax)
+    sval = np.where(atmin <= atmax, ymax, ymin)
+
+    x = np.empty(2 * len(starts))
+    yy = np.empty(2 * len(starts))
+    x[0::2], x[1::2] = first, second
+    yy[0::2], yy[1::2] = fval, sval
+    yy[np.isinf(yy)] = np.nan
+    return x * len(starts) / len(y), yy
+
+
+def render(chart, path, width=1600, height=900, dpi=100):
+    '''
+    Writes ``chart`` (see ``capture``) to ``path``. The format is taken
+    from the extension: png, svg or html (an SVG embedded in a page)
+    '''
+    fmt = os.path.splitext(path)[1][1:].lower()
+    if fmt not in FORMATS:
+        raise ValueError('Unsupported chart format: %s' % fmt)
+
+    dts = chart['datetime']
+    size = len(dts)
+    starts = buckets(size, width)
+    scale = len(starts) / size if size else 1.0
+
+    npanels = 1 + len(chart['panels'])
+    fig, axes = plt.subplots(
+        npanels, 1, sharex=True, squeeze=False,
+        figsize=(width / dpi, height / dpi), dpi=dpi,
+        gridspec_kw=dict(height_ratios=[3] + [1] * (npanels - 1)))
+    axes = axes[:, 0]
+
+    # Candles: high-low wick plus open-close body, one per bucket
+    ax = axes[0]
+    o, h, l, c = downsample_ohlc(*(chart['ohlc'] + [starts]))
+    x = np.arange(len(starts))
+    up = c >= o
+    ax.vlines(x, l, h, color='0.4', linewidth=0.5)
+    for mask, color in ((up, 'tab:green'), (~up, 'tab:red')):
+        ax.vlines(x[mask], np.minimum(o, c)[mask], np.maximum(o, c)[mask],
+                  color=color, linewidth=max(0.5, 0.7 * width / len(x)))
+
+    for label, y in chart['overlays']:
+        ax.plot(*downsample_line(y, starts), linewidth=0.8, label=label)
+
+    for label, y in chart['markers']:
+        idx = np.flatnonzero(~np.isnan(y))
+        ax.plot(idx * scale, y[idx], linestyle='', label=label,
+                marker='^' if label == 'buy' else 'v',
+                color='tab:green' if label == 'buy' else 'tab:red')
+
+    ax.set_title(chart['title'])
+    ax.legend(loc='upper left', fontsize='small')
+
+    for ax, (name, lines) in zip(axes[1:], chart['panels']):
+        for label, y in lines:
+            idx = np.flatnonzero(~np.isnan(y))
+            if len(idx) < len(y) // 2:  # sparse events (i.e. trade pnl)
+                ax.plot(idx * scale, y[idx], linestyle='', marker='o',
+                        label=label)
+            else:
+                ax.plot(*downsample_line(y, starts), linewidth=0.8,
+                        label=label)
+        ax.legend(loc='upper left', fontsize='small')
+
+    # Bars are drawn by position (no weekend gaps): label ticks with dates
+    ticks = np.linspace(0, len(starts) - 1, 8).astype(np.int64)
+    axes[-1].set_xticks(ticks)
+    axes[-1].set_xticklabels([bt.num2date(dts[starts[t]]).date().isoformat()
+                              for t in ticks], fontsize='small')
+
+    fig.tight_layout()
+    if fmt == 'html':
+        svg = io.StringIO()
+        fig.savefig(svg, format='svg')
+        with open(path, 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                    '<title>%s</title></head><body>\n%s\n</body></html>\n' %
+                    (html.escape(chart['title']), svg.getvalue()))
+    else:
+        fig.savefig(path, format=fmt)
+
+    plt.close(fig)
+    return path
@@ -0,0 +1,267 @@
+'''
+Dead indicator elimination: skip the indicators no one reads
+
+Exploratory strategies keep creating indicators in ``__init__`` which only
+serve the charts (or nothing at all, after the logic in ``next`` changed).
+All of them are calculated on every run. Inside ``pruning`` the indicators
+of each strategy are traced before the run starts and the top level ones
+which can not be reached are removed from it, so they are never
+calculated::
+
+    with deadind.pruning():
+        cerebro.run()
+
+An indicator (or line operation) is reachable if it is, or feeds (as an
+input, a clock or through a line binding), one of:
+
+  - an attribute of the strategy read by its methods other than
+    ``__init__`` (``next``, ``notify_order``, ``stop``, ...: read from their
+    source), also from functions/lambdas defined in ``__init__``
+  - an attribute of the strategy read by the analyzers (``self.strategy.x``)
+  - referenced by an observer or analyzer
+  - a signal (``SignalStrategy``/``cerebro.add_signal``)
+  - plotted, with ``pruning(plot=True)``: for runs which will be charted
+
+If the source of a method can not be read or it accesses the attributes
+dynamically (``getattr(self, name)``, ``self.__dict__``,
+``self.getindicators()``...) nothing is removed from that strategy.
+
+The minimum periods of the strategy are those it had with all the
+indicators, so ``next`` is called on the same bars and the results do not
+change. The removed indicators hold no values: do not plot a pruned run
+unless ``plot=True``.
+
+Each process of an optimization inherits the pruning if the pool is forked
+(the default on Linux), as ``pruning`` patches ``bt.Strategy._start`` while
+it is active.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import ast
+import contextlib
+import inspect
+import textwrap
+
+# Import the backtrader platform
+import backtrader as bt
+
+
+# Reads of ``self`` which may reach any attribute
+_DYNAMIC = ('__dict__', 'getindicators', 'getindicators_lines',
+            '_lineiterators')
+
+
+class _Unknown(Exception):
+    '''The attributes read by some code can not be determined'''
+
+
+def _methods(cls):
+    '''The functions defined by ``cls`` and its bases out of backtrader'''
+    for klass in cls.__mro__:
+        if klass is object or klass.__module__.startswith('backtrader'):
+            continue
+        for name, func in vars(klass).items():
+            if inspect.isfunction(func):
+                yield name, func
+
+
+def _tree(func):
+    try:
+        return ast.parse(textwrap.dedent(inspect.getsource(func)))
+    except (IOError, OSError, TypeError, SyntaxError):
+        raise _Unknown(func)
+
+
+def attrsread(cls, prefix=('self',)):
+    '''
+    Names of the attributes read from ``self`` (with ``prefix`` such as
+    ``('self', 'strategy')``: from ``self.strategy``) in the methods of
+    ``cls``. Raises ``_Unknown`` if it can not be determined
+    '''
+    names = set()
+    for name, func in _methods(cls):
+        tree = _tree(func)
+        if name == '__init__':
+            # Only what may run later: nested functions and lambdas
+            nodes = [n for top in ast.walk(tree.body[0])
+                     if top is not tree.body[0] and
+                     isinstance(top, (ast.FunctionDef, ast.Lambda))
+                     for n in ast.walk(top)]
+        else:
+            nodes = list(ast.walk(tree))
+
+        for node in nodes:
+            if isinstance(node, ast.Call) and \
+               isinstance(node.func, ast.Name) and \
+               node.func.id in ('getattr', 'vars') and node.args and \
+               _chain(node.args[0]) == prefix:
+                raise _Unknown(func)
+
+            if isinstance(node, ast.Attribute) and \
+               _chain(node.value) == prefix:
+                if node.attr in _DYNAMIC:
+                    raise _Unknown(func)
+                names.add(node.attr)
+
+    return names
+
+
+def _chain(node):
+    '''('self', 'strategy') for the expression ``self.strategy``'''
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return tuple(reversed(parts))
+
+
+def _lineroots(value):
+    '''The line objects in ``value``: a line object or a container of them'''
+    if isinstance(value, bt.LineRoot):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple, set)):
+        return [x for v in value for x in _lineroots(v)]
+    return []
+
+
+def _nested(obj):
+    '''``obj`` and the indicators/operations it calculates, recursively'''
+    yield obj
+    subs = getattr(obj, '_lineiterators', {}).get(bt.LineIterator.IndType, ())
+    for sub in subs:
+        for x in _nested(sub):
+            yield x
+
+
+def _inputs(obj):
+    '''The line objects ``obj`` reads from'''
+    inputs = list(getattr(obj, 'datas', ())) + list(getattr(obj, '_datas', ()))
+    clock = getattr(obj, '_clock', None)
+    if clock is not None:
+        inputs.append(clock)
+    return inputs
+
+
+def _lines(obj):
+    '''The line buffers of a line object (itself for a line)'''
+    if isinstance(obj, bt.LineSeries):
+        return list(obj.lines)
+    return [obj]
+
+
+def reachable(strategy, plot=False):
+    '''
+    The top level indicators of ``strategy`` which are reachable (see
+    above). Returns all of them if it can not be determined
+    '''
+    tops = list(strategy._lineiterators[bt.LineIterator.IndType])
+
+    # Everything calculated by a top level indicator leads to it
+    topof = dict()
+    for top in tops:
+        for obj in _nested(top):
+            topof[id(obj)] = top
+            for line in _lines(obj):
+                topof.setdefault(id(line), top)
+
+    def tops_of(objs):
+        found = []
+        for obj in objs:
+            for line in [obj] + _lines(obj):
+                top = topof.get(id(line))
+                if top is not None:
+                    found.append(top)
+        return found
+
+    # What each top level indicator needs from the others
+    needs = dict((id(top), set()) for top in tops)
+    for top in tops:
+        for obj in _nested(top):
+            needs[id(top)].update(id(x) for x in tops_of(_inputs(obj)))
+            for line in _lines(obj):
+                # A line binding fills the target with the values of obj
+                for target in tops_of(getattr(line, 'bindings', ())):
+                    needs[id(target)].add(id(top))
+
+    try:
+        attrs = attrsread(type(strategy))
+        for analyzer in strategy.analyzers:
+            attrs |= attrsread(type(analyzer), prefix=('self', 'strategy'))
+    except _Unknown:
+        return tops
+
+    roots = []
+    for name in attrs:
+        roots.extend(_lineroots(strategy.__dict__.get(name)))
+
+    for signals in getattr(strategy, '_signals', {}).values():
+        roots.extend(signals)
+
+    for other in list(strategy.observers) + list(strategy.analyzers):
+        roots.extend(_lineroots(list(vars(other).values())))
+        for obj in _nested(other):
+            roots.extend(_inputs(obj))
+
+    if plot:
+        for top in tops:
+            plotinfo = getattr(top, 'plotinfo', None)  # operations have none
+            if plotinfo is not None and plotinfo.plot and \
+               not plotinfo.plotskip:
+                roots.append(top)
+
+    live = dict((id(top), top) for top in tops_of(roots))
+    pending = list(live)
+    while pending:
+        for dep in needs[pending.pop()]:
+            if dep not in live:
+                live[dep] = topof[dep]
+                pending.append(dep)
+
+    return [top for top in tops if id(top) in live]
+
+
+def prune(strategy, plot=False):
+    '''
+    Removes the unreachable top level indicators from ``strategy``. Returns
+    the removed ones
+    '''
+    tops = strategy._lineiterators[bt.LineIterator.IndType]
+    live = set(id(x) for x in reachable(strategy, plot=plot))
+    removed = [x for x in tops if id(x) not in live]
+    tops[:] = [x for x in tops if id(x) in live]
+    return removed
+
+
+@contextlib.contextmanager
+def pruning(plot=False, callback=None):
+    '''
+    Context in which the strategies which start running are pruned.
+    ``callback(strategy, removed)`` is called for each of them
+    '''
+    start = bt.Strategy._start
+
+    def _start(self):
+        # The minimum periods with all the indicators are kept
+        self._periodset()
+        minperiod, minperiods = self._minperiod, list(self._minperiods)
+
+        removed = prune(self, plot=plot)
+        if callback is not None:
+            callback(self, removed)
+
+        start(self)
+        self._minperiod = max(self._minperiod, minperiod)
+        self._minperiods = [max(a, b)
+                            for a, b in zip(self._minperiods, minperiods)]
+
+    bt.Strategy._start = _start
+    try:
+        yield
+    finally:
+        bt.Strategy._start = start
@@ -0,0 +1,445 @@
+'''
+Vectorized CSV feed for the Yahoo and Alpha Vantage schemas
+
+``bt.feeds.YahooFinanceCSVData`` and ``bt.feeds.GenericCSVData`` parse the
+files line by line in Python: splitting, ``strptime``/``date`` and
+``float`` for every field of every row. ``read`` parses the whole file at
+once with the C parser of NumPy (``np.loadtxt`` into a structured array,
+the ISO dates straight into ``datetime64``), applies ``fromdate`` and
+``todate`` to the parsed columns and returns them ready for
+``memfeed.MemoryData``.
+
+The columns are found by the names in the header, not by position, so
+``Date,Open,High,Low,Close,Adj Close,Volume`` (Yahoo) and ``date,5.
+volume,4. close,2. high,1. open,3. low`` (Alpha Vantage, as written by
+alpha_vantage_update.py) are read alike. The numbered prefixes, case,
+spaces and underscores are ignored (``adjusted_close`` is ``adjclose``,
+``timestamp`` is ``datetime``). The schema is:
+
+  - ``yahoo``: exactly the Yahoo columns. The rules of
+    ``YahooFinanceCSVData`` are applied: rows with ``null`` are skipped,
+    prices are adjusted with ``Adj Close`` and rounded, the bars are
+    stamped at the end of the session
+  - ``generic`` (anything else): the values as they are, as
+    ``GenericCSVData`` does. Empty fields and missing columns get
+    ``nullvalue``. Integer keyword args (``close=2``, ``openinterest=-1``)
+    still override the column found for a line
+
+The values are the same as those of the backtrader feeds (see the check
+below). Drop-in use::
+
+    import fastcsv
+
+    data = fastcsv.YahooFinanceCSVData(
+        dataname=datapath,
+        fromdate=datetime.datetime(2018, 1, 1),
+        todate=datetime.datetime(2018, 9, 13),
+        reverse=False)
+
+Check that the columns equal those of the backtrader feeds for the files
+of the repository and a synthetic file, and time both::
+
+    python fastcsv.py --rows 1000000
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import io
+import math
+import os
+import os.path
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import memfeed
+
+
+# Normalized header name -> line (or the separate ``time`` column)
+ALIASES = dict(
+    date='datetime', datetime='datetime', timestamp='datetime', time='time',
+    open='open', high='high', low='low', close='close',
+    adjclose='adjclose', adjustedclose='adjclose',
+    volume='volume', openinterest='openinterest', oi='openinterest',
+)
+
+YAHOO = ('datetime', 'open', 'high', 'low', 'close', 'adjclose', 'volume')
+
+# Parsing rules of the backtrader feeds (Yahoo ones apply to ``yahoo``)
+DEFAULTS = dict(
+    headers=True, separator=',', sessionstart=None, sessionend=None,
+    timeframe=bt.TimeFrame.Days, dtformat=None, tmformat='%H:%M:%S',
+    nullvalue=float('nan'), reverse=False, adjclose=True, adjvolume=True,
+    round=True, decimals=2, roundvolume=0, swapcloses=False,
+)
+
+# Feed parameters handed to the in-memory feed
+PASSTHRU = ('name', 'timeframe', 'compression', 'sessionstart', 'sessionend')
+
+EPOCH = datetime.date(1970, 1, 1).toordinal()  # date number of 1970-01-01
+
+
+def fieldname(name):
+    '''The line for the header ``name`` (``5. adjusted close``) or None'''
+    name = re.sub(r'^\s*\d+\.\s*', '', name.strip().strip('"'))
+    return ALIASES.get(re.sub(r'[\s_]', '', name.lower()))
+
+
+def detect(names):
+    '''
+    The schema (``yahoo`` or ``generic``) and the line -> column index of
+    the header ``names``. ``ValueError`` without date or close
+    '''
+    fields = dict()
+    for i, name in enumerate(names):
+        field = fieldname(name)
+        if field is not None:
+            fields.setdefault(field, i)
+
+    missing = [f for f in ('datetime', 'close') if f not in fields]
+    if missing:
+        raise ValueError('No %s column in the header: %s' % (
+            ' and '.join(missing), ','.join(names)))
+
+    yahoo = tuple(fieldname(name) for name in names) == YAHOO
+    return ('yahoo' if yahoo else 'generic'), fields
+
+
+def _timefraction(micros):
+    '''The fraction of a day of ``micros``, as ``bt.date2num`` sums it'''
+    secs, us = divmod(int(micros), 1000000)
+    mins, secs = divmod(secs, 60)
+    hours, mins = divmod(mins, 60)
+    return math.fsum((hours / 24.0, mins / 1440.0, secs / 86400.0,
+                      us / 86400e6))
+
+
+def _datenums(stamps, sessionend, eos):
+    '''
+    Date numbers of the ``datetime64[us]`` ``stamps``. ``eos``: at the end
+    of the session (``sessionend``) if later than the stamp
+    '''
+    days = stamps.astype('M8[D]')
+    base = (days.astype(np.int64) + EPOCH).astype(np.float64)
+    micros = (stamps - days).astype(np.int64)
+
+    # Few distinct times of the day: each summed once, exactly as date2num
+    uniq, inverse = np.unique(micros, return_inverse=True)
+    fracs = np.array([_timefraction(m) for m in uniq], dtype=np.float64)
+    dtnums = base + fracs[inverse.reshape(-1)]
+
+    if eos:
+        endus = ((sessionend.hour * 60 + sessionend.minute) * 60 +
+                 sessionend.second) * 1000000 + sessionend.microsecond
+        dtnums = np.maximum(dtnums, base + _timefraction(endus))
+
+    return dtnums
+
+
+def _strptime(texts, fmt):
+    '''
+    ``datetime64[us]`` of ``texts`` parsed by ``fmt`` (a format or a
+    callable)
+    '''
+    uniq, inverse = np.unique(texts, return_inverse=True)
+    if callable(fmt):
+        parsed = [fmt(t) for t in uniq]
+    else:
+        parsed = [datetime.datetime.strptime(t, fmt) for t in uniq]
+
+    return np.array(parsed, dtype='M8[us]')[inverse.reshape(-1)]
+
+
+def _round(values, decimals):
+    '''
+    The builtin ``round`` of each value. ``np.round`` scales by ``10 **
+    decimals`` and rounds, which differs when the scaled value is close to
+    a half: those go through ``round``
+    '''
+    result = np.round(values, decimals)
+    scaled = values * 10.0 ** decimals
+    near = (np.abs(scaled - np.floor(scaled) - 0.5) <=
+            1e-9 + 1e-12 * np.abs(scaled))
+    for i in np.flatnonzero(near):
+        result[i] = round(float(values[i]), decimals)
+
+    return result
+
+
+def datelimit(dt, clock):
+    '''
+    The date number of ``fromdate``/``todate`` as the feeds take them: a
+    date (no time) is taken at ``clock`` (the start or end of the session)
+    '''
+    if not hasattr(dt, 'hour'):  # a date: the start/end of its session
+        dt = datetime.datetime.combine(dt, clock)
+    return bt.date2num(dt)
+
+
+def _readbytes(dataname):
+    if hasattr(dataname, 'read'):
+        raw = dataname.read()
+        return raw.encode('utf-8') if not isinstance(raw, bytes) else raw
+
+    with open(dataname, 'rb') as f:
+        return f.read()
+
+
+def _clean(body, sep, nullvalue):
+    '''
+    ``body`` without the rows with "null" (the Yahoo feed skips them) and
+    with ``nullvalue`` in the empty fields
+    '''
+    if b'null' in body:
+        body = b'\n'.join(row for row in body.split(b'\n')
+                          if b'null' not in row)
+
+    nulltext = repr(float(nullvalue)).encode('ascii')
+    while sep + sep in body:  # replace skips every other of a run
+        body = body.replace(sep + sep, sep + nulltext + sep)
+    body = body.replace(sep + b'\n', sep + nulltext + b'\n')
+    if body.endswith(sep):
+        body += nulltext
+
+    return body
+
+
+def read(dataname, schema=None, fromdate=None, todate=None, **kwargs):
+    '''
+    Parses the CSV file (or file-like) ``dataname`` and returns its
+    ``memfeed.COLUMNS`` as NumPy arrays restricted to ``fromdate`` <= date
+    <= ``todate``. ``schema``: ``yahoo``, ``generic`` or None to detect it
+    from the header. ``kwargs``: ``DEFAULTS`` and the column index of lines
+    '''
+    lines = set(memfeed.COLUMNS + ('time',))  # adjclose: the Yahoo param
+    opts = dict(DEFAULTS)
+    overrides = dict()
+    for name, value in kwargs.items():
+        if name in lines:
+            overrides[name] = value
+        elif name in DEFAULTS:
+            opts[name] = value
+        else:
+            raise TypeError('Unexpected argument: %s' % name)
+
+    sep = opts['separator'].encode('utf-8')
+    raw = _readbytes(dataname)
+    if b'\r' in raw:
+        raw = raw.replace(b'\r', b'')
+    if opts['headers']:
+        head, _, body = raw.partition(b'\n')
+        detected, fields = detect(
+            head.decode('utf-8').split(opts['separator']))
+    else:
+        body = raw
+        detected, fields = 'yahoo', dict((f, i) for i, f in enumerate(YAHOO))
+
+    schema = schema or detected
+    for name, idx in overrides.items():
+        if idx is None or idx < 0:
+            fields.pop(name, None)
+        else:
+            fields[name] = idx
+
+    # Dates in ISO format go straight into datetime64, others as text
+    dtformat = opts['dtformat']
+    isodates = dtformat is None or (
+        not callable(dtformat) and dtformat.startswith('%Y-%m-%d'))
+    dtypes = dict(datetime='M8[us]' if isodates else 'U64', time='U32')
+    used = sorted(fields.items(), key=lambda item: item[1])
+    dtype = [(name, dtypes.get(name, 'f8')) for name, _ in used]
+
+    loadkw = dict(delimiter=opts['separator'], dtype=dtype, ndmin=1,
+                  usecols=[i for _, i in used], encoding='utf-8')
+    if not body or body.isspace():
+        table = np.zeros(0, dtype=dtype)
+    else:
+        try:
+            table = np.loadtxt(io.BytesIO(body), **loadkw)
+        except ValueError:  # "null" or empty fields: cleaned and retried
+            body = _clean(body, sep, opts['nullvalue'])
+            table = np.loadtxt(io.BytesIO(body), **loadkw)
+
+    if opts['reverse']:
+        table = table[::-1]
+
+    stamps = table['datetime']
+    if not isodates:
+        stamps = _strptime(stamps, dtformat)
+    if 'time' in fields and schema != 'yahoo':
+        stamps = stamps.astype('M8[D]') + (
+            _strptime(table['time'], opts['tmformat']) -
+            np.datetime64('1900-01-01'))
+
+    sessionend = opts['sessionend'] or datetime.time(23, 59, 59, 999990)
+    if schema == 'yahoo':  # the date at the end of the session
+        dtnums = _datenums(stamps.astype('M8[D]'), sessionend, eos=True)
+    else:
+        dtnums = _datenums(stamps, sessionend,
+                           eos=opts['timeframe'] >= bt.TimeFrame.Days)
+
+    # Only the rows in the dates are turned into lines
+    keep = np.ones(len(dtnums), dtype=bool)
+    if fromdate is not None:
+        keep &= dtnums >= datelimit(
+            fromdate, opts['sessionstart'] or datetime.time.min)
+    if todate is not None:
+        keep &= dtnums <= datelimit(todate, sessionend)
+    if not keep.all():
+        table, dtnums = table[keep], dtnums[keep]
+
+    nan = np.full(len(table), opts['nullvalue'], dtype=np.float64)
+    cols = dict((name, np.array(table[name], dtype=np.float64)
+                 if name in fields else nan.copy())
+                for name in memfeed.COLUMNS if name != 'datetime')
+    cols['datetime'] = dtnums
+
+    if schema == 'yahoo':
+        _yahoo(cols, table['adjclose'] if 'adjclose' in fields else
+               cols['close'].copy(), opts)
+
+    return cols
+
+
+def _yahoo(cols, adjustedclose, opts):
+    '''The adjustments and rounding of ``YahooFinanceCSVData``, in place'''
+    cols['openinterest'][:] = 0.0
+    c = cols['close']
+    if opts['swapcloses']:
+        c, adjustedclose = adjustedclose, c
+
+    if opts['adjclose']:
+        adjfactor = c / adjustedclose
+        for name in ('open', 'high', 'low'):
+            cols[name] = cols[name] / adjfactor
+        c = adjustedclose
+        if opts['adjvolume']:
+            cols['volume'] = cols['volume'] * adjfactor
+
+    cols['close'] = np.array(c, dtype=np.float64)
+    if opts['round']:
+        for name in ('open', 'high', 'low', 'close'):
+            cols[name] = _round(cols[name], opts['decimals'])
+
+    cols['volume'] = _round(cols['volume'], int(opts['roundvolume']))
+
+
+def CSVData(dataname, schema=None, **kwargs):
+    '''
+    A ``memfeed.MemoryData`` feed with the columns ``read`` from
+    ``dataname``
+    '''
+    feedkw = dict((k, v) for k, v in kwargs.items() if k in PASSTHRU)
+    if not hasattr(dataname, 'read'):
+        feedkw.setdefault('name', os.path.basename(dataname))
+
+    # The dates are filtered by read: the feed gets no fromdate/todate
+    readkw = dict((k, v) for k, v in kwargs.items()
+                  if k not in ('name', 'compression'))
+    cols = read(dataname, schema=schema, **readkw)
+    return memfeed.MemoryData(dataname=cols, **feedkw)
+
+
+def YahooFinanceCSVData(dataname, **kwargs):
+    '''Vectorized drop-in for ``bt.feeds.YahooFinanceCSVData``'''
+    return CSVData(dataname, schema='yahoo', **kwargs)
+
+
+def GenericCSVData(dataname, **kwargs):
+    '''Vectorized drop-in for ``bt.feeds.GenericCSVData``'''
+    return CSVData(dataname, schema='generic', **kwargs)
+
+
+# Check
+def same(a, b):
+    '''Whether the columns ``a`` and ``b`` are equal (NaN equal to NaN)'''
+    return all(np.array_equal(np.asarray(a[name], dtype=np.float64),
+                              np.asarray(b[name], dtype=np.float64),
+                              equal_nan=True)
+               for name in memfeed.COLUMNS)
+
+
+def compare(path, feedcls, schema, **kwargs):
+    '''Rows, same columns, secs of the backtrader feed and of ``read``'''
+    t0 = time.perf_counter()
+    stock = memfeed.snapshot(feedcls(dataname=path, **kwargs))
+    t1 = time.perf_counter()
+    fast = read(path, schema=schema, **kwargs)
+    t2 = time.perf_counter()
+    return len(fast['datetime']), same(stock, fast), t1 - t0, t2 - t1
+
+
+def runcheck(args=None):
+    args = parse_args(args)
+
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    yahoo = dict(reverse=False)
+    checks = [(os.path.join(modpath, '../data', name),
+               bt.feeds.YahooFinanceCSVData, 'yahoo', yahoo)
+              for name in sorted(os.listdir(os.path.join(modpath, '../data')))
+              if name.endswith('.csv')]
+
+    checks.append((
+        os.path.join(modpath, '../data/PETR4.SA.csv'),
+        bt.feeds.YahooFinanceCSVData, 'yahoo',
+        dict(reverse=False, fromdate=datetime.datetime(2018, 1, 1),
+             todate=datetime.datetime(2018, 9, 13))))
+
+    # As bollinger_bands_with_alphavantage.py (by column index)
+    checks.append((
+        os.path.join(modpath, 'test_alpha.csv'), bt.feeds.GenericCSVData,
+        'generic', dict(datetime=0, time=-1, volume=1, close=2, high=3,
+                        open=4, low=5, openinterest=-1, dtformat='%Y-%m-%d',
+                        fromdate=datetime.datetime(2008, 5, 4),
+                        todate=datetime.datetime(2018, 9, 21))))
+
+    tmpdir = tempfile.mkdtemp(prefix='fastcsv-')
+    try:
+        if args.rows:
+            import synthdata
+            path = os.path.join(tmpdir, 'synthetic.csv')
+            synthdata.write(path, args.rows, fmt='yahoo', seed=args.seed)
+            checks.append((path, bt.feeds.YahooFinanceCSVData, 'yahoo', yahoo))
+
+            path = os.path.join(tmpdir, 'synthetic-alpha.csv')
+            synthdata.write(path, args.rows, fmt='alphavantage',
+                            seed=args.seed)
+            checks.append((path, bt.feeds.GenericCSVData, 'generic', dict(
+                datetime=0, time=-1, volume=1, close=2, high=3, open=4,
+                low=5, openinterest=-1, dtformat='%Y-%m-%d')))
+
+        print('%-24s %9s %6s %10s %10s %8s' % (
+            'File', 'Rows', 'Same', 'Feed secs', 'Fast secs', 'Speedup'))
+        for path, feedcls, schema, kwargs in checks:
+            rows, ok, slow, fast = compare(path, feedcls, schema, **kwargs)
+            print('%-24s %9d %6s %10.3f %10.3f %7.1fx' % (
+                os.path.basename(path), rows, ok, slow, fast, slow / fast))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Compares the vectorized CSV reader with the feeds')
+
+    parser.add_argument('--rows', required=False, default=200000, type=int,
+                        help='Rows of a synthetic Yahoo file (0: none)')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the synthetic data')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runcheck()
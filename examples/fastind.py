@@ -0,0 +1,550 @@
+'''
+Streaming versions of SMA, BBands, RSI_SMA, ATR and StochasticSlow
+
+The stock indicators recompute their window on every bar (``math.fsum`` of
+``period`` values for a moving average, a scan of ``period`` values for
+``Highest``/``Lowest``) and are built from trees of smaller indicators
+(``BBands`` is 9 of them), each one with its own lines and its own pass
+over the data. The ones here keep running state instead, so the cost of a
+bar does not depend on ``period``:
+
+  - running sums for the simple moving averages (SMA, RSI_SMA, %K/%D)
+  - Welford's mean/variance for the Bollinger Bands
+  - monotonic deques for the highest high/lowest low of the Stochastic
+  - Wilder's smoothing of the true range in a single indicator for the ATR
+
+They subclass the stock indicators and keep their lines, params, minimum
+periods and plotting, which makes them drop-in replacements::
+
+    import fastind
+    self.bband = fastind.BBands(self.data, period=200)
+
+Running sums accumulate rounding errors: they are recomputed exactly with
+``math.fsum`` every ``period`` values (amortized O(1)) and an all-zero window
+sums to exactly 0.0 (as in the stock indicators, which matters for the
+``safediv`` checks of the RSI). The values stay within 1e-9 of the stock
+ones, which is checked (with and without ``runonce``, on the sample data and
+on synthetic daily and intraday data) and timed with::
+
+    python fastind.py --periods 5,20,200 --timing
+
+Notes:
+
+  - ``movav`` can not be changed (``ValueError``): the moving average is the
+    one of the stock indicator being replaced
+  - with ``replaydata`` a bar is delivered several times while it forms: the
+    state is then rebuilt from the window, O(period) per update
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import collections
+import math
+import os.path
+import sys
+import time
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import memfeed
+import synthdata
+
+
+_INF = float('inf')
+_NAN = float('nan')
+
+
+class RollingSum(object):
+    '''
+    Sum of the last ``period`` values pushed, updated in O(1). It is
+    recomputed with ``math.fsum`` every ``period`` values and when a non
+    finite value leaves the window, and is 0.0 while the window holds only
+    zeros
+    '''
+    def __init__(self, period):
+        self.period = period
+        self.window = collections.deque()
+        self.sum = 0.0
+        self.nonzero = 0  # values != 0.0 in the window
+        self.pending = period  # values until the next exact recalculation
+
+    def push(self, value):
+        window = self.window
+        window.append(value)
+        self.nonzero += value != 0.0
+        if len(window) > self.period:
+            old = window.popleft()
+            self.nonzero -= old != 0.0
+            if not -_INF < old < _INF:
+                self.pending = 0
+        else:
+            old = 0.0
+
+        self.pending -= 1
+        if not self.nonzero:
+            self.sum = 0.0
+        elif self.pending <= 0:
+            self.sum = math.fsum(window)
+            self.pending = self.period
+        else:
+            self.sum += value - old
+
+        return self.sum
+
+
+class RollingMoments(object):
+    '''
+    Mean and (population) variance of the last ``period`` values pushed,
+    updated in O(1) with Welford's algorithm for a sliding window. Both are
+    recomputed exactly (two passes) every ``period`` values
+    '''
+    def __init__(self, period):
+        self.period = period
+        self.window = collections.deque()
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared deviations from the mean
+        self.pending = period
+
+    def push(self, value):
+        window = self.window
+        window.append(value)
+        n = len(window)
+        mean = self.mean
+        if n > self.period:
+            old = window.popleft()
+            delta = value - old
+            self.mean += delta / self.period
+            self.m2 += delta * (value - self.mean + old - mean)
+            if not -_INF < old < _INF:
+                self.pending = 0
+        else:
+            delta = value - mean
+            self.mean += delta / n
+            self.m2 += delta * (value - self.mean)
+
+        self.pending -= 1
+        if self.pending <= 0:
+            self.mean = mean = math.fsum(window) / len(window)
+            self.m2 = math.fsum((x - mean) ** 2 for x in window)
+            self.pending = self.period
+
+        return self.mean, max(self.m2, 0.0) / len(window)
+
+
+class RollingExtreme(object):
+    '''
+    Highest (or lowest with ``highest=False``) of the last ``period`` values
+    pushed. A monotonic deque holds the candidates: each value enters and
+    leaves it once, amortized O(1) per value
+    '''
+    def __init__(self, period, highest=True):
+        self.period = period
+        self.highest = highest
+        self.queue = collections.deque()  # (index, value), values monotonic
+        self.count = 0
+
+    def push(self, value):
+        queue = self.queue
+        if self.highest:
+            while queue and queue[-1][1] <= value:
+                queue.pop()
+        else:
+            while queue and queue[-1][1] >= value:
+                queue.pop()
+
+        queue.append((self.count, value))
+        if queue[0][0] <= self.count - self.period:
+            queue.popleft()
+
+        self.count += 1
+        return queue[0][1]
+
+
+class _Streaming(bt.Indicator):
+    '''
+    Base class of the streaming indicators. Subclasses return from
+    ``kernel`` a function which takes the values of ``inputs`` for a bar and
+    returns the values of the lines for that bar. It is fed the bars from the
+    first one with values in the inputs: the values returned before the
+    minimum period of each line are discarded
+    '''
+    def __init__(self):
+        if hasattr(self.p, 'movav') and self.p.notdefault('movav'):
+            raise ValueError('%s uses a fixed moving average, movav can not '
+                             'be changed' % self.__class__.__name__)
+
+    def inputs(self):
+        return (self.data,)
+
+    def kernel(self):
+        raise NotImplementedError
+
+    def _firstbar(self):
+        return max(x._minperiod for x in self.inputs())
+
+    def nextstart(self):
+        # Build the state from the bars of the minimum period
+        self._bar = len(self)
+        self._update = self.kernel()
+        size = self._minperiod - self._firstbar() + 1
+        cols = [x.get(size=size) for x in self.inputs()]
+        outs = [self._update(*vals) for vals in zip(*cols)]
+        for i, line in enumerate(self.lines):
+            # Lines with a shorter minimum period also get the earlier bars
+            for ago in range(self._minperiod - line._minperiod + 1):
+                line[-ago] = outs[-1 - ago][i]
+
+    def next(self):
+        if len(self) == self._bar:  # replaydata: the same bar, updated
+            return self.nextstart()
+
+        self._bar = len(self)
+        vals = self._update(*[x[0] for x in self.inputs()])
+        for line, val in zip(self.lines, vals):
+            line[0] = val
+
+    def oncestart(self, start, end):
+        # The state starts at the first bar: fill everything in one pass
+        update = self.kernel()
+        srcs = [x.array for x in self.inputs()]
+        dsts = [line.array for line in self.lines]
+        firsts = [line._minperiod - 1 for line in self.lines]
+        for i in range(self._firstbar() - 1, self.buflen()):
+            vals = update(*[src[i] for src in srcs])
+            for dst, first, val in zip(dsts, firsts, vals):
+                if i >= first:
+                    dst[i] = val
+
+    def once(self, start, end):
+        pass  # done in oncestart
+
+
+class SMA(_Streaming, bt.ind.SMA):
+    '''Simple moving average from a running sum'''
+    _notregister = True  # bt.ind.MovAv.SMA remains the stock one
+
+    def __init__(self):
+        super(SMA, self).__init__()
+        self.addminperiod(self.p.period)
+
+    def kernel(self):
+        period = self.p.period
+        push = RollingSum(period).push
+
+        def update(value):
+            return (push(value) / period,)
+
+        return update
+
+
+class BBands(_Streaming, bt.ind.BBands):
+    '''Bollinger Bands from a running mean and (Welford) variance'''
+    def __init__(self):
+        super(BBands, self).__init__()
+        self.addminperiod(self.p.period)
+
+    def kernel(self):
+        push = RollingMoments(self.p.period).push
+        devfactor = self.p.devfactor
+
+        def update(value):
+            mean, var = push(value)
+            dev = devfactor * math.sqrt(var)
+            return mean, mean + dev, mean - dev
+
+        return update
+
+
+class RSI_SMA(_Streaming, bt.ind.RSI_SMA):
+    '''RSI with simple moving averages of the up/down moves (running sums)'''
+    def __init__(self):
+        super(RSI_SMA, self).__init__()
+        self.addminperiod(self.p.period + self.p.lookback)
+
+    def kernel(self):
+        p = self.p
+        period = p.period
+        closes = collections.deque(maxlen=p.lookback + 1)
+        ups, downs = RollingSum(period), RollingSum(period)
+        highrs, lowrs = self._rscalc(p.safehigh), self._rscalc(p.safelow)
+
+        def update(close):
+            closes.append(close)
+            if len(closes) <= p.lookback:
+                return (_NAN,)
+
+            maup = ups.push(max(close - closes[0], 0.0)) / period
+            madown = downs.push(max(closes[0] - close, 0.0)) / period
+            if len(ups.window) < period:
+                return (_NAN,)
+
+            if p.safediv and madown == 0.0:
+                rs = lowrs if maup == 0.0 else highrs
+            else:
+                rs = maup / madown
+
+            return (100.0 - 100.0 / (1.0 + rs),)
+
+        return update
+
+
+class ATR(_Streaming, bt.ind.ATR):
+    '''
+    Average true range: Wilder's smoothing of the true range computed in
+    one indicator instead of four
+    '''
+    def __init__(self):
+        super(ATR, self).__init__()
+        self.addminperiod(self.p.period + 1)  # the true range needs close(-1)
+        self._alpha = alpha = 1.0 / self.p.period
+        self._alpha1 = 1.0 - alpha
+
+    def inputs(self):
+        return (self.data.high, self.data.low, self.data.close)
+
+    def kernel(self):
+        period, alpha, alpha1 = self.p.period, self._alpha, self._alpha1
+        trs = []  # the seed is the average of the first true ranges
+        state = [None, _NAN]  # previous close and atr
+
+        def update(high, low, close):
+            prevclose, state[0] = state[0], close
+            if prevclose is None:
+                return (_NAN,)
+
+            tr = max(high, prevclose) - min(low, prevclose)
+            if len(trs) < period:
+                trs.append(tr)
+                atr = math.fsum(trs) / period
+            else:
+                atr = state[1] * alpha1 + tr * alpha
+
+            state[1] = atr
+            return (atr,)
+
+        return update
+
+    def next(self):
+        if len(self) == self._minperiod:  # replaydata: the seed bar again
+            return self.nextstart()
+
+        # Only the previous value is needed, which also suits replaydata
+        data = self.data
+        prevclose = data.close[-1]
+        tr = max(data.high[0], prevclose) - min(data.low[0], prevclose)
+        self.lines.atr[0] = \
+            self.lines.atr[-1] * self._alpha1 + tr * self._alpha
+
+
+class StochasticSlow(_Streaming, bt.ind.StochasticSlow):
+    '''
+    Slow stochastic with the highest high/lowest low from monotonic deques
+    and running sums for %K and %D
+    '''
+    def __init__(self):
+        super(StochasticSlow, self).__init__()
+        p = self.p
+        self.lines.percK.addminperiod(p.period + p.period_dfast - 1)
+        self.lines.percD.addminperiod(
+            p.period + p.period_dfast + p.period_dslow - 2)
+
+    def inputs(self):
+        return (self.data.high, self.data.low, self.data.close)
+
+    def kernel(self):
+        p = self.p
+        highest = RollingExtreme(p.period)
+        lowest = RollingExtreme(p.period, highest=False)
+        ksum, dsum = RollingSum(p.period_dfast), RollingSum(p.period_dslow)
+
+        def update(high, low, close):
+            hh, ll = highest.push(high), lowest.push(low)
+            if highest.count < p.period:
+                return _NAN, _NAN
+
+            den = hh - ll
+            if p.safediv:
+                k = 100.0 * ((close - ll) / den if den else p.safezero)
+            else:
+                k = 100.0 * ((close - ll) / den)
+
+            percK = ksum.push(k) / p.period_dfast
+            if len(ksum.window) < p.period_dfast:
+                return _NAN, _NAN
+
+            return percK, dsum.push(percK) / p.period_dslow
+
+        return update
+
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data')
+
+
+def pairs(data, period):
+    '''(name, stock indicator, streaming indicator) to compare'''
+    rsi = bt.ind.RSI(data)  # an indicator as input has a minimum period
+    return [
+        ('SMA', bt.ind.SMA(data, period=period), SMA(data, period=period)),
+        ('SMA(RSI)', bt.ind.SMA(rsi, period=period), SMA(rsi, period=period)),
+        ('BBands', bt.ind.BBands(data, period=period),
+         BBands(data, period=period)),
+        ('RSI_SMA', bt.ind.RSI_SMA(data, period=period, safediv=True),
+         RSI_SMA(data, period=period, safediv=True)),
+        ('ATR', bt.ind.ATR(data, period=period), ATR(data, period=period)),
+        ('StochasticSlow', bt.ind.StochasticSlow(data, period=period),
+         StochasticSlow(data, period=period)),
+    ]
+
+
+class Compare(bt.Strategy):
+    '''Holds the ``pairs`` of indicators for each of the ``periods``'''
+    params = (('periods', (14,)),)
+
+    def __init__(self):
+        self.pairs = [(name, period, stock, fast)
+                      for period in self.p.periods
+                      for name, stock, fast in pairs(self.data, period)]
+
+
+class Only(bt.Strategy):
+    '''The stock (or the streaming with ``fast``) indicators, for timing'''
+    params = (('periods', (14,)), ('fast', False),)
+
+    def __init__(self):
+        mod = sys.modules[__name__] if self.p.fast else bt.ind
+        for period in self.p.periods:
+            mod.SMA(self.data, period=period)
+            mod.BBands(self.data, period=period)
+            mod.RSI_SMA(self.data, period=period, safediv=True)
+            mod.ATR(self.data, period=period)
+            mod.StochasticSlow(self.data, period=period)
+
+
+def maxdiff(stock, fast):
+    '''
+    Largest difference between the lines of two indicators, relative for
+    values above 1. ``inf`` if they do not have values on the same bars
+    '''
+    worst = 0.0
+    for a, b in zip(stock.lines, fast.lines):
+        a, b = np.frombuffer(a.array), np.frombuffer(b.array)
+        nan = np.isnan(a)
+        if len(a) != len(b) or not np.array_equal(nan, np.isnan(b)):
+            return _INF
+
+        a, b = a[~nan], b[~nan]
+        if len(a):
+            diff = np.abs(a - b) / np.maximum(1.0, np.abs(a))
+            worst = max(worst, float(diff.max()))
+
+    return worst
+
+
+def feeds(bars=100000, seed=0):
+    '''Makers of the data feeds of the checks, by name'''
+    daily = synthdata.columns(bars, seed=seed)
+    intraday = synthdata.columns(bars, seed=seed, freq='5min')
+    return collections.OrderedDict([
+        ('PETR4', lambda: bt.feeds.YahooFinanceCSVData(
+            dataname=os.path.join(DATADIR, 'PETR4.SA.csv'))),
+        ('daily', lambda: memfeed.MemoryData(dataname=daily)),
+        ('intraday', lambda: memfeed.MemoryData(dataname=intraday)),
+    ])
+
+
+def verify(makers, periods=(5, 20, 200), tol=1e-9, callback=None):
+    '''
+    Runs the ``Compare`` strategy on each feed of ``makers`` with and without
+    ``runonce``. Returns rows (feed, mode, name, period, diff) and whether
+    all the differences are within ``tol``. ``callback(row)`` sees each row
+    '''
+    rows, ok = [], True
+    for feedname, maker in makers.items():
+        for mode, runonce in (('once', True), ('next', False)):
+            cerebro = bt.Cerebro(stdstats=False, runonce=runonce)
+            cerebro.adddata(maker())
+            cerebro.addstrategy(Compare, periods=periods)
+            strat = cerebro.run()[0]
+            for name, period, stock, fast in strat.pairs:
+                row = (feedname, mode, name, period, maxdiff(stock, fast))
+                ok = ok and row[-1] <= tol
+                rows.append(row)
+                if callback is not None:
+                    callback(row)
+
+    return rows, ok
+
+
+def timing(maker, periods=(5, 20, 200)):
+    '''Bars per second of the stock and streaming indicators, by mode'''
+    result = collections.OrderedDict()
+    for mode, runonce in (('once', True), ('next', False)):
+        for fast in (False, True):
+            cerebro = bt.Cerebro(stdstats=False, runonce=runonce)
+            data = maker()
+            cerebro.adddata(data)
+            cerebro.addstrategy(Only, periods=periods, fast=fast)
+            t0 = time.time()
+            cerebro.run()
+            result[(mode, fast)] = len(data) / (time.time() - t0)
+
+    return result
+
+
+def runchecks(args=None):
+    args = parse_args(args)
+    periods = [int(x) for x in args.periods.split(',')]
+    makers = feeds(args.bars, args.seed)
+
+    def printrow(row):
+        print('%-10s %-5s %-15s %6d %10.3g' % row)
+        sys.stdout.flush()
+
+    print('%-10s %-5s %-15s %6s %10s' % ('Feed', 'Mode', 'Indicator',
+                                         'Period', 'Max diff'))
+    rows, ok = verify(makers, periods, args.tolerance, callback=printrow)
+    print('Verification: %s' % ('OK' if ok else 'MISMATCH'))
+
+    if args.timing:
+        for feedname, maker in makers.items():
+            result = timing(maker, periods)
+            for mode in ('once', 'next'):
+                stock, fast = result[(mode, False)], result[(mode, True)]
+                print('%-10s %-5s stock: %9.0f bars/s, streaming: %9.0f '
+                      'bars/s (x%.1f)' % (feedname, mode, stock, fast,
+                                          fast / stock))
+
+    if not ok:
+        sys.exit(1)
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Check the streaming indicators against the stock ones')
+
+    parser.add_argument('--periods', required=False, default='5,20,200',
+                        help='Comma separated periods to check')
+
+    parser.add_argument('--bars', required=False, default=100000, type=int,
+                        help='Bars of the synthetic feeds')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the synthetic feeds')
+
+    parser.add_argument('--tolerance', required=False, default=1e-9,
+                        type=float,
+                        help='Maximum difference (relative above 1)')
+
+    parser.add_argument('--timing', required=False, action='store_true',
+                        help='Also time the stock and streaming indicators')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runchecks()
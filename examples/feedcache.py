@@ -0,0 +1,213 @@
+'''
+Persistent binary cache for the CSV data feeds
+
+The first time a CSV file is loaded it is parsed (Yahoo files by fastcsv.py,
+with the values of the backtrader feed, others by the feed itself) and its
+lines are stored as a columnar NumPy file (one row per line:
+datetime, open, high, low, close, volume, openinterest). Later runs
+memory-map that file and hand the requested date range straight to a
+``memfeed.MemoryData`` feed, skipping the text parsing altogether.
+
+Cache entries are keyed by the absolute path, mtime and size of the CSV and
+by the parsing parameters of the feed, so touching the file or changing how
+it is parsed transparently rebuilds the entry.
+
+Usage (drop-in for the feed constructors used in the examples)::
+
+    import feedcache
+
+    data = feedcache.YahooFinanceCSVData(
+        dataname=datapath,
+        fromdate=datetime.datetime(2016, 1, 1),
+        todate=datetime.datetime(2018, 9, 6),
+        reverse=False)
+
+Scripts which work on the columns themselves (shared memory, vectorized
+backtests) take them from ``load``, with the arguments of ``fastcsv.read``::
+
+    columns = feedcache.load(datapath, fromdate=datetime.datetime(2018, 1, 1))
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import glob
+import hashlib
+import os.path
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import fastcsv
+import memfeed
+
+
+# Default cache location: a hidden directory next to each CSV file
+CACHEDIR = '.btcache'
+
+# Feed parameters which do not change how the file is parsed. They are
+# applied to the in-memory feed instead of being part of the cache key
+PASSTHRU = ('name', 'compression', 'fromdate', 'todate')
+
+# Parameters which are part of the key and also given to the in-memory feed
+# (``timeframe`` decides whether the bars are stamped at the session end)
+FEEDKW = PASSTHRU + ('timeframe',)
+
+
+def fileversion(path):
+    '''A short hash of the mtime and size of ``path``'''
+    st = os.stat(path)
+    key = repr((st.st_mtime_ns, st.st_size))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+
+
+def _cachepath(parser, dataname, cachedir, kwargs):
+    path = os.path.abspath(dataname)
+    version = fileversion(path)
+
+    parsekw = sorted((k, repr(v)) for k, v in kwargs.items()
+                     if k not in PASSTHRU)
+    key = repr((path, version, parser, parsekw))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    # The file version is in the name, to tell the stale entries apart
+    cachedir = cachedir or os.path.join(os.path.dirname(path), CACHEDIR)
+    return os.path.join(cachedir, '%s.%s.%s.npy' % (
+        os.path.basename(path), version, digest))
+
+
+def cachepath(feedcls, dataname, cachedir=None, **kwargs):
+    '''Returns the path of the cache entry for the given feed arguments'''
+    return _cachepath('%s.%s' % (feedcls.__module__, feedcls.__name__),
+                      dataname, cachedir, kwargs)
+
+
+def parse(feedcls, dataname, **kwargs):
+    '''
+    The ``memfeed.COLUMNS`` loaded by ``feedcls(dataname=dataname,
+    **kwargs)``. The Yahoo files are parsed by fastcsv.py (the same values,
+    parsed at once) unless a param it does not know is given
+    '''
+    if feedcls is bt.feeds.YahooFinanceCSVData and \
+       all(k in fastcsv.DEFAULTS for k in kwargs):
+        return fastcsv.read(dataname, schema='yahoo', **kwargs)
+
+    return memfeed.snapshot(feedcls(dataname=dataname, **kwargs))
+
+
+def _write(dataname, cachefile, columns):
+    table = np.array([columns[name] for name in memfeed.COLUMNS],
+                     dtype=np.float64).reshape(len(memfeed.COLUMNS), -1)
+
+    cachedir = os.path.dirname(cachefile)
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+
+    # Entries for older versions of the same file are no longer reachable.
+    # Those of the current version (other parse kwargs) are kept
+    basename = os.path.basename(dataname)
+    version = fileversion(dataname)
+    for oldfile in glob.glob(os.path.join(glob.escape(cachedir),
+                                          glob.escape(basename) + '.*.npy')):
+        parts = os.path.basename(oldfile)[len(basename) + 1:-4].split('.')
+        if len(parts) != 2 or parts[0] != version:
+            try:
+                os.remove(oldfile)
+            except OSError:
+                pass  # removed by a concurrent build
+
+    # Write aside and rename, so a concurrent reader never sees half a file
+    tmpfile = '%s.%d.tmp' % (cachefile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        np.save(f, table)
+    os.replace(tmpfile, cachefile)
+
+
+def build(feedcls, dataname, cachefile, **kwargs):
+    '''Parses ``dataname`` as ``feedcls`` does and writes the cache entry'''
+    parsekw = dict((k, v) for k, v in kwargs.items() if k not in PASSTHRU)
+    _write(dataname, cachefile, parse(feedcls, dataname, **parsekw))
+
+
+def _slice(cachefile, fromdate, todate):
+    table = np.load(cachefile, mmap_mode='r')
+    dts = table[0]
+
+    # Same boundaries as the feeds: from <= dt <= to
+    lo, hi = 0, len(dts)
+    if fromdate is not None:
+        lo = int(np.searchsorted(dts, bt.date2num(fromdate), side='left'))
+    if todate is not None:
+        hi = int(np.searchsorted(dts, bt.date2num(todate), side='right'))
+
+    return dict((name, table[i, lo:hi])
+                for i, name in enumerate(memfeed.COLUMNS))
+
+
+def columns(feedcls, dataname, fromdate=None, todate=None, cachedir=None,
+            **kwargs):
+    '''
+    Returns a dict of memory-mapped (read-only) columns for ``dataname``
+    restricted to ``fromdate``/``todate``, building the cache entry if
+    needed
+    '''
+    cachefile = cachepath(feedcls, dataname, cachedir=cachedir, **kwargs)
+    if not os.path.exists(cachefile):
+        build(feedcls, dataname, cachefile, **kwargs)
+
+    return _slice(cachefile, fromdate, todate)
+
+
+def load(dataname, schema=None, fromdate=None, todate=None, cachedir=None,
+         **kwargs):
+    '''
+    The columns of the CSV file ``dataname`` as ``fastcsv.read`` (same
+    arguments) returns them, through the cache: the way the examples load
+    the columns of a data file. ``schema`` is detected from the header if
+    not given
+    '''
+    if schema is None and not kwargs.get('headers', True):
+        schema = 'yahoo'  # the columns in the Yahoo order, as fastcsv reads
+    elif schema is None:
+        with open(dataname) as f:
+            schema, _ = fastcsv.detect(f.readline().rstrip('\r\n').split(
+                kwargs.get('separator', ',')))
+
+    if schema == 'yahoo':  # shares the entries of the Yahoo feeds
+        return columns(bt.feeds.YahooFinanceCSVData, dataname,
+                       fromdate=fromdate, todate=todate, cachedir=cachedir,
+                       **kwargs)
+
+    cachefile = _cachepath('fastcsv.%s' % schema, dataname, cachedir, kwargs)
+    if not os.path.exists(cachefile):
+        parsekw = dict((k, v) for k, v in kwargs.items()
+                       if k not in PASSTHRU)
+        _write(dataname, cachefile,
+               fastcsv.read(dataname, schema=schema, **parsekw))
+
+    return _slice(cachefile, fromdate, todate)
+
+
+def cached(feedcls, dataname, fromdate=None, todate=None, cachedir=None,
+           **kwargs):
+    '''
+    Returns a ``memfeed.MemoryData`` feed backed by the binary cache of what
+    ``feedcls(dataname=dataname, **kwargs)`` would have loaded
+    '''
+    cols = columns(feedcls, dataname, fromdate=fromdate, todate=todate,
+                   cachedir=cachedir, **kwargs)
+
+    feedkw = dict((k, v) for k, v in kwargs.items() if k in FEEDKW)
+    feedkw.setdefault('name', os.path.basename(dataname))
+    return memfeed.MemoryData(dataname=cols, **feedkw)
+
+
+def YahooFinanceCSVData(dataname, **kwargs):
+    '''Cached drop-in for ``bt.feeds.YahooFinanceCSVData``'''
+    return cached(bt.feeds.YahooFinanceCSVData, dataname, **kwargs)
+
+
+def GenericCSVData(dataname, **kwargs):
+    '''Cached drop-in for ``bt.feeds.GenericCSVData``'''
+    return cached(bt.feeds.GenericCSVData, dataname, **kwargs)
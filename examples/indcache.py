@@ -0,0 +1,442 @@
+'''
+Indicator cache for parameter sweeps: identical indicators are calculated
+once per sweep
+
+The combinations of a sweep recalculate the same indicators over the same
+feed: every combination with the same ``macd1`` builds the same
+``EMA(close, macd1)``, the indicators which do not depend on the swept
+params at all (``KnowSureThing``, ``BollingerBands`` in
+``petr4_macd.TheStrategy``) are the same in every combination.
+
+``IndicatorCache`` keeps the output lines of the indicators calculated in
+``runonce`` mode, keyed by:
+
+  - the class of the indicator (aliases resolved, see sharedind.py)
+  - its params
+  - its inputs: a data feed or one of its lines is identified by a hash of
+    the values of the feed, an indicator or one of its lines by its own key
+
+Within ``caching(cache)`` an indicator found in the cache gets its lines
+copied from it instead of calculating them. The indicators inside it are
+still run, as other indicators may use them (see sharedind.py), and are
+themselves looked up in the cache. The line operations inside it
+(``me1 - me2`` in ``MACD``) are skipped. An indicator whose inputs are
+line operations (``self.data.high - self.data.low``) or whose params are
+not plain values (numbers, strings, classes) is not cached, and the line
+operations next to it are then run.
+
+The cache is a directory in shared memory (``/dev/shm``, see shmfeed.py)
+with a file per indicator, so it pickles as its location and the workers
+of a process pool all use the same one. Files are evicted, least recently
+used first, to keep the cache under ``budget`` bytes::
+
+    cache = indcache.IndicatorCache(budget=512 * 2 ** 20)
+    pool = multiprocessing.Pool(initializer=init, initargs=(cache,))
+
+    # In the workers
+    with indcache.caching(cache):
+        cerebro.run()
+
+Indicators must be functions of their inputs and params: one reading
+anything else (the broker, a global) would be served stale values.
+
+Check that sweeps give the same final values and the same values in every
+line of every indicator with and without the cache (and time them)::
+
+    python indcache.py --bars 20000 --macd1 8,12,16 --atrperiod 7,14
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import array
+import contextlib
+import hashlib
+import itertools
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import weakref
+
+# Import the backtrader platform
+import backtrader as bt
+
+import memfeed
+import sharedind
+import shmfeed
+import stratlog
+
+
+def _removedir(path, pid):
+    if os.getpid() == pid and os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class IndicatorCache(object):
+    '''
+    The output lines of indicators, a file per indicator in a directory
+    created in ``dirname`` (default: ``shmfeed.SHMDIR``), evicted least
+    recently used first above ``budget`` bytes. ``stats`` counts the
+    ``hits``, ``misses`` and ``uncached`` indicators of this process
+    '''
+    def __init__(self, budget=256 * 2 ** 20, dirname=None):
+        self.budget = budget
+        self.path = tempfile.mkdtemp(prefix='btind-',
+                                     dir=dirname or shmfeed.SHMDIR)
+        self.stats = dict(hits=0, misses=0, uncached=0)
+        self._size = 0  # of the directory, as of the last eviction
+        self._finalizer = weakref.finalize(self, _removedir, self.path,
+                                           os.getpid())
+
+    def __getstate__(self):
+        return dict(budget=self.budget, path=self.path)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stats = dict(hits=0, misses=0, uncached=0)
+        self._size = 0
+        self._finalizer = None  # only the creator removes the directory
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(
+            key.encode('utf-8')).hexdigest())
+
+    def get(self, key, size):
+        '''The ``size`` bytes stored under ``key`` or None'''
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # most recently used
+        except (IOError, OSError):
+            return None  # not there or just evicted
+
+        return data if len(data) == size else None
+
+    def put(self, key, data):
+        '''Stores the bytes ``data`` under ``key`` and evicts above budget'''
+        if len(data) > self.budget:
+            return
+
+        # Written aside and renamed: readers see whole files only
+        fd, tmppath = tempfile.mkstemp(prefix='.', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmppath, self._file(key))
+
+        # The directory is only scanned when this process may have filled
+        # it: other processes writing meanwhile can take it a bit over
+        self._size += len(data)
+        if self._size > self.budget:
+            self.evict()
+
+    def evict(self):
+        '''Removes the least recently used files above the budget'''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue  # being written
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue  # evicted by another process
+            entries.append((st.st_mtime_ns, st.st_size, name))
+
+        total = sum(e[1] for e in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+        self._size = total
+
+    def close(self):
+        '''Removes the directory (if this process created it)'''
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        self.close()
+
+
+def _paramvalue(value):
+    '''A stable text for a param value or None if it has none'''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return repr(value)
+
+    if isinstance(value, type):
+        cls = sharedind.canonicalclass(value)
+        return '%s.%s' % (cls.__module__, cls.__name__)
+
+    if isinstance(value, (tuple, list)):
+        items = [_paramvalue(v) for v in value]
+        if None not in items:
+            return '(%s)' % ','.join(items)
+
+    return None
+
+
+class _Keys(object):
+    '''
+    Keys of the feeds, lines and indicators of a run, by id (the objects
+    are kept alive so the ids are not reused)
+    '''
+    def __init__(self):
+        self.keys = dict()
+        self.objs = []
+
+    def add(self, obj, key):
+        self.keys[id(obj)] = key
+        self.objs.append(obj)
+
+    def feed(self, data):
+        digest = hashlib.sha1()
+        for line in data.lines:
+            digest.update(memoryview(line.array).cast('B'))
+
+        key = 'data:%s:%d' % (digest.hexdigest(), data.buflen())
+        self.add(data, key)
+        for i, line in enumerate(data.lines):
+            self.add(line, '%s[%d]' % (key, i))
+
+    def get(self, obj, strategy):
+        '''The key of an input of an indicator or None'''
+        if isinstance(obj, bt.LineSeriesStub):
+            obj = obj.lines[0]
+
+        if id(obj) not in self.keys and strategy is not None:
+            for data in strategy.datas:
+                if id(data) not in self.keys:
+                    self.feed(data)
+
+        return self.keys.get(id(obj))
+
+    def indicator(self, ind):
+        '''The key of the indicator ``ind`` or None if it is not cacheable'''
+        if id(ind) in self.keys:
+            return self.keys[id(ind)]
+
+        strategy = sharedind.strategyof(ind)
+        inputs = [self.get(data, strategy) for data in ind.datas]
+        params = [(name, _paramvalue(getattr(ind.params, name)))
+                  for name in ind.params._getkeys()]
+
+        key = None
+        if None not in inputs and None not in (v for _, v in params):
+            cls = sharedind.canonicalclass(type(ind))
+            key = '%s.%s(%s;%s)' % (
+                cls.__module__, cls.__name__, ','.join(inputs),
+                ','.join('%s=%s' % p for p in params))
+
+        self.add(ind, key)
+        if key is not None:
+            for i, line in enumerate(ind.lines):
+                self.add(line, '%s[%d]' % (key, i))
+
+        return key
+
+
+# Cache and keys of the run in progress
+_active = None
+
+
+def _cached_once(self, _once=bt.Indicator._once):
+    cache, keys = _active
+    key = keys.indicator(self)
+    if key is None:
+        cache.stats['uncached'] += 1
+        return _once(self)
+
+    size = self._clock.buflen()
+    nbytes = size * 8
+    stored = cache.get(key, nbytes * self.lines.size())
+    if stored is None:
+        cache.stats['misses'] += 1
+        _once(self)
+        cache.put(key, b''.join(
+            memoryview(line.array[:size]).cast('B') for line in self.lines))
+        return
+
+    cache.stats['hits'] += 1
+    # As LineIterator._once, with the lines loaded instead of calculated.
+    # They are loaded first: the indicators inside may take them as inputs
+    self.forward(size=size)
+    view = memoryview(stored)
+    for i, line in enumerate(self.lines):
+        line.array = array.array(str('d'))
+        line.array.frombytes(view[i * nbytes:(i + 1) * nbytes])
+
+    # The line operations inside only feed the calculation of the lines,
+    # unless an indicator inside (which is not cached) takes them as input
+    children = self._lineiterators[bt.LineIterator.IndType]
+    skipops = all(keys.indicator(child) is not None for child in children
+                  if isinstance(child, bt.Indicator))
+    for child in children:
+        if skipops and not isinstance(child, bt.Indicator):
+            child.forward(size=size)
+        else:
+            child._once()
+
+    for data in self.datas:
+        data.home()
+
+    for child in children:
+        child.home()
+
+    self.home()
+
+    for line in self.lines:
+        line.oncebinding()
+
+
+@contextlib.contextmanager
+def caching(cache):
+    '''Context in which the runs use the indicators in ``cache``'''
+    global _active
+    active, once = _active, bt.Indicator._once
+    _active = (cache, _Keys())
+    bt.Indicator._once = _cached_once
+    try:
+        yield cache
+    finally:
+        _active = active
+        bt.Indicator._once = once
+
+
+class Cerebro(sharedind.Cerebro):
+    '''
+    ``sharedind.Cerebro`` whose runs use the indicators in ``indcache`` (an
+    ``IndicatorCache``, or None for no cache)
+    '''
+    params = (('indcache', None),)
+
+    def runstrategies(self, iterstrat, predata=False):
+        if self.p.indcache is None:
+            return super(Cerebro, self).runstrategies(iterstrat, predata)
+
+        with caching(self.p.indcache):
+            return super(Cerebro, self).runstrategies(iterstrat, predata)
+
+
+# Check
+def _linedigests(ind, prefix=''):
+    '''
+    ``(name, sha1)`` of the values of each line of ``ind`` and, recursively,
+    of the indicators inside it (not of the line operations inside an
+    indicator, which are skipped when it is cached)
+    '''
+    import numpy as np
+
+    name = '%s%s' % (prefix, type(ind).__name__)
+    result = []
+    for i, line in enumerate(ind.lines):
+        values = np.array(line.array, dtype=np.float64)
+        values[np.isnan(values)] = np.nan  # NaNs of any sign and payload
+        result.append(('%s[%d]' % (name, i),
+                       hashlib.sha1(values.tobytes()).hexdigest()))
+    if isinstance(ind, bt.Indicator):
+        children = ind._lineiterators[bt.LineIterator.IndType]
+        for i, child in enumerate(children):
+            if isinstance(child, bt.Indicator):
+                result.extend(_linedigests(child, '%s.%d.' % (name, i)))
+    return result
+
+
+def sweep(columns, grid, cache=None):
+    '''
+    Runs ``petr4_macd.TheStrategy`` for every combination of ``grid``
+    (``[(name, values), ...]``). Returns the final values, the digests of
+    the lines of the indicators of each run (a dict, see ``_linedigests``)
+    and the seconds
+    '''
+    import petr4_macd
+
+    names = [name for name, _ in grid]
+    values, lines = [], []
+    t0 = time.perf_counter()
+    for combo in itertools.product(*[v for _, v in grid]):
+        cerebro = Cerebro(stdstats=False, indcache=cache)
+        cerebro.adddata(memfeed.MemoryData(dataname=columns))
+        cerebro.addstrategy(petr4_macd.TheStrategy, **dict(zip(names, combo)))
+        cerebro.addsizer(bt.sizers.FixedSize, stake=100)
+        cerebro.broker.setcash(20000.0)
+        with stratlog.configure(level=stratlog.WARN):
+            strat = cerebro.run()[0]
+        values.append(cerebro.broker.getvalue())
+        lines.append(dict(d for i, ind in enumerate(
+            strat._lineiterators[bt.LineIterator.IndType])
+            for d in _linedigests(ind, '%d.' % i)))
+
+    return values, lines, time.perf_counter() - t0
+
+
+def runcheck(args=None):
+    args = parse_args(args)
+
+    import synthdata
+    columns = synthdata.columns(args.bars, seed=args.seed)
+    grid = [(name, [int(v) for v in getattr(args, name).split(',')])
+            for name in ('macd1', 'atrperiod', 'smaperiod')]
+
+    plain, plainlines, secs = sweep(columns, grid)
+    print('No cache: %.2f secs' % secs)
+    with IndicatorCache(budget=args.budget * 2 ** 20) as cache:
+        cached, cachedlines, secs = sweep(columns, grid, cache=cache)
+        print('Cached:   %.2f secs, %s' % (secs, ', '.join(
+            '%s: %d' % kv for kv in sorted(cache.stats.items()))))
+
+    # Every line of every run, so that the hits (the runs after the first
+    # one) are checked too and not only through the trades they lead to.
+    # A LinePlotterIndicator gains a line each time it is created in the
+    # process: only the lines of both runs are compared
+    differ, compared = [], 0
+    for i, (plainrun, cachedrun) in enumerate(zip(plainlines, cachedlines)):
+        names = sorted(set(plainrun) & set(cachedrun))
+        compared += len(names)
+        differ.extend((i, name) for name in names
+                      if plainrun[name] != cachedrun[name])
+
+    print('Combinations: %d, Same results: %s, Same indicator lines: %s '
+          '(%d lines compared)' % (len(plain), plain == cached, not differ,
+                                   compared))
+    for i, name in differ[:10]:
+        print('  Combination %d differs in %s' % (i, name))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Sweeps of TheStrategy with and without indicator cache')
+
+    parser.add_argument('--bars', required=False, default=20000, type=int,
+                        help='Synthetic bars')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the synthetic data')
+
+    parser.add_argument('--macd1', required=False, default='8,12,16',
+                        help='Values of macd1')
+
+    parser.add_argument('--atrperiod', required=False, default='7,14',
+                        help='Values of atrperiod')
+
+    parser.add_argument('--smaperiod', required=False, default='30',
+                        help='Values of smaperiod')
+
+    parser.add_argument('--budget', required=False, default=256, type=int,
+                        help='Cache budget (MB)')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runcheck()
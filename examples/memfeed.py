@@ -0,0 +1,86 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import array
+
+# Import the backtrader platform
+import backtrader as bt
+
+
+# Lines carried from a loaded feed into memory (datetime first)
+COLUMNS = ('datetime', 'open', 'high', 'low', 'close', 'volume',
+           'openinterest')
+
+
+def snapshot(data):
+    '''
+    Loads a (not yet started) backtrader data feed outside of cerebro and
+    returns its lines as a dict of ``array.array('d')`` columns.
+
+    The feed's own parsing rules (fromdate/todate, Yahoo adjclose and
+    rounding, ...) are applied, so the columns hold exactly what cerebro
+    would have seen. The result is cheap to pickle and can be handed to
+    worker processes to build ``MemoryData`` feeds without re-reading the
+    file.
+    '''
+    # A feed needs an environment to fetch the default trading calendar
+    data.setenvironment(bt.Cerebro())
+    data._start()
+    data.preload()
+    data.stop()
+
+    return dict((name, array.array(str('d'), getattr(data.lines, name).array))
+                for name in COLUMNS)
+
+
+class MemoryData(bt.feed.DataBase):
+    '''
+    Data feed which replays columns already held in memory (see
+    ``snapshot``)
+
+      - ``dataname``: dict of column name -> sequence of floats. The
+        ``datetime`` column holds backtrader date numbers. Any object with
+        a ``tobytes`` method holding doubles (``array.array('d')``, NumPy
+        arrays and memmaps) is copied in bulk when preloading
+    '''
+
+    def start(self):
+        super(MemoryData, self).start()
+        cols = self.p.dataname
+        self._cols = [(getattr(self.lines, name), cols[name])
+                      for name in COLUMNS if name in cols]
+        self._size = len(cols['datetime'])
+        self._idx = 0
+
+    def _load(self):
+        idx = self._idx
+        if idx >= self._size:
+            return False
+
+        for line, col in self._cols:
+            line[0] = col[idx]
+
+        self._idx = idx + 1
+        return True
+
+    def preload(self):
+        bulk = (not self._filters and not self.p.fromdate and
+                not self.p.todate and not self._tzinput and
+                all(hasattr(col, 'tobytes') for _, col in self._cols) and
+                all(isinstance(line.array, array.array)  # not qbuffer'ed
+                    for line in self.lines))
+        if not bulk:
+            return super(MemoryData, self).preload()
+
+        # Copy whole columns into the line buffers instead of bar by bar
+        loaded = set()
+        for line, col in self._cols:
+            line.array.frombytes(col.tobytes())
+            loaded.add(id(line))
+
+        for line in self.lines:
+            if id(line) not in loaded:
+                line.array.extend([float('NaN')] * self._size)
+
+        self._idx = self._size
+        self.home()
@@ -0,0 +1,445 @@
+'''
+Early-stopping parameter search: random search, successive halving and
+Hyperband
+
+A grid over the seven params of ``petr4_macd.TheStrategy`` has billions of
+combinations. Instead, candidates are drawn at random from a search space
+and most of them are discarded after a backtest on a short slice of the
+history: only the survivors get longer slices and, in the end, the whole
+history.
+
+  - ``random``: every candidate is backtested on the whole history
+  - ``halving`` (successive halving): ``candidates`` are backtested on the
+    last ``1/eta**s`` of the history, the best ``1/eta`` of them on a slice
+    ``eta`` times longer and so on up to the whole history
+  - ``hyperband``: several successive halvings (brackets) with ever fewer
+    candidates starting on ever longer slices, from ``s`` down to the
+    plain random search, for strategies which only show on long histories
+
+Slices end at the last bar, so the short slices are the most recent part
+of the history, and each backtest is fed ``warmup`` extra bars before its
+slice (see walkforward.py). Candidates are ranked by their final value.
+
+The backtests of all the brackets at the same step run in one process pool
+with the columns of the feed shared by the workers (see shmfeed.py).
+
+Every result is appended to a journal (JSON lines) as it comes in. Running
+the same search with the same journal skips what was already backtested,
+so an interrupted search resumes where it stopped (the candidates are drawn
+from ``seed``, they are the same every time)::
+
+    python paramsearch.py --method hyperband --candidates 81 --eta 3 \\
+        --journal /tmp/search.jsonl
+
+The space is taken from the ``SEARCHSPACE`` of the module of the strategy
+unless given as ``name=(low, high)`` (ints or floats) or ``name=[choices]``::
+
+    python paramsearch.py --space 'period=(5, 30)'
+
+The default ``--strategy`` is the RSI ``petr4_backtrader.TestStrategy``.
+``petr4_macd.TheStrategy`` enters and leaves the market on the crosses of
+the KnowSureThing lines, which have no params: its ``SEARCHSPACE`` only
+shifts the first bar it may trade on (until its ``next`` uses its params
+the final values of the candidates barely differ)::
+
+    python paramsearch.py --strategy petr4_macd:TheStrategy \
+        --space 'macd1=(5, 15),atrdist=(1.0, 4.0)'
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import math
+import multiprocessing
+import os.path
+import random
+import sys
+import time
+
+# Import the backtrader platform
+import backtrader as bt
+
+import feedcache
+import indcache
+import runmatrix
+import shmfeed
+import stratlog
+import universe
+import walkforward
+
+
+METHODS = ('random', 'halving', 'hyperband')
+
+
+def sample(space, rng):
+    '''
+    A candidate from ``space``: a ``(low, high)`` tuple of ints is an int
+    in [low, high], of floats a float (4 decimals) and a list a choice
+    '''
+    params = dict()
+    for name in sorted(space):
+        dim = space[name]
+        if isinstance(dim, list):
+            params[name] = rng.choice(dim)
+        elif all(isinstance(x, int) for x in dim):
+            params[name] = rng.randint(*dim)
+        else:
+            params[name] = round(rng.uniform(*dim), 4)
+
+    return params
+
+
+def brackets(method, candidates, eta=3, minfrac=1.0 / 9):
+    '''
+    The brackets of a search, each a list of rungs ``(candidates, fraction
+    of the history)``. The shortest slice is the largest ``1/eta**s`` which
+    is not below ``minfrac``
+    '''
+    if method not in METHODS:
+        raise ValueError('Unknown method %s' % method)
+    if eta < 2 or candidates < 1 or not 0.0 < minfrac <= 1.0:
+        raise ValueError('eta must be at least 2, candidates at least 1 and '
+                         'minfrac in (0, 1]')
+
+    smax = int(math.floor(math.log(1.0 / minfrac, eta) + 1e-9))
+    if method == 'random':
+        steps = [0]
+    elif method == 'halving':
+        steps = [smax]
+    else:
+        steps = range(smax, -1, -1)
+
+    result = []
+    for s in steps:
+        # The most aggressive bracket starts with ``candidates``
+        n = candidates if s == smax else int(math.ceil(
+            candidates * (smax + 1) / (s + 1) / eta ** (smax - s)))
+        result.append([(max(1, n // eta ** k), 1.0 / eta ** (s - k))
+                       for k in range(s + 1)])
+
+    return result
+
+
+def resultkey(params, bars):
+    return json.dumps([sorted(params.items()), bars])
+
+
+class Journal(object):
+    '''
+    Results of a search, appended to ``path`` (if given) as they come in.
+    The first line describes the search: a journal of another search is
+    refused
+    '''
+    def __init__(self, path, header):
+        self.path = path
+        self.values = dict()
+        if not path:
+            return
+
+        data = b''
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        # A line cut by an interruption is dropped: appending after it would
+        # glue the next record to it
+        end = data.rfind(b'\n') + 1
+        if end:
+            if end < len(data):
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+
+            lines = data[:end].decode('utf-8').splitlines()
+            if json.loads(lines[0]) != header:
+                raise ValueError('%s is the journal of another search' % path)
+            for line in lines[1:]:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # damaged line: its backtest is run again
+                self.values[resultkey(rec['params'], rec['bars'])] = \
+                    rec['value']
+            self.f = open(path, 'a')
+        else:
+            self.f = open(path, 'w')
+            self.f.write(json.dumps(header) + '\n')
+            self.f.flush()
+
+    def add(self, params, bars, value):
+        self.values[resultkey(params, bars)] = value
+        if self.path:
+            self.f.write(json.dumps(dict(params=params, bars=bars,
+                                         value=value)) + '\n')
+            self.f.flush()
+
+    def close(self):
+        if self.path:
+            self.f.close()
+
+
+# Columns of the feed and indicator cache shared by the workers (set by the
+# pool initializer)
+_search_data = None
+_search_cache = None
+
+
+def _search_init(columns, cache):
+    global _search_data, _search_cache
+    _search_data = columns
+    _search_cache = cache
+
+
+def _search_run(job):
+    '''
+    Backtests ``params`` on the last ``bars`` bars, fed ``warmup`` bars
+    before them. Returns the job and the final value
+    '''
+    opts, params, bars = job
+    size = len(_search_data['datetime'])
+    tradefrom = size - bars
+    start = max(0, tradefrom - opts['warmup'])
+
+    columns = dict((name, col[start:]) for name, col in _search_data.items())
+
+    cerebro = indcache.Cerebro(stdstats=False, indcache=_search_cache)
+    cerebro.adddata(shmfeed.SharedData(dataname=columns))
+    cerebro.broker = bt.brokers.BackBroker(**opts['broker'])
+    cerebro.addsizer(bt.sizers.FixedSize, **opts['sizer'])
+    kwargs = dict(opts['strat'], **params)
+    cerebro.addstrategy(walkforward.windowed(opts['strategy']),
+                        tradefrom=columns['datetime'][tradefrom - start],
+                        **kwargs)
+
+    # Only warnings are written: not the result line printed by the stop
+    # of some strategies either
+    with stratlog.configure(level=stratlog.WARN, ringsize=500), \
+            contextlib.redirect_stdout(io.StringIO()):
+        cerebro.run()
+
+    return job, cerebro.broker.getvalue()
+
+
+def search(strategy, columns, space, method='hyperband', candidates=81,
+           eta=3, minfrac=1.0 / 9, warmup=0, strat=None, broker=None,
+           sizer=None, cpus=None, seed=0, journal='', cachesize=256 * 2 ** 20,
+           callback=None):
+    '''
+    Searches ``space`` (see ``sample``) for the params of ``strategy`` (a
+    class) with the highest final value over the feed ``columns`` (see
+    ``memfeed.snapshot``). ``strat``, ``broker`` and ``sizer`` are the
+    kwargs for the fixed params, the ``BackBroker`` and the ``FixedSize``
+    sizer. ``journal`` is the path of the journal to resume from and
+    append to. Up to ``cachesize`` bytes of indicators are shared by the
+    backtests on the same slice (see indcache.py, 0 for no cache).
+
+    ``callback(bracket, rung, bars, ranked)`` is called as each rung of a
+    bracket finishes, ``ranked`` being its ``(value, params)`` best first.
+
+    Returns the ``(value, params)`` backtested on the whole history, best
+    first, and the number of backtests (including those in the journal)
+    '''
+    opts = dict(strategy=strategy, strat=strat or {}, broker=broker or {},
+                sizer=sizer or {}, warmup=warmup)
+
+    size = len(columns['datetime'])
+    tradable = size - warmup
+    if tradable < 1:
+        raise ValueError('%d bars do not go beyond a warmup of %d' %
+                         (size, warmup))
+
+    header = dict(strategy='%s:%s' % (strategy.__module__, strategy.__name__),
+                  space=dict((k, space[k]) for k in sorted(space)),
+                  method=method, candidates=candidates, eta=eta,
+                  minfrac=minfrac, warmup=warmup, bars=size,
+                  lastdate=columns['datetime'][-1], strat=opts['strat'],
+                  broker=opts['broker'], sizer=opts['sizer'], seed=seed)
+    header = json.loads(json.dumps(header))  # as it is read back
+
+    # Each bracket: its rungs, the candidates alive, the current rung
+    states = []
+    for b, rungs in enumerate(brackets(method, candidates, eta, minfrac)):
+        rng = random.Random('%d-%d' % (seed, b))
+        alive = [sample(space, rng) for _ in range(rungs[0][0])]
+        states.append(dict(rungs=rungs, alive=alive, rung=0))
+
+    def slicebars(frac):
+        return max(1, int(round(tradable * frac)))
+
+    cpus = cpus or multiprocessing.cpu_count()
+    log = Journal(journal, header)
+    shared = shmfeed.SharedColumns(columns)
+    cache = indcache.IndicatorCache(cachesize) if cachesize else None
+    pool = multiprocessing.Pool(cpus, _search_init, (shared, cache))
+    backtests = 0
+    try:
+        active = list(states)
+        while active:
+            # The backtests of the current rung of every bracket, once
+            jobs = dict()
+            for state in active:
+                bars = slicebars(state['rungs'][state['rung']][1])
+                for params in state['alive']:
+                    key = resultkey(params, bars)
+                    backtests += 1
+                    if key not in log.values and key not in jobs:
+                        jobs[key] = (opts, params, bars)
+
+            for (_, params, bars), value in pool.imap_unordered(
+                    _search_run, list(jobs.values()), 1):
+                log.add(params, bars, value)
+
+            for state in active:
+                k = state['rung']
+                bars = slicebars(state['rungs'][k][1])
+                values = [log.values[resultkey(p, bars)]
+                          for p in state['alive']]
+                # Highest value, the earliest drawn on ties
+                order = sorted(range(len(values)),
+                               key=lambda i: (-values[i], i))
+                ranked = [(values[i], state['alive'][i]) for i in order]
+                if callback is not None:
+                    callback(states.index(state), k, bars, ranked)
+
+                state['rung'] += 1
+                if state['rung'] < len(state['rungs']):
+                    keep = state['rungs'][state['rung']][0]
+                    state['alive'] = [p for _, p in ranked[:keep]]
+                else:
+                    state['final'] = ranked
+
+            active = [s for s in active if s['rung'] < len(s['rungs'])]
+
+        pool.close()
+    except BaseException:
+        pool.terminate()  # interrupted: the journal has what is done
+        raise
+    finally:
+        pool.join()
+        shared.close()
+        if cache is not None:
+            cache.close()
+        log.close()
+
+    # The same candidate may end more than one bracket
+    results = dict()
+    for state in states:
+        for value, params in state['final']:
+            results[resultkey(params, 0)] = (value, params)
+
+    best = sorted(results.values(), key=lambda r: -r[0])
+    return best, backtests
+
+
+def runsearch(args=None):
+    args = parse_args(args)
+
+    module, _, _ = args.strategy.partition(':')
+    StClass = universe.loadclass(args.strategy)
+    if args.space:
+        space = runmatrix.parse_kwargs(args.space)
+    else:
+        space = getattr(importlib.import_module(module), 'SEARCHSPACE', None)
+        if not space:
+            raise ValueError('%s has no SEARCHSPACE: use --space' % module)
+
+    for name in space:
+        if name not in StClass.params._getkeys():
+            raise ValueError('%s has no param %s' % (StClass.__name__, name))
+
+    # Datas are in a subfolder of the samples, relative to this script
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    datapath = os.path.join(modpath, args.data0)
+    columns = feedcache.load(datapath, schema='yahoo')
+
+    def printrung(bracket, rung, bars, ranked):
+        value, params = ranked[0]
+        print('Bracket %d rung %d: %4d candidates on %5d bars, best %10.2f '
+              '%s' % (bracket, rung, len(ranked), bars, value,
+                      ' '.join('%s=%g' % kv for kv in sorted(params.items()))))
+        sys.stdout.flush()
+
+    t0 = time.perf_counter()
+    best, backtests = search(
+        StClass, columns, space, method=args.method,
+        candidates=args.candidates, eta=args.eta, minfrac=args.minfrac,
+        warmup=args.warmup, strat=runmatrix.parse_kwargs(args.strat),
+        broker=runmatrix.parse_kwargs(args.broker),
+        sizer=runmatrix.parse_kwargs(args.sizer), cpus=args.cpus,
+        seed=args.seed, journal=args.journal,
+        cachesize=args.indcache * 2 ** 20, callback=printrung)
+
+    print('Backtests: %d, Secs: %.2f' % (backtests, time.perf_counter() - t0))
+    print('%12s %s' % ('Final value', 'Params'))
+    for value, params in best[:args.top]:
+        print('%12.2f %s' % (value, ' '.join(
+            '%s=%g' % kv for kv in sorted(params.items()))))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Random search / successive halving / Hyperband')
+
+    parser.add_argument('--strategy', required=False,
+                        default='petr4_backtrader:TestStrategy',
+                        help='Strategy as module:Class')
+
+    parser.add_argument('--space', required=False, default='',
+                        metavar='kwargs',
+                        help=('name=(low, high) or name=[choices] (default: '
+                              'SEARCHSPACE of the module of the strategy)'))
+
+    parser.add_argument('--method', required=False, default='hyperband',
+                        choices=METHODS, help='Search method')
+
+    parser.add_argument('--candidates', required=False, default=81, type=int,
+                        help='Candidates of the first (or only) bracket')
+
+    parser.add_argument('--eta', required=False, default=3, type=int,
+                        help='Kept 1/eta of the candidates at each rung')
+
+    parser.add_argument('--minfrac', required=False, default=1.0 / 9,
+                        type=float,
+                        help='Shortest slice as a fraction of the history')
+
+    parser.add_argument('--warmup', required=False, default=150, type=int,
+                        help='Bars fed to the indicators before each slice')
+
+    parser.add_argument('--data0', default='../data/ABEV3.SA.csv',
+                        required=False,
+                        help='Data to read in (relative to this script)')
+
+    parser.add_argument('--strat', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--broker', required=False, default='cash=20000',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--sizer', required=False, default='stake=100',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--cpus', required=False, default=None, type=int,
+                        help='Worker processes (default: number of cores)')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed the candidates are drawn from')
+
+    parser.add_argument('--journal', required=False, default='',
+                        help='JSON lines file to resume from and append to')
+
+    parser.add_argument('--indcache', required=False, default=256, type=int,
+                        metavar='MB',
+                        help='Indicator cache of the search (0: no cache)')
+
+    parser.add_argument('--top', required=False, default=5, type=int,
+                        help='Best candidates to print')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runsearch()
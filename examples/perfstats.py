@@ -0,0 +1,162 @@
+'''
+Performance metrics computed from the equity curve after the run
+
+The stock analyzers (``SharpeRatio``, ``DrawDown``, ``Returns``, ...) each
+do their own bookkeeping on every bar. ``Curve`` only stores, once per bar,
+the date, the broker value and the cash into arrays, and the traded value
+on each execution. ``metrics`` then computes everything from the arrays in
+one vectorized (NumPy) pass:
+
+  - ``return``, ``cagr``: total and compound annual return
+  - ``volatility``: annualized standard deviation of the bar returns
+  - ``sharpe``, ``sortino``: annualized, over ``riskfree`` (annual rate)
+  - ``maxdd``, ``maxddbars``: maximum drawdown (fraction of the peak) and
+    the longest time (bars) spent below a previous peak
+  - ``exposure``: mean fraction of the value which is invested
+  - ``turnover``: traded value over the mean value
+
+``rolling`` has the ``(date number, annualized volatility)`` of a rolling
+window, for when the series is wanted. ``periods`` is the number of bars
+in a year (252 trading days)::
+
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
+    strat = cerebro.run()[0]
+    stats = strat.analyzers.curve.get_analysis()  # metrics() of the curve
+    print(perfstats.report(stats))
+
+``frame`` turns a list of metrics (i.e. those of a sweep) into a pandas
+``DataFrame``.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import array
+import math
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+
+PERIODS = 252  # daily bars in a year
+
+FIELDS = ('return', 'cagr', 'volatility', 'sharpe', 'sortino', 'maxdd',
+          'maxddbars', 'exposure', 'turnover')
+
+
+class Curve(bt.Analyzer):
+    '''
+    Stores the date, value and cash of the broker on each bar and the
+    traded value. ``get_analysis`` returns their ``metrics``
+    '''
+    params = dict(periods=PERIODS, riskfree=0.0, window=21)
+
+    def start(self):
+        self.dt = array.array(str('d'))
+        self.value = array.array(str('d'))
+        self.cash = array.array(str('d'))
+        self.traded = 0.0
+
+    def notify_order(self, order):
+        if order.status in (order.Partial, order.Completed):
+            self.traded += abs(order.executed.size * order.executed.price)
+
+    def next(self):
+        broker = self.strategy.broker
+        self.dt.append(self.data.datetime[0])
+        self.value.append(broker.getvalue())
+        self.cash.append(broker.getcash())
+
+    def get_analysis(self):
+        return metrics(self.dt, self.value, cash=self.cash,
+                       traded=self.traded, periods=self.p.periods,
+                       riskfree=self.p.riskfree, window=self.p.window)
+
+
+def drawdown(value):
+    '''
+    The drawdown (fraction of the running peak) of each bar and the number
+    of bars since the peak
+    '''
+    value = np.asarray(value, dtype=np.float64)
+    peak = np.maximum.accumulate(value)
+    dd = 1.0 - value / peak
+
+    # Index of the last bar at the peak, carried forward
+    idx = np.arange(len(value))
+    atpeak = np.maximum.accumulate(np.where(dd <= 0.0, idx, 0))
+    return dd, idx - atpeak
+
+
+def metrics(dt, value, cash=None, traded=0.0, periods=PERIODS, riskfree=0.0,
+            window=21):
+    '''
+    The metrics (see the module documentation) of the equity curve
+    ``value`` at the date numbers ``dt``. ``cash`` gives the exposure and
+    ``traded`` (total traded value) the turnover
+    '''
+    dt = np.asarray(dt, dtype=np.float64)
+    value = np.asarray(value, dtype=np.float64)
+    nan = float('nan')
+    result = dict((name, nan) for name in FIELDS)
+    result.update(bars=len(value), rolling=[])
+    if not len(value):
+        return result
+
+    start, end = value[0], value[-1]
+    result['return'] = end / start - 1.0
+    days = dt[-1] - dt[0]
+    if days > 0 and end > 0:
+        result['cagr'] = (end / start) ** (365.25 / days) - 1.0
+
+    rets = np.diff(value) / value[:-1]
+    if len(rets) > 1:
+        excess = rets - riskfree / periods
+        std = rets.std(ddof=1)
+        result['volatility'] = std * math.sqrt(periods)
+        if std > 0:
+            result['sharpe'] = excess.mean() / std * math.sqrt(periods)
+        downside = math.sqrt(np.mean(np.minimum(excess, 0.0) ** 2))
+        if downside > 0:
+            result['sortino'] = excess.mean() / downside * math.sqrt(periods)
+
+    if len(rets) >= window > 1:
+        # Rolling sums of the returns and their squares: one pass
+        c1 = np.concatenate(([0.0], np.cumsum(rets)))
+        c2 = np.concatenate(([0.0], np.cumsum(rets * rets)))
+        s1 = c1[window:] - c1[:-window]
+        s2 = c2[window:] - c2[:-window]
+        var = np.maximum(s2 - s1 * s1 / window, 0.0) / (window - 1)
+        vol = np.sqrt(var * periods)
+        result['rolling'] = list(zip(dt[window:].tolist(), vol.tolist()))
+
+    dd, since = drawdown(value)
+    result['maxdd'] = float(dd.max())
+    result['maxddbars'] = int(since.max())
+
+    if cash is not None:
+        invested = np.abs(value - np.asarray(cash, dtype=np.float64))
+        result['exposure'] = float(np.mean(invested / value))
+
+    result['turnover'] = traded / value.mean()
+    return result
+
+
+def report(stats):
+    '''The metrics of ``stats`` as printable text'''
+    return ('Return: %.2f%%, CAGR: %.2f%%, Volatility: %.2f%%, Sharpe: %.2f, '
+            'Sortino: %.2f\nMax drawdown: %.2f%% (%d bars below a peak), '
+            'Exposure: %.2f%%, Turnover: %.2f' % (
+                stats['return'] * 100.0, stats['cagr'] * 100.0,
+                stats['volatility'] * 100.0, stats['sharpe'],
+                stats['sortino'], stats['maxdd'] * 100.0,
+                stats['maxddbars'], stats['exposure'] * 100.0,
+                stats['turnover']))
+
+
+def frame(rows, fields=FIELDS):
+    '''A pandas ``DataFrame`` with the ``fields`` of the metrics ``rows``'''
+    import pandas as pd
+    return pd.DataFrame([[row.get(f) for f in fields] for row in rows],
+                        columns=list(fields))
@@ -1,25 +1,37 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import argparse
 import datetime  # For datetime objects
+import itertools
+import multiprocessing
 import os.path  # To manage paths
 import sys  # To find out the script name (in argv[0])
 
 # Import the backtrader platform
 import backtrader as bt
 
+import fastind
+import feedcache
+import indcache
+import perfstats
+import shmfeed
+import stratlog
+import walkforward
+
+
+# Ranges of the params for paramsearch.py: (low, high), both included
+SEARCHSPACE = dict(
+    period=(2, 60),
+)
+
 
 # Create a Stratey
-class TestStrategy(bt.Strategy):
+class TestStrategy(stratlog.LoggerMixin, bt.Strategy):
     params = (
         ('period', 21),
     )
 
-    def log(self, txt, dt=None):
-        ''' Logging function for this strategy'''
-        dt = dt or self.datas[0].datetime.date(0)
-        print('%s, %s' % (dt.isoformat(), txt))
-
     def __init__(self):
         # Keep a reference to the "close" line in the data[0] dataseries
         self.dataclose = self.datas[0].close
@@ -29,7 +41,9 @@ class TestStrategy(bt.Strategy):
         self.buyprice = None
         self.buycomm = None
 
-        self.rsi = bt.indicators.RSI_SMA(self.data.close, period=self.params.period)
+        # safediv: short periods see windows without any down move
+        self.rsi = fastind.RSI_SMA(self.data.close, period=self.params.period,
+                                   safediv=True)
 
     # Add a MovingAverageSimple indicator
         #self.sma = bt.indicators.SimpleMovingAverage(
@@ -54,24 +68,24 @@ class TestStrategy(bt.Strategy):
         # Attention: broker could reject order if not enough cash
         if order.status in [order.Completed]:
             if order.isbuy():
-                self.log(
-                    'BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f' %
-                    (order.executed.price,
-                     order.executed.value,
-                     order.executed.comm))
+                self.info(
+                    'BUY EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f',
+                    order.executed.price,
+                    order.executed.value,
+                    order.executed.comm)
 
                 self.buyprice = order.executed.price
                 self.buycomm = order.executed.comm
             else:  # Sell
-                self.log('SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f' %
-                         (order.executed.price,
+                self.info('SELL EXECUTED, Price: %.2f, Cost: %.2f, Comm %.2f',
+                          order.executed.price,
                           order.executed.value,
-                          order.executed.comm))
+                          order.executed.comm)
 
             self.bar_executed = len(self)
 
         elif order.status in [order.Canceled, order.Margin, order.Rejected]:
-            self.log('Order Canceled/Margin/Rejected')
+            self.warn('Order Canceled/Margin/Rejected')
 
         # Write down: no pending order
         self.order = None
@@ -80,12 +94,12 @@ class TestStrategy(bt.Strategy):
         if not trade.isclosed:
             return
 
-        self.log('OPERATION PROFIT, GROSS %.2f, NET %.2f' %
-                 (trade.pnl, trade.pnlcomm))
+        self.info('OPERATION PROFIT, GROSS %.2f, NET %.2f',
+                  trade.pnl, trade.pnlcomm)
 
     def next(self):
         # Simply log the closing price of the series from the reference
-        self.log('Close, %.2f' % self.dataclose[0])
+        self.debug('Close, %.2f', self.dataclose[0])
 
 
         # Check if an order is pending ... if yes, we cannot send a 2nd one
@@ -99,7 +113,7 @@ class TestStrategy(bt.Strategy):
             if self.rsi < 30:
 
                 # BUY, BUY, BUY!!! (with all possible default parameters)
-                self.log('BUY CREATE, %.2f' % self.dataclose[0])
+                self.info('BUY CREATE, %.2f', self.dataclose[0])
 
                 # Keep track of the created order to avoid a 2nd order
                 self.order = self.buy()
@@ -108,31 +122,124 @@ class TestStrategy(bt.Strategy):
 
             if self.rsi > 70:
                 # SELL, SELL, SELL!!! (with all possible default parameters)
-                self.log('SELL CREATE, %.2f' % self.dataclose[0])
+                self.info('SELL CREATE, %.2f', self.dataclose[0])
 
                 # Keep track of the created order to avoid a 2nd order
                 self.order = self.sell()
 
     def stop(self):
-        pnl = round(self.broker.getvalue() - self.startcash,2)
+        self.pnl = pnl = round(self.broker.getvalue() - self.startcash,2)
         print('RSI Period: {} Final PnL: {}'.format(
             self.params.period, pnl))
 
+
+# Columns of the feed and indicator cache shared by the sweep workers (set
+# by the pool initializer)
+_sweep_data = None
+_sweep_cache = None
+
+
+def _sweep_init(columns, cache):
+    global _sweep_data, _sweep_cache
+    _sweep_data = columns
+    _sweep_cache = cache
+
+
+def _sweep_run(combination):
+    period, stake, commission, startcash = combination
+
+    cerebro = indcache.Cerebro(stdstats=False, indcache=_sweep_cache)
+    cerebro.adddata(shmfeed.SharedData(dataname=_sweep_data))
+    cerebro.addstrategy(TestStrategy, period=period)
+    cerebro.broker.setcash(startcash)
+    cerebro.addsizer(bt.sizers.FixedSize, stake=stake)
+    cerebro.broker.setcommission(commission=commission)
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
+
+    # Only warnings are written, but the last bars can be dumped on failure
+    with stratlog.configure(level=stratlog.WARN, ringsize=500):
+        strat = cerebro.run()[0]
+    return (period, stake, commission, strat.pnl,
+            strat.analyzers.curve.get_analysis())
+
+
+def sweep(data, periods, stakes, commissions, startcash=10000, cpus=None,
+          cachesize=256 * 2 ** 20):
+    '''
+    Runs ``TestStrategy`` for the cartesian product of ``periods``,
+    ``stakes`` and ``commissions``.
+
+    The feed ``data`` is parsed only once in this process and its columns
+    are shared (see shmfeed.py) with the workers of a process pool (sized
+    to the number of cores unless ``cpus`` is given), which replay them
+    from memory without copying them. The indicators are calculated once
+    for all the combinations which use them, up to ``cachesize`` bytes of
+    them (see indcache.py, 0 for no cache).
+
+    Returns a list of ``(period, stake, commission, pnl, stats)`` sorted by
+    PnL, best first. ``stats`` are the metrics of the equity curve (see
+    perfstats.py)
+    '''
+    columns = shmfeed.share(data)
+    grid = [c + (startcash,)
+            for c in itertools.product(periods, stakes, commissions)]
+
+    cpus = cpus or multiprocessing.cpu_count()
+    chunksize = max(1, len(grid) // (cpus * 4))
+    cache = indcache.IndicatorCache(cachesize) if cachesize else None
+    pool = multiprocessing.Pool(cpus, _sweep_init, (columns, cache))
+    try:
+        results = list(pool.imap_unordered(_sweep_run, grid, chunksize))
+    finally:
+        pool.close()
+        pool.join()
+        columns.close()
+        if cache is not None:
+            cache.close()
+
+    results.sort(key=lambda r: r[3], reverse=True)
+    return results
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='RSI strategy on PETR4 with an optional parameter sweep')
+
+    parser.add_argument('--sweep', required=False, action='store_true',
+                        help='Sweep the parameter grid in a process pool')
+
+    parser.add_argument('--periods', required=False, default='21',
+                        help='RSI periods, i.e.: 5:30,40,50:60:2')
+
+    parser.add_argument('--stakes', required=False, default='10',
+                        help='FixedSize stakes, i.e.: 10,20')
+
+    parser.add_argument('--commissions', required=False, default='0.01',
+                        help='Commissions, i.e.: 0.01,0.002')
+
+    parser.add_argument('--cpus', required=False, default=None, type=int,
+                        help='Worker processes (default: number of cores)')
+
+    parser.add_argument('--indcache', required=False, default=256, type=int,
+                        metavar='MB',
+                        help='Indicator cache of the sweep (0: no cache)')
+
+    return parser.parse_args(pargs)
+
+
 if __name__ == '__main__':
-    startcash = 10000
-    # Create a cerebro entity
-    cerebro = bt.Cerebro()
+    args = parse_args()
 
-    # Add a strategy
-    cerebro.addstrategy(TestStrategy)
+    startcash = 10000
 
     # Datas are in a subfolder of the samples. Need to find where the script is
     # because it could have been called from anywhere
     modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
     datapath = os.path.join(modpath, '../data/PETR4.SA.csv')
 
-    # Create a Data Feed
-    data = bt.feeds.YahooFinanceCSVData(
+    # Create a Data Feed (parsed once, then from the binary cache)
+    data = feedcache.YahooFinanceCSVData(
         dataname=datapath,
         # Do not pass values before this date
         fromdate=datetime.datetime(2016, 1, 1),
@@ -141,6 +248,29 @@ if __name__ == '__main__':
         # Do not pass values after this date
         reverse=False)
 
+    if args.sweep:
+        results = sweep(data,
+                        periods=walkforward.parse_grid(args.periods, int),
+                        stakes=walkforward.parse_grid(args.stakes, int),
+                        commissions=walkforward.parse_grid(args.commissions),
+                        startcash=startcash, cpus=args.cpus,
+                        cachesize=args.indcache * 2 ** 20)
+
+        print('%6s %6s %10s %12s %8s %8s' % (
+            'Period', 'Stake', 'Commission', 'PnL', 'Sharpe', 'MaxDD'))
+        for period, stake, commission, pnl, stats in results:
+            print('%6d %6d %10.4f %12.2f %8.2f %7.2f%%' % (
+                period, stake, commission, pnl, stats['sharpe'],
+                stats['maxdd'] * 100.0))
+
+        sys.exit(0)
+
+    # Create a cerebro entity
+    cerebro = bt.Cerebro()
+
+    # Add a strategy
+    cerebro.addstrategy(TestStrategy)
+
     # Add the Data Feed to Cerebro
     cerebro.adddata(data)
 
@@ -153,14 +283,18 @@ if __name__ == '__main__':
     # Set the commission
     cerebro.broker.setcommission(commission=0.01)
 
+    # Equity curve metrics, computed after the run
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
+
     # Print out the starting conditions
     print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
     # Run over everything
-    cerebro.run()
+    strats = cerebro.run()
 
     # Print out the final result
     print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
+    print(perfstats.report(strats[0].analyzers.curve.get_analysis()))
 
     # Plot the result
     #cerebro.plot()
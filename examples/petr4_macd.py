@@ -1,6 +1,7 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import argparse
 import datetime  # For datetime objects
 import os.path  # To manage paths
 import sys  # To find out the script name (in argv[0])
@@ -8,10 +9,27 @@ import sys  # To find out the script name (in argv[0])
 # Import the backtrader platform
 import backtrader as bt
 
+import feedcache
+import perfstats
+import sharedind
+import stratlog
+
+
+# Ranges of the params for paramsearch.py: (low, high), both included
+SEARCHSPACE = dict(
+    macd1=(4, 20),
+    macd2=(21, 60),  # always slower than macd1
+    macdsig=(3, 20),
+    atrperiod=(3, 30),
+    atrdist=(1.0, 6.0),
+    smaperiod=(10, 100),
+    dirperiod=(2, 30),
+)
+
 
 # Create a Stratey
 
-class TheStrategy(bt.Strategy):
+class TheStrategy(stratlog.LoggerMixin, bt.Strategy):
     '''
     This strategy is loosely based on some of the examples from the Van
     K. Tharp book: *Trade Your Way To Financial Freedom*. The logic:
@@ -42,11 +60,6 @@ class TheStrategy(bt.Strategy):
         ('dirperiod', 10),  # Lookback period to consider SMA trend direction
     )
 
-    def log(self, txt, dt=None):
-        ''' Logging function for this strategy'''
-        dt = dt or self.datas[0].datetime.date(0)
-        print('%s, %s' % (dt.isoformat(), txt))
-
     def notify_order(self, order):
         if order.status == order.Completed:
             pass
@@ -132,7 +145,7 @@ class TheStrategy(bt.Strategy):
 
     def next(self):
 
-        self.log('Close, %.2f' % self.dataclose[0])
+        self.debug('Close, %.2f', self.dataclose[0])
 
         if self.order:
             return  # pending order execution
@@ -144,7 +157,7 @@ class TheStrategy(bt.Strategy):
             #if self.rsi[0] < 30.0:# and self.smadir[0] > 0.0:
             #if self.emuriba_cross > 0.0:
             #if self.buysignal:
-                    self.log('BUY CREATE, %.2f' % self.dataclose[0])
+                    self.info('BUY CREATE, %.2f', self.dataclose[0])
                     self.order = self.buy()
                     self.bought = self.data.close[0]
                     self.pricetosell = self.data.close[0] * 1.10
@@ -158,7 +171,7 @@ class TheStrategy(bt.Strategy):
 
             #if pclose < pstop:
             #    self.close()  # stop met - get out
-            #    self.log('Sell CREATE, %.2f' % self.dataclose[0])
+            #    self.info('Sell CREATE, %.2f', self.dataclose[0])
             #else:
             #    pdist = self.atr[0] * self.p.atrdist
                 # Update only if greater than
@@ -171,14 +184,30 @@ class TheStrategy(bt.Strategy):
             #if self.rsi[0] > 70.0:
             #if self.sellsignal:
             #if self.histo[0] < 0.0 and self.histo[-1] > 0.0 and self.histo[-2] > 0.0:
-                    self.log('Sell CREATE, %.2f' % self.dataclose[0])
+                    self.info('Sell CREATE, %.2f', self.dataclose[0])
                     self.pstop = self.data.close[0]
                     self.close()  # stop met - get out
 
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='MACD/KST strategy on PETR4')
+
+    parser.add_argument('--render', required=False, default='',
+                        metavar='FILE',
+                        help='Write the chart to a png/svg/html file instead '
+                             'of opening an interactive plot')
+
+    return parser.parse_args(pargs)
+
+
 if __name__ == '__main__':
+    args = parse_args()
+
     startcash = 20000
     # Create a cerebro entity
-    cerebro = bt.Cerebro()
+    # Identical indicators (i.e.: the EMAs of MACD and MACDHisto) run once
+    cerebro = sharedind.Cerebro()
 
     # Add a strategy
     cerebro.addstrategy(TheStrategy)
@@ -189,8 +218,8 @@ if __name__ == '__main__':
     datapath = os.path.join(modpath, '../data/PETR4.SA.csv')
     #datapath = os.path.join(modpath, 'data/ABEV3.SA.csv')
 
-    # Create a Data Feed
-    data = bt.feeds.YahooFinanceCSVData(
+    # Create a Data Feed (parsed once, then from the binary cache)
+    data = feedcache.YahooFinanceCSVData(
         dataname=datapath,
         # Do not pass values before this date
         fromdate=datetime.datetime(2018, 1, 1),
@@ -211,14 +240,22 @@ if __name__ == '__main__':
     # Set the commission
     cerebro.broker.setcommission(commission=0.01)
 
+    # Equity curve metrics, computed after the run
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
+
     # Print out the starting conditions
     print('Starting Portfolio Value: %.2f' % cerebro.broker.getvalue())
 
     # Run over everything
-    cerebro.run()
+    strats = cerebro.run()
 
     # Print out the final result
     print('Final Portfolio Value: %.2f' % cerebro.broker.getvalue())
+    print(perfstats.report(strats[0].analyzers.curve.get_analysis()))
 
     # Plot the result
-    cerebro.plot()
+    if args.render:
+        import chartrender
+        chartrender.render(chartrender.capture(strats[0]), args.render)
+    else:
+        cerebro.plot()
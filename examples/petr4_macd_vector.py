@@ -0,0 +1,347 @@
+'''
+Vectorized backtest engine for ``TheStrategy`` (petr4_macd.py)
+
+``TheStrategy`` builds MACD, ATR, SMA, RSI, KST and Bollinger Bands, but
+orders are only driven by the sign of ``kst_cross`` (CrossOver of the
+default KnowSureThing lines):
+
+  - flat and ``kst_cross > 0``: buy ``stake`` at the next open
+  - long and ``kst_cross < 0``: close the position at the next open
+
+The other indicators only matter through their minimum periods, which
+decide on which bar ``next`` is first called. The engine therefore computes
+the KST lines and their crossover over whole arrays, takes the warm-up
+period from ``TheStrategy`` itself (``minperiod``) and then only steps over
+the crossover events (not over the bars) to simulate fills, cash and
+commission.
+
+``verify`` runs the same data through ``cerebro.run()`` and checks the final
+portfolio value and the closed trades of both engines against each other.
+It is the guard of this engine: a change to the trading logic of
+``TheStrategy`` must be mirrored here and checked with ``--verify``.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import itertools
+import os.path
+import sys
+
+import numpy as np
+
+import backtrader as bt
+
+import feedcache
+import memfeed
+import runmatrix
+import stratlog
+from petr4_macd import TheStrategy
+
+
+# Defaults of bt.indicators.KnowSureThing, which TheStrategy uses unchanged
+_KST = bt.indicators.KnowSureThing.params
+KST_RP = (_KST.rp1, _KST.rp2, _KST.rp3, _KST.rp4)
+KST_RMA = (_KST.rma1, _KST.rma2, _KST.rma3, _KST.rma4)
+KST_RSIGNAL = _KST.rsignal
+KST_RFACTORS = tuple(_KST.rfactors)
+
+
+def sma(x, period):
+    '''Simple moving average. The first ``period - 1`` values are NaN'''
+    out = np.full(len(x), np.nan)
+    if len(x) >= period:
+        windows = np.lib.stride_tricks.sliding_window_view(x, period)
+        out[period - 1:] = windows.sum(axis=1) / period
+    return out
+
+
+def roc100(x, period):
+    '''Rate of change with base 100. The first ``period`` values are NaN'''
+    out = np.full(len(x), np.nan)
+    prev = x[:-period]
+    out[period:] = 100.0 * ((x[period:] - prev) / prev)
+    return out
+
+
+def kst(close):
+    '''Returns the ``kst`` and ``signal`` lines of KnowSureThing'''
+    line = 0
+    for rp, rma, rf in zip(KST_RP, KST_RMA, KST_RFACTORS):
+        line = line + rf * sma(roc100(close, rp), rma)
+
+    return line, sma(line, KST_RSIGNAL)
+
+
+def crossover(a, b, start):
+    '''
+    bt.indicators.CrossOver of ``a`` and ``b`` (+1 up, -1 down, 0 none),
+    where ``start`` is the first index at which both inputs are valid. The
+    last non-zero difference is remembered as in NonZeroDifference
+    '''
+    out = np.zeros(len(a))
+    diff = a[start:] - b[start:]
+    if len(diff) < 2:
+        return out
+
+    # Index of the last non zero difference (the seed always counts)
+    nz = np.where(diff != 0.0, np.arange(len(diff)), 0)
+    nzd = diff[np.maximum.accumulate(nz)]
+
+    before, after = nzd[:-1], diff[1:]
+    up = (before < 0.0) & (after > 0.0)
+    down = (before > 0.0) & (after < 0.0)
+    out[start + 1:] = up.astype(float) - down.astype(float)
+    return out
+
+
+_minperiods = dict()
+
+
+def minperiod(**params):
+    '''
+    Minimum period of TheStrategy with ``params``: number of bars seen when
+    ``next`` is called for the first time. It is taken from the strategy
+    built by a cerebro run over a single bar (once per set of params), so
+    it follows the indicators of petr4_macd.py; ``verify`` checks that it
+    matches the first bar cerebro trades on
+    '''
+    key = tuple(sorted(params.items()))
+    if key not in _minperiods:
+        dt0 = bt.date2num(datetime.datetime(2000, 1, 3))
+        bar = dict((name, [dt0 if name == 'datetime' else 1.0])
+                   for name in memfeed.COLUMNS)
+        # Bar by bar: the one-pass calculation needs the periods filled
+        cerebro = bt.Cerebro(stdstats=False, runonce=False)
+        cerebro.adddata(memfeed.MemoryData(dataname=bar))
+        cerebro.addstrategy(TheStrategy, **params)
+        with stratlog.configure(level=stratlog.WARN):
+            _minperiods[key] = cerebro.run()[0]._minperiod
+
+    return _minperiods[key]
+
+
+def signals(columns):
+    '''Returns the ``kst_cross`` array for the given feed columns'''
+    close = np.asarray(columns['close'], dtype=np.float64)
+    kline, ksignal = kst(close)
+    start = max(rp + rma for rp, rma in zip(KST_RP, KST_RMA))
+    start += KST_RSIGNAL - 2  # index of the first valid signal value
+    return crossover(kline, ksignal, start)
+
+
+def backtest(columns, cash=20000.0, stake=100, commission=0.01, cross=None,
+             **params):
+    '''
+    Simulates TheStrategy on the feed ``columns`` (see memfeed.snapshot and
+    feedcache.load) with a FixedSize ``stake`` and a percentage
+    ``commission``.
+
+    ``cross`` can be a precomputed result of ``signals(columns)``, which is
+    the same for every parameter set and can be shared when screening.
+
+    Returns a dict with the final ``value`` and ``cash``, the closed
+    ``trades`` as ``(dtopen, dtclose, price, pnl, pnlcomm)`` tuples and the
+    ``equity`` curve (broker value at each bar)
+    '''
+    opens = np.asarray(columns['open'], dtype=np.float64)
+    closes = np.asarray(columns['close'], dtype=np.float64)
+    dts = np.asarray(columns['datetime'], dtype=np.float64)
+    if cross is None:
+        cross = signals(columns)
+
+    startcash = cash
+    first = minperiod(**params) - 1  # index of the first call to next
+    events = np.flatnonzero(cross[first:]) + first
+    last = len(closes) - 1  # orders created on the last bar never execute
+
+    flows = np.zeros(len(closes))  # cash movements at each bar
+    position = np.zeros(len(closes))
+    trades = []
+    entry = None
+    for i in events:
+        if i >= last:
+            break
+
+        if entry is None and cross[i] > 0.0:
+            # Market buy created at close[i]: checked on submission against
+            # the creation price and executed at the next open
+            price = opens[i + 1]
+            if cash - stake * closes[i] * (1.0 + commission) < 0.0:
+                continue  # margin - order rejected
+            comm = stake * price * commission
+            if cash - stake * price - comm < 0.0:
+                continue  # margin - not enough cash at execution
+
+            cash -= stake * price + comm
+            flows[i + 1] -= stake * price + comm
+            entry = (i + 1, price, comm)
+
+        elif entry is not None and cross[i] < 0.0:
+            # self.close() at the next open
+            price = opens[i + 1]
+            comm = stake * price * commission
+            cash += stake * price - comm
+            flows[i + 1] += stake * price - comm
+
+            ibar, eprice, ecomm = entry
+            pnl = stake * (price - eprice)
+            trades.append((dts[ibar], dts[i + 1], eprice, pnl,
+                           pnl - ecomm - comm))
+            position[ibar:i + 1] = stake
+            entry = None
+
+    if entry is not None:
+        position[entry[0]:] = stake
+
+    equity = startcash + np.cumsum(flows) + position * closes
+    value = equity[-1] if len(equity) else cash
+    return dict(value=value, cash=cash, trades=trades, equity=equity)
+
+
+def screen(columns, grid, cash=20000.0, stake=100, commission=0.01):
+    '''
+    Backtests every parameter dict in ``grid`` reusing the signal arrays.
+    Returns a list of ``(params, value)`` sorted by value, best first
+    '''
+    cross = signals(columns)
+    results = [(params, backtest(columns, cash=cash, stake=stake,
+                                 commission=commission, cross=cross,
+                                 **params)['value'])
+               for params in grid]
+
+    results.sort(key=lambda r: r[-1], reverse=True)
+    return results
+
+
+class TradeList(bt.Analyzer):
+    '''Collects the closed trades in the format returned by ``backtest``'''
+
+    def start(self):
+        self.trades = []
+
+    def notify_trade(self, trade):
+        if trade.isclosed:
+            self.trades.append((trade.dtopen, trade.dtclose, trade.price,
+                                trade.pnl, trade.pnlcomm))
+
+    def get_analysis(self):
+        return self.trades
+
+
+def verify(columns, cash=20000.0, stake=100, commission=0.01, **params):
+    '''
+    Runs both the vectorized engine and ``cerebro.run()`` on ``columns``.
+    Returns ``(ok, vector_result, cerebro_result)``, where the cerebro result
+    only carries ``value`` and ``trades``
+    '''
+    vec = backtest(columns, cash=cash, stake=stake, commission=commission,
+                   **params)
+
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(memfeed.MemoryData(dataname=columns))
+    cerebro.addstrategy(TheStrategy, **params)
+    cerebro.addanalyzer(TradeList, _name='tradelist')
+    cerebro.broker.setcash(cash)
+    cerebro.addsizer(bt.sizers.FixedSize, stake=stake)
+    cerebro.broker.setcommission(commission=commission)
+    with stratlog.configure(level=stratlog.WARN):
+        strat = cerebro.run()[0]
+
+    evt = dict(value=cerebro.broker.getvalue(),
+               trades=strat.analyzers.tradelist.get_analysis())
+
+    ok = (np.isclose(vec['value'], evt['value'], rtol=0, atol=1e-6) and
+          len(vec['trades']) == len(evt['trades']) and
+          all(np.allclose(v, e, rtol=0, atol=1e-6)
+              for v, e in zip(vec['trades'], evt['trades'])))
+
+    return ok, vec, evt
+
+
+def runstrat(args=None):
+    args = parse_args(args)
+
+    # Datas are in a subfolder of the samples. Need to find where the script is
+    # because it could have been called from anywhere
+    modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    datapath = args.data or os.path.join(modpath, '../data/PETR4.SA.csv')
+
+    kwargs = dict(reverse=False)
+    dtfmt = '%Y-%m-%d'
+    for d in ['fromdate', 'todate']:
+        a = getattr(args, d)
+        if a:
+            kwargs[d] = datetime.datetime.strptime(a, dtfmt)
+
+    columns = feedcache.load(datapath, schema='yahoo', **kwargs)
+
+    params = runmatrix.parse_kwargs(args.strat)
+    if args.verify:
+        ok, vec, evt = verify(columns, cash=args.cash, **params)
+        print('Vector Portfolio Value: %.2f' % vec['value'])
+        print('Cerebro Portfolio Value: %.2f' % evt['value'])
+        print('Trades: %d / %d' % (len(vec['trades']), len(evt['trades'])))
+        print('Verification: %s' % ('OK' if ok else 'MISMATCH'))
+        return ok
+
+    if args.screen:
+        # Grid over the periods of the strategy: name=v1:v2:v3 per param
+        grid = dict(TheStrategy.params._getitems())
+        for tok in args.screen.split(','):
+            name, values = tok.split('=')
+            grid[name] = [type(grid[name])(v) for v in values.split(':')]
+
+        names = sorted(grid)
+        combos = [dict(zip(names, c)) for c in itertools.product(
+            *[grid[n] if isinstance(grid[n], list) else [grid[n]]
+              for n in names])]
+
+        for params, value in screen(columns, combos, cash=args.cash)[:10]:
+            print('%.2f %s' % (value, params))
+        return True
+
+    res = backtest(columns, cash=args.cash, **params)
+    for dtopen, dtclose, price, pnl, pnlcomm in res['trades']:
+        print('%s - %s, Price: %.2f, GROSS %.2f, NET %.2f' % (
+            bt.num2date(dtopen).date().isoformat(),
+            bt.num2date(dtclose).date().isoformat(), price, pnl, pnlcomm))
+
+    print('Final Portfolio Value: %.2f' % res['value'])
+    return True
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Vectorized backtest of TheStrategy (petr4_macd.py)')
+
+    parser.add_argument('--data', required=False, default='',
+                        help='Yahoo CSV to read in (default: PETR4)')
+
+    parser.add_argument('--fromdate', required=False, default='2018-01-01',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--todate', required=False, default='2018-09-13',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--cash', required=False, default=20000.0,
+                        type=float, help='Starting cash')
+
+    parser.add_argument('--strat', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--verify', required=False, action='store_true',
+                        help='Check the results against cerebro.run()')
+
+    parser.add_argument('--screen', required=False, default='',
+                        metavar='grid',
+                        help='Parameter grid, i.e.: smaperiod=20:30:50,'
+                             'dirperiod=5:10')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runstrat()
@@ -7,8 +7,12 @@ import backtrader as bt
 import backtrader.feeds as btfeeds
 import backtrader.utils.flushfile
 
+import memfeed
+import resample
+import stratlog
 
-class St(bt.SignalStrategy):
+
+class St(stratlog.LoggerMixin, bt.SignalStrategy):
     params = (('usepp1', False),
               ('plot_on_daily', False))
 
@@ -19,8 +23,8 @@ class St(bt.SignalStrategy):
 
         ## Here is here I am trying to buy when the daily close is less than the
         ## pivot on the Xth day and sell whenever it crosses r1
-        pp1 = self.pp()  # couple the entire indicators
-        self.buysignal = self.data0.close < pp1.p
+        pp1 = resample.couple(pp, self.data0)  # monthly values on daily bars
+        self.buysignal = self.data0.close < pp1.lines.p
         self.sellsignal = self.data0.close > pp1.r1
 
         self.signal_add(bt.SIGNAL_LONG, self.buysignal)
@@ -28,28 +32,30 @@ class St(bt.SignalStrategy):
 
 
     def next(self):
-        txt = ','.join(
-            ['%04d' % len(self),
-             '%04d' % len(self.data0),
-             '%04d' % len(self.data1),
-             self.data.datetime.date(0).isoformat(),
-             '%04d' % len(self.pp),
-             '%.2f' % self.pp[0]])
-
-        print(txt)
+        self.info('%04d,%04d,%04d,%04d,%.2f',
+                  len(self), len(self.data0), len(self.data1),
+                  len(self.pp), self.pp[0])
 
 
 def runstrat():
     args = parse_args()
 
     cerebro = bt.Cerebro()
-    data = btfeeds.BacktraderCSVData(dataname=args.data)
-    cerebro.adddata(data)
-    cerebro.resampledata(data, timeframe=bt.TimeFrame.Months)
+    data = btfeeds.YahooFinanceCSVData(dataname=args.data)
+    if args.resampledata:
+        # Streaming resampler: monthly bars are built bar by bar
+        cerebro.adddata(data)
+        cerebro.resampledata(data, timeframe=bt.TimeFrame.Months)
+    else:
+        # Monthly bars precomputed at load time as a regular second feed
+        columns = memfeed.snapshot(data)
+        cerebro.adddata(memfeed.MemoryData(dataname=columns))
+        cerebro.adddata(resample.ResampledData(columns,
+                                               bt.TimeFrame.Months))
 
     cerebro.addstrategy(St,
                         plot_on_daily=args.plot_on_daily)
-    cerebro.run(runonce=False)
+    cerebro.run(runonce=not args.resampledata)
     if args.plot:
         cerebro.plot(style='bar')
 
@@ -63,6 +69,11 @@ def parse_args():
                         default='../data/PETR4.SA.csv',
                         help='Data to be read in')
 
+    parser.add_argument('--resampledata', required=False,
+                        action='store_true',
+                        help=('Resample with cerebro.resampledata and run '
+                              'bar by bar (monthly bars one day later)'))
+
     parser.add_argument('--plot', required=False, action='store_true',
                         help=('Plot the result'))
 
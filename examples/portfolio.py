@@ -0,0 +1,433 @@
+'''
+One strategy trading a portfolio of symbols against a single broker account
+
+universe.py backtests each symbol on its own, with its own cash. Here all
+the symbols are feeds of one cerebro: the strategy sees every symbol on
+each bar, ranks them and allocates the cash of the shared account.
+
+The feeds differ in length and in the dates they have (ABEV3 starts in
+2013, PETR4 and VALE3 in 2017, a symbol may miss a day). The stock runonce
+loop of cerebro peeks at the next date of every feed on each step to find
+which ones have a bar: ``N`` feeds cost ``N`` Python calls per step even
+when only a few of them have a bar. ``Cerebro`` merges the dates of all
+the preloaded feeds once (``align``) and on each step advances only the
+feeds which have a bar at that date, which costs the total number of bars
+instead of the number of feeds times the steps.
+
+``align`` also gives the strategies the bars of all the symbols as
+``(steps, symbols)`` matrices on the merged dates, carrying the last bar of
+a symbol over the dates it misses (NaN before its first bar), to score
+and rank all the symbols at once with NumPy on each bar::
+
+    class Strategy(portfolio.PortfolioStrategy):
+        def next(self):
+            t, aligned = self.step, self.aligned
+            score = aligned['close'][t] / aligned['close'][t - 20]
+            score[~aligned['present'][t]] = np.nan
+            for i in self.rank(score)[:3]:
+                self.order_target_percent(self.datas[i], target=0.3)
+
+``PortfolioStrategy`` gets ``next`` on every step (also before every feed
+has a bar). ``load`` reads the feeds (CSV files through feedcache.py or a
+bar store, see barstore.py) in a process pool.
+
+From the command line, the ``Momentum`` example over the symbols in
+``data/`` (or a store)::
+
+    python portfolio.py --symbols ABEV3,PETR4,VALE3 --top 2 --cash 100000
+    python portfolio.py --store store/ --fromdate 2016-01-01
+
+Check that the runs equal those of the stock cerebro, and time both, on
+synthetic symbols with missing bars::
+
+    python portfolio.py --check --synthetic 200 --bars 1000
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import functools
+import multiprocessing
+import time
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import memfeed
+import perfstats
+import stratlog
+
+
+ALIGNED = ('open', 'high', 'low', 'close', 'volume')
+
+
+def align(datas, names=ALIGNED):
+    '''
+    Merges the dates of the (preloaded) ``datas``. Returns a dict with:
+
+      - ``symbols``: the name of each data
+      - ``datetime``: the merged (sorted, unique) date numbers
+      - ``steps``: for each data, the steps of its bars in ``datetime``
+      - ``present``: ``(steps, symbols)``, whether a data has a bar
+      - ``bars``: ``(steps, symbols)``, bars of each data so far
+      - ``open`` ... ``volume`` (``names``): ``(steps, symbols)``, the
+        values, those of the last bar where a data has none and NaN before
+        its first bar
+    '''
+    dts = [np.array(data.lines.datetime.array[:data.buflen()],
+                    dtype=np.float64) for data in datas]
+    index = np.unique(np.concatenate(dts)) if dts else np.zeros(0)
+    steps = [np.searchsorted(index, d) for d in dts]
+
+    nsteps, nsyms = len(index), len(datas)
+    present = np.zeros((nsteps, nsyms), dtype=bool)
+    for i, s in enumerate(steps):
+        present[s, i] = True
+
+    result = dict(
+        symbols=[data._name or 'data%d' % i for i, data in enumerate(datas)],
+        datetime=index, steps=steps, present=present,
+        bars=np.cumsum(present, axis=0, dtype=np.int32))
+
+    # Row (bar of the data) of each step: the last one up to the step
+    rows = np.maximum.accumulate(np.where(
+        present, np.cumsum(present, axis=0) - 1, -1), axis=0)
+    for name in names:
+        values = np.full((nsteps, nsyms), np.nan)
+        for i, data in enumerate(datas):
+            col = np.array(getattr(data.lines, name).array[:data.buflen()],
+                           dtype=np.float64)
+            valid = rows[:, i] >= 0
+            values[valid, i] = col[rows[valid, i]]
+        result[name] = values
+
+    return result
+
+
+class Cerebro(bt.Cerebro):
+    '''
+    ``bt.Cerebro`` whose runonce loop advances on each date only the feeds
+    which have a bar at it (see ``align``). The merged dates are kept in
+    ``aligned``. Other modes run as the stock cerebro
+    '''
+    aligned = None
+
+    def _runonce(self, runstrats):
+        for strat in runstrats:
+            strat._once()
+            strat.reset()  # strat called next by next - reset lines
+
+        self.aligned = aligned = align(self.datas)
+
+        # The feeds with a bar at each step: the steps of all the bars
+        # sorted, with the bounds of each step
+        steps = np.concatenate(aligned['steps'] + [np.zeros(0, np.int64)])
+        feeds = np.repeat(np.arange(len(self.datas)),
+                          [len(s) for s in aligned['steps']])
+        order = np.argsort(steps, kind='stable')
+
+        # Preloaded bars are their own ticks (the broker falls back to the
+        # bar when a tick is None): only feeds with filters fill them
+        advances = []
+        for data in self.datas:
+            if data._filters:
+                advances.append(data.advance)
+            else:
+                data._tick_nullify()
+                advances.append(functools.partial(data.advance, ticks=False))
+
+        feeds = [advances[i] for i in feeds[order].tolist()]
+        bounds = np.searchsorted(steps[order],
+                                 np.arange(len(aligned['datetime']) + 1))
+        bounds = bounds.tolist()
+
+        for t, dt0 in enumerate(aligned['datetime'].tolist()):
+            for advance in feeds[bounds[t]:bounds[t + 1]]:
+                advance()
+
+            self._check_timers(runstrats, dt0, cheat=True)
+
+            if self.p.cheat_on_open:
+                for strat in runstrats:
+                    strat._oncepost_open()
+                    if self._event_stop:  # stop if requested
+                        return
+
+            self._brokernotify()
+            if self._event_stop:  # stop if requested
+                return
+
+            self._check_timers(runstrats, dt0, cheat=False)
+
+            for strat in runstrats:
+                strat._oncepost(dt0)
+                if self._event_stop:  # stop if requested
+                    return
+
+                self._next_writers(runstrats)
+
+
+class PortfolioStrategy(bt.Strategy):
+    '''
+    Strategy over all the feeds, whose ``next`` is called on every step of
+    the merged dates. ``step`` is the current step in ``aligned`` (see
+    ``align``)
+    '''
+    def prenext(self):
+        self.next()
+
+    def nextstart(self):
+        self.next()
+
+    @property
+    def aligned(self):
+        if getattr(self, '_aligned', None) is None:
+            # Merged by portfolio.Cerebro or else here (stock cerebro)
+            self._aligned = getattr(self.env, 'aligned', None) or \
+                align(self.datas)
+        return self._aligned
+
+    @property
+    def step(self):
+        return len(self) - 1
+
+    @staticmethod
+    def rank(scores):
+        '''The indices of the symbols by descending score, NaN left out'''
+        scores = np.asarray(scores, dtype=np.float64)
+        order = np.argsort(-scores, kind='stable')
+        return order[~np.isnan(scores[order])].tolist()
+
+
+class Momentum(stratlog.LoggerMixin, PortfolioStrategy):
+    '''
+    Every ``rebalance`` steps holds the ``top`` symbols with the highest
+    return over the last ``lookback`` steps, each with an equal part of
+    ``invest`` (fraction of the value of the account). Only the symbols
+    which have a bar and at least ``lookback`` bars are ranked
+    '''
+    params = dict(lookback=20, top=3, rebalance=5, invest=0.95)
+
+    def next(self):
+        t, aligned = self.step, self.aligned
+        if t < self.p.lookback or t % self.p.rebalance:
+            return
+
+        close = aligned['close']
+        score = close[t] / close[t - self.p.lookback] - 1.0
+        score[~aligned['present'][t] |
+              (aligned['bars'][t] <= self.p.lookback)] = np.nan
+        chosen = set(self.rank(score)[:self.p.top])
+
+        # Sells first: they are executed first and free the cash
+        for i, data in enumerate(self.datas):
+            if i not in chosen and self.getposition(data).size:
+                self.debug('SELL %s, %.2f', aligned['symbols'][i],
+                           close[t, i])
+                self.close(data)
+
+        weight = self.p.invest / self.p.top
+        for i in sorted(chosen):
+            self.debug('TARGET %s, %.2f', aligned['symbols'][i], close[t, i])
+            self.order_target_percent(self.datas[i], target=weight)
+
+
+def _loadsymbol(job):
+    '''The name and ``memfeed`` columns of a symbol (see ``load``)'''
+    symbol, store, fromdate, todate = job
+    if store:
+        import barstore
+        return symbol, barstore.Store(store).read(symbol, fromdate, todate)
+
+    import feedcache
+    import universe
+    path = universe.symbolpath(symbol)
+    return universe.symbolname(path), feedcache.load(
+        path, fromdate=fromdate, todate=todate)
+
+
+def load(symbols, store='', fromdate=None, todate=None, cpus=None):
+    '''
+    The ``(name, columns)`` of ``symbols`` (names or CSV paths, see
+    universe.py, or symbols of the bar ``store``) read in a process pool
+    '''
+    jobs = [(symbol, store, fromdate, todate) for symbol in symbols]
+    cpus = min(cpus or multiprocessing.cpu_count(), len(jobs))
+    if cpus <= 1:
+        return [_loadsymbol(job) for job in jobs]
+
+    pool = multiprocessing.Pool(cpus)
+    try:
+        return pool.map(_loadsymbol, jobs, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def backtest(feeds, cerebrocls=Cerebro, strategy=Momentum, cash=100000.0,
+             commission=0.0, **kwargs):
+    '''
+    Runs ``strategy`` (``kwargs``: its params) over the ``(name, columns)``
+    of ``feeds`` with one account. Returns the strategy
+    '''
+    cerebro = cerebrocls(stdstats=False)
+    for name, cols in feeds:
+        if len(cols['datetime']):
+            cerebro.adddata(memfeed.MemoryData(dataname=cols, name=name))
+
+    cerebro.addstrategy(strategy, **kwargs)
+    cerebro.broker.setcash(cash)
+    cerebro.broker.setcommission(commission=commission)
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+    return cerebro.run()[0]
+
+
+# Check
+def synthetic(symbols, bars, seed=0, missing=0.05):
+    '''
+    ``symbols`` synthetic ``(name, columns)`` starting on different days,
+    each missing a fraction ``missing`` of its bars
+    '''
+    import synthdata
+
+    rng = np.random.RandomState(seed)
+    feeds = []
+    for i in range(symbols):
+        start = datetime.date(2000, 1, 3) + datetime.timedelta(
+            days=int(rng.randint(0, bars // 2)))
+        cols = synthdata.columns(bars, seed=seed + i, start=start)
+        keep = rng.uniform(size=bars) >= missing
+        feeds.append(('SYN%04d' % i, dict(
+            (name, np.asarray(col)[keep]) for name, col in cols.items())))
+    return feeds
+
+
+def runcheck(args):
+    feeds = synthetic(args.synthetic, args.bars, seed=args.seed)
+    total = sum(len(cols['datetime']) for _, cols in feeds)
+    print('Symbols: %d, Bars: %d' % (len(feeds), total))
+
+    results = []
+    for label, cerebrocls in (('Stock cerebro', bt.Cerebro),
+                              ('Merged dates', Cerebro)):
+        t0 = time.perf_counter()
+        with stratlog.configure(level=stratlog.WARN):
+            strat = backtest(feeds, cerebrocls=cerebrocls,
+                             lookback=args.lookback, top=args.top,
+                             rebalance=args.rebalance)
+        secs = time.perf_counter() - t0
+        trades = strat.analyzers.trades.get_analysis()
+        result = (len(strat), strat.broker.getvalue(),
+                  trades.get('total', {}).get('closed', 0))
+        results.append(result)
+        print('%-14s %.2f secs, Steps: %d, Final value: %.2f, Trades: %d' % (
+            (label, secs) + result))
+
+    print('Same results: %s' % (results[0] == results[1]))
+
+
+def runstrat(args=None):
+    args = parse_args(args)
+    if args.check:
+        return runcheck(args)
+
+    kwargs = dict()
+    for d in ['fromdate', 'todate']:
+        a = getattr(args, d)
+        if a:
+            kwargs[d] = datetime.datetime.strptime(a, '%Y-%m-%d')
+
+    if args.store:
+        import barstore
+        symbols = ([s for s in args.symbols.split(',') if s] or
+                   barstore.Store(args.store).symbols())
+    else:
+        import glob
+        import os.path
+        import universe
+        symbols = ([s for s in args.symbols.split(',') if s] or
+                   sorted(glob.glob(os.path.join(universe.DATADIR, '*.csv'))))
+
+    if not symbols:
+        raise SystemExit('No symbols to trade')
+
+    feeds = load(symbols, store=args.store, cpus=args.cpus, **kwargs)
+    print('Symbols: %s' % ', '.join('%s (%d bars)' % (
+        name, len(cols['datetime'])) for name, cols in feeds))
+
+    with stratlog.configure(level=stratlog.DEBUG if args.verbose else
+                            stratlog.WARN):
+        strat = backtest(feeds, cash=args.cash, commission=args.commission,
+                         lookback=args.lookback, top=args.top,
+                         rebalance=args.rebalance)
+
+    trades = strat.analyzers.trades.get_analysis()
+    print('Steps: %d, Trades: %d, Final value: %.2f' % (
+        len(strat), trades.get('total', {}).get('closed', 0),
+        strat.broker.getvalue()))
+    print(perfstats.report(strat.analyzers.curve.get_analysis()))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Momentum strategy over a portfolio of symbols')
+
+    parser.add_argument('--symbols', required=False, default='',
+                        help='Comma separated symbols or CSV paths '
+                             '(default: all in data/ or in the store)')
+
+    parser.add_argument('--store', required=False, default='',
+                        metavar='DIR',
+                        help='Read the symbols from this bar store '
+                             '(see barstore.py)')
+
+    parser.add_argument('--fromdate', required=False, default='',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--todate', required=False, default='',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--cash', required=False, default=100000.0,
+                        type=float, help='Starting cash of the account')
+
+    parser.add_argument('--commission', required=False, default=0.0,
+                        type=float, help='Commission')
+
+    parser.add_argument('--lookback', required=False, default=20, type=int,
+                        help='Steps of the return used to rank')
+
+    parser.add_argument('--top', required=False, default=3, type=int,
+                        help='Symbols held')
+
+    parser.add_argument('--rebalance', required=False, default=5, type=int,
+                        help='Steps between rebalances')
+
+    parser.add_argument('--cpus', required=False, default=None, type=int,
+                        help='Processes loading the feeds')
+
+    parser.add_argument('--verbose', required=False, action='store_true',
+                        help='Log the orders of each rebalance')
+
+    parser.add_argument('--check', required=False, action='store_true',
+                        help='Compare with the stock cerebro on synthetic '
+                             'symbols instead')
+
+    parser.add_argument('--synthetic', required=False, default=200, type=int,
+                        help='Synthetic symbols of the check')
+
+    parser.add_argument('--bars', required=False, default=1000, type=int,
+                        help='Bars of each synthetic symbol')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the synthetic data')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runstrat()
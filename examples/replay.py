@@ -0,0 +1,511 @@
+'''
+Local replay server and live streaming feeds
+
+The server replays CSV files (Yahoo files as in ``data/``, the Alpha Vantage
+layout of ``test_alpha.csv`` or any file with date/open/high/low/close
+columns) over a TCP (``host:port``) or Unix socket (a path). A client
+subscribes to some symbols (file names without ``.csv``/``.SA``) and
+receives their bars merged in datetime order, one text line per bar, at
+``rate`` bars per second (``0``: as fast as the client reads them). Files
+are read line by line while streaming: neither side holds the history.
+
+On the client side a ``ReplayStore`` owns the connection and a reader
+thread which hands the bars to one bounded queue per symbol, so a slow
+strategy pushes back on the server instead of piling up bars. Its
+``ReplayData`` feeds are live feeds: cerebro processes each bar as it
+arrives. ``Latency`` is an analyzer measuring, for each bar, the time from
+its arrival on the socket to the end of the strategy's ``next`` and to the
+submission of each order to the broker, kept in log-bucketed histograms
+(bounded memory) which report percentiles.
+
+Serve the data and paper-trade the Bollinger strategy on several symbols,
+one process per symbol::
+
+    python replay.py serve --address /tmp/replay.sock \\
+        --files ../data/*.csv test_alpha.csv
+
+    python replay.py run --address /tmp/replay.sock \\
+        --symbols PETR4,VALE3,ABEV3 --rate 2000
+
+With ``--files``, ``run`` starts its own server first. Latencies measured
+with ``--rate 0`` include the time the bars wait in the queues.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import glob
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import os.path
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+# Import the backtrader platform
+import backtrader as bt
+
+import stratlog
+import universe
+
+
+QSIZE = 1024  # bars waiting per symbol on the client side
+BATCH = 256  # bars per write on the server side
+END = b'END\n'
+
+
+def sockaddr(address):
+    '''``(family, address)`` for ``host:port`` or a Unix socket path'''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+# Server
+def _dtnum(txt, sessionend=bt.utils.dateintern.TIME_MAX):
+    if len(txt) <= 10:  # daily bars are stamped at the end of the session
+        dt = datetime.datetime.strptime(txt, '%Y-%m-%d')
+        return bt.date2num(datetime.datetime.combine(dt.date(), sessionend))
+    return bt.date2num(datetime.datetime.strptime(txt[:19],
+                                                  '%Y-%m-%d %H:%M:%S'))
+
+
+def bars(path, symbol):
+    '''
+    Yields ``(symbol, datetime, open, high, low, close, volume,
+    openinterest)`` for each line of the CSV file in ``path``, with the
+    values a backtrader feed would produce (adjusted and rounded like
+    ``YahooFinanceCSVData`` for Yahoo files)
+    '''
+    with open(path) as f:
+        header = [h.strip().lower() for h in f.readline().split(',')]
+        yahoo = 'adj close' in header
+        # i.e. '1. open' in the Alpha Vantage layout
+        names = [h.split('. ')[-1] for h in header]
+        idx = [names.index(n) if n in names else -1
+               for n in ('open', 'high', 'low', 'close', 'volume',
+                         'openinterest')]
+        iadj = header.index('adj close') if yahoo else -1
+
+        for line in f:
+            toks = line.rstrip('\r\n').split(',')
+            if len(toks) < len(header) or 'null' in toks:
+                continue
+
+            o, h, l, c, v, oi = [float(toks[i]) if i >= 0 else 0.0
+                                 for i in idx]
+            if yahoo:
+                adjfactor = c / float(toks[iadj])
+                o, h, l = o / adjfactor, h / adjfactor, l / adjfactor
+                c = float(toks[iadj])
+                v *= adjfactor
+                o, h, l, c = [round(x, 2) for x in (o, h, l, c)]
+                v = round(v, 0)
+
+            yield symbol, _dtnum(toks[0]), o, h, l, c, v, oi
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        if self.connection.family == socket.AF_INET:
+            self.connection.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        # One JSON line: {"symbols": [...], "rate": bars per second}
+        request = json.loads(self.rfile.readline().decode('utf-8') or '{}')
+        paths = self.server.paths
+        symbols = request.get('symbols') or sorted(paths)
+        missing = [s for s in symbols if s not in paths]
+        if missing:
+            self.wfile.write(('ERROR unknown symbols: %s\n' %
+                              ','.join(missing)).encode('utf-8'))
+            return
+
+        rate = float(request.get('rate', self.server.rate))
+        merged = heapq.merge(*[bars(paths[s], s) for s in symbols],
+                             key=lambda bar: bar[1])
+
+        t0 = time.perf_counter()
+        batch = []
+        for n, bar in enumerate(merged):
+            if rate:
+                wait = t0 + n / rate - time.perf_counter()
+                if wait > 0:  # ahead of time: write the bars already due
+                    self._write(batch)
+                    batch = []
+                    time.sleep(wait)
+
+            batch.append(','.join([bar[0]] + [repr(x) for x in bar[1:]]))
+            if len(batch) >= BATCH:
+                self._write(batch)
+                batch = []
+
+        self._write(batch)
+        self.wfile.write(END)
+
+    def _write(self, lines):
+        if lines:
+            self.wfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, paths, rate=0.0):
+    '''
+    Returns a (not yet serving) server replaying the CSV files in ``paths``
+    on ``address``. Clients may ask for their own ``rate``
+    '''
+    family, addr = sockaddr(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)  # stale socket of a previous server
+        server = _UnixServer(addr, _Handler)
+    else:
+        server = _TCPServer(addr, _Handler)
+
+    server.paths = dict((universe.symbolname(p), p) for p in paths)
+    server.rate = rate
+    return server
+
+
+# Client
+class ReplayStore(object):
+    '''
+    Connection to a replay server. Create the feeds with ``getdata`` before
+    running cerebro: the subscription holds the symbols of all the feeds
+    '''
+    def __init__(self, address, rate=0.0, qsize=QSIZE):
+        self.address = address
+        self.rate = rate
+        self.qsize = qsize
+        self.queues = dict()
+        self.sock = None
+        self.error = None
+
+    def getdata(self, symbol, **kwargs):
+        self.queues[symbol] = queue.Queue(maxsize=self.qsize)
+        kwargs.setdefault('name', symbol)
+        return ReplayData(dataname=symbol, store=self, **kwargs)
+
+    def start(self):
+        if self.sock is not None:  # already started by another feed
+            return
+
+        family, addr = sockaddr(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        request = dict(symbols=sorted(self.queues), rate=self.rate)
+        self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        queues = self.queues
+        clock = time.perf_counter
+        try:
+            for line in self.sock.makefile('rb'):
+                if line == END:
+                    break
+                if line.startswith(b'ERROR'):
+                    self.error = line.decode('utf-8').strip()
+                    break
+
+                symbol, values = line.split(b',', 1)
+                bar = tuple(float(x) for x in values.split(b','))
+                queues[symbol.decode('utf-8')].put((clock(), bar))
+        except OSError as e:  # closed by stop() or by the server
+            self.error = self.error or str(e)
+        finally:
+            for q in queues.values():
+                q.put(None)
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+class ReplayData(bt.feed.DataBase):
+    '''
+    Live feed of one symbol of a ``ReplayStore``. ``arrival`` holds the
+    ``time.perf_counter()`` at which the current bar was received
+    '''
+    params = (
+        ('store', None),
+        ('qcheck', 0.5),  # seconds to wait for a bar before yielding
+    )
+
+    arrival = None
+
+    def islive(self):
+        return True
+
+    def start(self):
+        super(ReplayData, self).start()
+        self._queue = self.p.store.queues[self.p.dataname]
+        self.p.store.start()
+
+    def stop(self):
+        super(ReplayData, self).stop()
+        self.p.store.stop()
+
+    def _load(self):
+        try:
+            item = self._queue.get(timeout=self.p.qcheck)
+        except queue.Empty:
+            return None  # nothing yet: let cerebro check the other feeds
+
+        if item is None:
+            if self.p.store.error:
+                raise RuntimeError('Replay: %s' % self.p.store.error)
+            return False  # end of the replay
+
+        self.arrival, bar = item
+        lines = self.lines
+        (lines.datetime[0], lines.open[0], lines.high[0], lines.low[0],
+         lines.close[0], lines.volume[0], lines.openinterest[0]) = bar
+        return True
+
+
+# Latency
+class Histogram(object):
+    '''
+    Log-bucketed histogram of durations in seconds (1% wide buckets from
+    0.1 microseconds up to 100 seconds): bounded memory and mergeable
+    '''
+    LOW = 1e-7
+    RATIO = 1.01
+    SIZE = 2085
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        if value > self.LOW:
+            i = int(math.log(value / self.LOW) / math.log(self.RATIO)) + 1
+            i = min(i, self.SIZE - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        '''Upper edge of the bucket holding the ``q`` (0-100) percentile'''
+        if not self.count:
+            return float('nan')
+
+        target = q / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self.LOW * self.RATIO ** i, self.max)
+        return self.max
+
+
+class Latency(bt.Analyzer):
+    '''
+    Time from the arrival of each bar of the live data to the end of the
+    strategy's ``next`` (``bars``) and to the submission to the broker of
+    each order created on it (``orders``, stamped by wrapping the
+    ``submit`` of the broker for the run)
+    '''
+    def start(self):
+        self.bars = Histogram()
+        self.orders = Histogram()
+
+        broker = self.strategy.broker
+        submit = broker.submit
+
+        def stamped(order, check=True):
+            arrival = self.data.arrival
+            if arrival is not None:
+                self.orders.add(time.perf_counter() - arrival)
+            return submit(order, check=check)
+
+        broker.submit = stamped
+
+    def stop(self):
+        vars(self.strategy.broker).pop('submit', None)
+
+    def next(self):
+        now = time.perf_counter()
+        arrival = self.data.arrival
+        if arrival is not None:
+            self.bars.add(now - arrival)
+
+    prenext = next
+
+    def get_analysis(self):
+        return dict(bars=self.bars, orders=self.orders)
+
+
+def report(name, lat):
+    '''Text line with the p50/p99 latencies (microseconds) of ``lat``'''
+    us = 1e6
+    return ('%-12s bars: %8d p50 %9.1f p99 %9.1f | orders: %6d '
+            'p50 %9.1f p99 %9.1f' % (
+                name, lat['bars'].count, lat['bars'].percentile(50) * us,
+                lat['bars'].percentile(99) * us, lat['orders'].count,
+                lat['orders'].percentile(50) * us,
+                lat['orders'].percentile(99) * us))
+
+
+def runsymbol(job):
+    '''
+    Paper-trades ``strategy`` (``module:Class``) on one symbol of the replay
+    server at ``address``. Returns ``(symbol, seconds, latencies, value)``
+    '''
+    address, symbol, opts = job
+    store = ReplayStore(address, rate=opts['rate'])
+
+    # exactbars: live runs keep only the bars the indicators need
+    cerebro = bt.Cerebro(stdstats=False, exactbars=1)
+    cerebro.adddata(store.getdata(symbol))
+    cerebro.addstrategy(universe.loadclass(opts['strategy']))
+    cerebro.broker.setcash(opts['cash'])
+    cerebro.addsizer(bt.sizers.FixedSize, stake=opts['stake'])
+    cerebro.broker.setcommission(commission=opts['commission'])
+    cerebro.addanalyzer(Latency, _name='latency')
+
+    t0 = time.perf_counter()
+    with stratlog.configure(level=stratlog.WARN, ringsize=500):
+        strat = cerebro.run()[0]
+
+    return (symbol, time.perf_counter() - t0,
+            strat.analyzers.latency.get_analysis(), cerebro.broker.getvalue())
+
+
+def run(address, symbols, cpus=None, callback=None, **opts):
+    '''
+    Runs ``runsymbol`` for every symbol in a process pool (each worker has
+    its own connection). Returns the total bars per second and the merged
+    latencies. ``callback`` receives the result of each symbol
+    '''
+    opts = dict(dict(strategy='bollinger_bands_with_alphavantage:'
+                              'TestStrategy',
+                     rate=0.0, cash=30000.0, stake=100, commission=0.002),
+                **opts)
+    jobs = [(address, s, opts) for s in symbols]
+
+    total = dict(bars=Histogram(), orders=Histogram())
+    t0 = time.perf_counter()
+    pool = multiprocessing.Pool(cpus or len(symbols))
+    try:
+        for res in pool.imap_unordered(runsymbol, jobs, 1):
+            for k in total:
+                total[k].merge(res[2][k])
+            if callback is not None:
+                callback(res)
+    finally:
+        pool.close()
+        pool.join()
+
+    return total['bars'].count / (time.perf_counter() - t0), total
+
+
+def runreplay(args=None):
+    args = parse_args(args)
+
+    paths = [p for pattern in args.files for p in sorted(glob.glob(pattern))]
+    if args.command == 'serve' or paths:
+        server = make_server(args.address, paths, rate=args.rate)
+        if args.command == 'serve':
+            print('Replaying %s on %s' % (', '.join(sorted(server.paths)),
+                                          args.address))
+            server.serve_forever()
+            return
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    symbols = [s for s in args.symbols.split(',') if s]
+
+    def printres(res):
+        symbol, secs, lat, value = res
+        print('%s %8.1f bars/s value %10.2f' % (
+            report(symbol, lat), lat['bars'].count / secs, value))
+        sys.stdout.flush()
+
+    bps, total = run(args.address, symbols, cpus=args.cpus,
+                     callback=printres, strategy=args.strategy,
+                     rate=args.rate, cash=args.cash, stake=args.stake,
+                     commission=args.commission)
+    print(report('Total', total))
+    print('Throughput: %.1f bars/s' % bps)
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Replay CSV files over a socket and paper-trade them')
+
+    parser.add_argument('command', choices=['serve', 'run'],
+                        help='Start a server or run strategies against one')
+
+    parser.add_argument('--address', required=False,
+                        default='localhost:8765',
+                        help='host:port or the path of a Unix socket')
+
+    parser.add_argument('--files', required=False, nargs='*', default=[],
+                        help='CSV files (or globs) to replay')
+
+    parser.add_argument('--rate', required=False, default=0.0, type=float,
+                        help='Bars per second per client (0: unthrottled)')
+
+    parser.add_argument('--symbols', required=False, default='',
+                        help='Comma separated symbols to paper-trade')
+
+    parser.add_argument('--strategy', required=False,
+                        default='bollinger_bands_with_alphavantage:'
+                                'TestStrategy',
+                        help='Strategy as module:Class')
+
+    parser.add_argument('--cpus', required=False, default=None, type=int,
+                        help='Worker processes (default: one per symbol)')
+
+    parser.add_argument('--cash', required=False, default=30000.0,
+                        type=float, help='Starting cash per symbol')
+
+    parser.add_argument('--stake', required=False, default=100, type=int,
+                        help='FixedSize stake')
+
+    parser.add_argument('--commission', required=False, default=0.002,
+                        type=float, help='Commission')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runreplay()
@@ -0,0 +1,162 @@
+'''
+Precomputed resampling of in-memory feed columns
+
+``cerebro.resampledata`` builds the bars of the larger timeframe with a
+filter which sees one bar at a time. Here the daily (or intraday) columns
+(see memfeed.py) are grouped by calendar period in one vectorized pass and
+the resulting bars are handed to cerebro as a regular second data feed::
+
+    columns = feedcache.load(path)
+    cerebro.adddata(memfeed.MemoryData(dataname=columns))
+    cerebro.adddata(resample.ResampledData(columns, bt.TimeFrame.Months))
+    cerebro.run()  # runonce
+
+Indicators of the resampled feed are brought to the clock of the daily one
+with ``couple`` (instead of ``indicator()``, whose couplers only work with
+``runonce=False``)::
+
+    pp = bt.ind.PivotPoint(self.data1)
+    self.buysignal = self.data0.close < resample.couple(pp, self.data0).p
+
+Alignment:
+
+  - periods are calendar aligned: weeks start on Monday, ``compression``
+    groups whole periods counted from the year 1 (``Months`` with
+    ``compression=3`` are calendar quarters). The streaming resampler
+    counts compressed periods from the first bar of the data instead
+  - each bar is stamped with the datetime of the last bar of its period,
+    so it becomes visible at the close of that bar, when the period is
+    complete. There is no look-ahead: nothing of a period is seen before
+    it ends. The streaming resampler only learns that a period ended when
+    the first bar of the next one arrives and delivers it one bar later
+  - the last period may be incomplete (the data ends before the period)
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import array
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import memfeed
+
+
+def periodkeys(dts, timeframe, compression=1):
+    '''
+    Integer key of the calendar period of each backtrader date number in
+    ``dts``. Consecutive bars with the same key form a resampled bar
+    '''
+    ordinal = np.floor(dts).astype(np.int64)  # 1 is 0001-01-01, a Monday
+    if timeframe == bt.TimeFrame.Days:
+        key = ordinal
+    elif timeframe == bt.TimeFrame.Weeks:
+        key = (ordinal - 1) // 7
+    elif timeframe in (bt.TimeFrame.Months, bt.TimeFrame.Years):
+        days = np.datetime64('0001-01-01', 'D') + (ordinal - 1)
+        key = days.astype('datetime64[M]').astype(np.int64)  # from 1970
+        key += 1969 * 12  # months since 0001-01 (always positive)
+        if timeframe == bt.TimeFrame.Years:
+            key //= 12
+    else:
+        raise ValueError('Unsupported timeframe: %s' %
+                         bt.TimeFrame.Names[timeframe])
+
+    return key // compression
+
+
+def resample(columns, timeframe=bt.TimeFrame.Months, compression=1):
+    '''
+    Returns the columns of the bars of ``timeframe``/``compression`` built
+    from ``columns``: first open, highest high, lowest low, last close,
+    summed volume and last open interest of each period
+    '''
+    dts = np.asarray(columns['datetime'], dtype=np.float64)
+    if not len(dts):
+        return dict((name, np.empty(0)) for name in memfeed.COLUMNS)
+
+    key = periodkeys(dts, timeframe, compression)
+    starts = np.append(0, np.flatnonzero(np.diff(key)) + 1)
+    ends = np.append(starts[1:], len(dts)) - 1
+
+    def col(name):
+        return np.asarray(columns[name], dtype=np.float64)
+
+    return dict(
+        datetime=dts[ends],
+        open=col('open')[starts],
+        high=np.maximum.reduceat(col('high'), starts),
+        low=np.minimum.reduceat(col('low'), starts),
+        close=col('close')[ends],
+        volume=np.add.reduceat(col('volume'), starts),
+        openinterest=col('openinterest')[ends],
+    )
+
+
+def ResampledData(columns, timeframe=bt.TimeFrame.Months, compression=1,
+                  **kwargs):
+    '''
+    ``memfeed.MemoryData`` feed with the resampled bars of ``columns``.
+    ``kwargs`` go to the feed (i.e.: ``name``)
+    '''
+    return memfeed.MemoryData(
+        dataname=resample(columns, timeframe, compression),
+        timeframe=timeframe, compression=compression, **kwargs)
+
+
+def _feed(obj):
+    '''The data feed which ultimately clocks ``obj``'''
+    while not isinstance(obj, bt.AbstractDataBase):
+        obj = obj._clock
+    return obj
+
+
+class Coupler(bt.Indicator):
+    '''
+    Base class of the couplers built by ``couple``: each bar of the clock
+    carries the values of the last bar of the source delivered so far
+    '''
+    def next(self):
+        src = self.data
+        for i in range(self.fullsize()):
+            self.lines[i][0] = src.lines[i][0] if len(src) else float('nan')
+
+    def once(self, start, end):
+        # For each bar of the clock, the last source bar not after it
+        srcdt = np.frombuffer(_feed(self.data).lines.datetime.array)
+        clkdt = np.frombuffer(_feed(self._clock).lines.datetime.array)
+        idx = np.searchsorted(srcdt, clkdt[start:end], side='right') - 1
+        valid = idx >= 0
+        idx[~valid] = 0
+
+        for i in range(self.fullsize()):
+            src = np.frombuffer(self.data.lines[i].array)
+            vals = np.where(valid, src[idx] if len(src) else np.nan, np.nan)
+            self.lines[i].array[start:end] = array.array(str('d'),
+                                                         vals.tobytes())
+
+
+_couplers = dict()
+
+
+def couple(source, clock):
+    '''
+    Returns an indicator with the lines of ``source`` (an indicator or feed
+    of another timeframe) following ``clock`` (i.e.: ``self.data0``). Works
+    with and without ``runonce``
+    '''
+    srccls = source.__class__
+    cls = _couplers.get(srccls)
+    if cls is None:
+        cls = type(str('Coupler_%s' % srccls.__name__), (Coupler,), {})
+        # Same lines (and plotting) as the source, as bt's LinesCoupler does
+        cls.lines = srccls.lines
+        cls.plotinfo = srccls.plotinfo
+        cls.plotlines = srccls.plotlines
+        _couplers[srccls] = cls
+
+    coupler = cls(source)
+    coupler._clock = clock  # set after creation, not scanned as a data
+    return coupler
@@ -0,0 +1,123 @@
+'''
+Run matrices: many backtest configurations described in one file
+
+A matrix file (YAML or JSON) holds sections of kwargs. In a section each
+key maps to a value or to a list of values and the section stands for the
+cartesian product of them. A list of sections stands for all their
+combinations in turn. For ``stop-trading.py --matrix``::
+
+    approach: [manual, auto]
+    dates:
+      - [2015-01-01, 2016-01-01]
+      - [2017-09-11, 2018-09-13]
+    strat:
+      stop_loss: [0.01, 0.02, 0.05]
+      trail: [false, 2, 3]
+    sizer:
+      stake: [10, 100]
+
+A value which is a list itself goes inside another list (``[[1, 2]]``).
+
+The ``key=value`` strings of the command lines (``--strat trail=3``) are
+parsed with ``parse_kwargs``: literals only, nothing is evaluated.
+
+Results are written as CSV or, for a ``.parquet`` file, Parquet (needs
+pandas and pyarrow).
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import ast
+import csv
+import itertools
+import json
+import os.path
+
+
+def parse_kwargs(text):
+    '''
+    The dict of a ``key=value, ...`` string as it would be written in
+    ``dict(key=value, ...)``, i.e.: ``stop_loss=0.02,trail=3``. Dict literals
+    (``{'a': 1}``) may come before the pairs. Only literals (numbers,
+    strings, booleans, None, tuples, lists, dicts) are accepted: raises
+    ``ValueError`` for anything else
+    '''
+    try:
+        node = ast.parse('dict(%s)' % text, mode='eval').body
+    except SyntaxError as e:
+        raise ValueError('Bad kwargs %r: %s' % (text, e))
+
+    if not isinstance(node, ast.Call) or \
+       not isinstance(node.func, ast.Name) or node.func.id != 'dict':
+        raise ValueError('Bad kwargs %r' % text)
+
+    result = dict()
+    try:
+        for arg in node.args:
+            value = ast.literal_eval(arg)
+            if not isinstance(value, dict):
+                raise ValueError('not a dict')
+            result.update(value)
+
+        for kw in node.keywords:
+            if kw.arg is None:
+                raise ValueError('** is not supported')
+            result[kw.arg] = ast.literal_eval(kw.value)
+    except ValueError as e:
+        raise ValueError('Bad kwargs %r: %s' % (text, e))
+
+    return result
+
+
+def load(path):
+    '''The contents of a YAML (``.yaml``/``.yml``) or JSON file'''
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            import yaml
+            return yaml.safe_load(f)
+
+        return json.load(f)
+
+
+def expand(spec):
+    '''
+    The list of kwargs dicts of a section ``spec``: a dict (the cartesian
+    product of its values, a list being the values to combine), a list of
+    sections or None (a single empty dict)
+    '''
+    if spec is None:
+        return [dict()]
+
+    if isinstance(spec, list):
+        return [kwargs for section in spec for kwargs in expand(section)]
+
+    if not isinstance(spec, dict):
+        raise ValueError('A section must be a dict or a list: %r' % (spec,))
+
+    names = list(spec)
+    values = [v if isinstance(v, list) else [v] for v in spec.values()]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def write(path, rows, fields):
+    '''
+    Writes the ``rows`` (dicts) with the columns ``fields`` to ``path``: a
+    Parquet file if it ends in ``.parquet``, else CSV
+    '''
+    if path.lower().endswith('.parquet'):
+        import pandas as pd
+        frame = pd.DataFrame([[row.get(f) for f in fields] for row in rows],
+                             columns=list(fields))
+        for f in fields:
+            # Parquet columns hold a single type: i.e. trail False and 2
+            kinds = set(type(row[f]) for row in rows if row.get(f) is not None)
+            if len(kinds) > 1:
+                frame[f] = [None if row.get(f) is None else str(row[f])
+                            for row in rows]
+        frame.to_parquet(path, index=False)
+        return
+
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,211 @@
+'''
+Shared indicators: identical indicators are computed once per run
+
+Strategies (and the indicators inside other indicators) often ask for the
+same series more than once: ``MACD`` and ``MACDHisto`` with the default
+periods both build ``EMA(data, 12)`` and ``EMA(data, 26)``, two strategies on
+the same feed both build ``RSI(data)``. Each instance has its own lines and
+is recalculated on every bar.
+
+``Cerebro`` is a drop-in ``bt.Cerebro`` which, while it creates the
+strategies of a run, returns the existing instance for an indicator which
+was already built with the same:
+
+  - class (aliases resolved: ``SMA`` is ``MovingAverageSimple``)
+  - inputs (the same feeds, lines or indicators. A single line indicator and
+    its line are the same input. No inputs means the first data of the
+    owner, as backtrader does)
+  - params, with the defaults filled in (``RSI(data)`` is
+    ``RSI(data, period=14)``), and other keyword args (i.e.: ``plot``)
+
+It uses the indicator cache hook of backtrader (``MetaIndicator`` with
+``usecache``), with the registry below as the cache and the scope limited to
+a run: instances are never reused across runs (optimization passes) or
+cerebros::
+
+    cerebro = sharedind.Cerebro()
+    cerebro.addstrategy(TheStrategy)
+    cerebro.addstrategy(OtherStrategy)  # shares with TheStrategy
+    cerebro.run()
+    print(cerebro.sharedstats)  # {'created': 42, 'shared': 17}
+
+A shared instance is calculated by its first owner, which always comes
+before the later users (indicators are calculated in creation order,
+strategies in the order they were added). A strategy which gets an
+instance of another strategy has its minimum periods extended with it, as
+if it were its own.
+
+Values set on a shared instance after its creation (i.e. ``plotinfo``) are
+seen by all its users.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import contextlib
+
+# Import the backtrader platform
+import backtrader as bt
+from backtrader.indicator import MetaIndicator
+from backtrader.metabase import findowner
+
+
+def canonicalclass(cls):
+    '''The class an alias (i.e.: ``bt.ind.SMA``) was made from'''
+    while cls.__dict__.get('aliased'):
+        cls = cls.__bases__[0]
+    return cls
+
+
+def strategyof(obj):
+    '''The strategy which (maybe through other indicators) owns ``obj``'''
+    while obj is not None and not isinstance(obj, bt.Strategy):
+        obj = getattr(obj, '_owner', None)
+    return obj
+
+
+class Registry(dict):
+    '''
+    Indicator cache for ``MetaIndicator``. It receives the keys backtrader
+    builds, ``(cls, args, tuple(kwargs.items()))``, and stores the instances
+    under the canonical version of them. Raising ``TypeError`` (unhashable
+    values) makes backtrader create a new, unshared, instance
+    '''
+    def __init__(self):
+        super(Registry, self).__init__()
+        self.created = 0
+        self.shared = 0
+        self.borrowers = dict()  # strategy -> instances of other strategies
+        self.inputs = []  # keeps alive the objects whose ids are in the keys
+
+    def _value(self, value):
+        if isinstance(value, bt.LineRoot):
+            if isinstance(value, bt.LineSeries) and value.size() == 1:
+                value = value.lines[0]  # same as its only line
+
+            return id(value)  # instances held in the registry keep the ids
+
+        if isinstance(value, type):
+            return canonicalclass(value)
+
+        hash(value)  # TypeError if not hashable
+        return value
+
+    def canonical(self, key):
+        cls, args, kwargs = key
+        kwargs = dict(kwargs)
+        if not args:
+            # backtrader gives them the first datas of the owner
+            owner = findowner(None, bt.LineIterator, startlevel=2)
+            if owner is not None:
+                args = tuple(owner.datas[:cls._mindatas])
+
+        params = []
+        for name, default in cls.params._getitems():
+            params.append((name, self._value(kwargs.pop(name, default))))
+
+        return (canonicalclass(cls),
+                tuple(self._value(arg) for arg in args),
+                tuple(params),
+                tuple(sorted((k, self._value(v)) for k, v in kwargs.items())))
+
+    def __getitem__(self, key):
+        ind = super(Registry, self).__getitem__(self.canonical(key))
+        owner = findowner(None, bt.LineIterator, startlevel=2)
+        if not shareable(ind, owner):
+            raise KeyError(key)  # backtrader creates a new one
+
+        self.shared += 1
+        user = strategyof(owner)
+        if user is not strategyof(ind):
+            self.borrow(user, ind)
+
+        return ind
+
+    def setdefault(self, key, ind):
+        # Only called after a miss: a new instance, which replaces any
+        # unshareable one under the same key
+        self.created += 1
+        self.inputs.append(key)
+        self[self.canonical(key)] = ind
+        return ind
+
+    def borrow(self, strategy, ind):
+        '''
+        Adds the minimum period of ``ind`` to those of ``strategy`` when it
+        calculates them, as backtrader only considers its own indicators
+        '''
+        borrowed = self.borrowers.get(strategy)
+        if borrowed is None:
+            self.borrowers[strategy] = borrowed = []
+            periodset = strategy._periodset
+
+            def _periodset():
+                periodset()
+                extendperiods(strategy, borrowed)
+
+            strategy._periodset = _periodset
+
+        borrowed.append(ind)
+
+
+def shareable(ind, owner):
+    '''
+    Whether ``owner`` (the one asking for the indicator) can use ``ind``.
+    With ``runonce`` only the top level indicators of a strategy are moved
+    bar by bar with it, and an indicator calculated bar by bar (only
+    ``next``) only moves its own: those get only strategy level instances
+    '''
+    if isinstance(owner, bt.Indicator) and \
+       type(owner).once is not bt.Indicator.once_via_next:
+        return True  # calculated from the arrays of the inputs
+
+    return isinstance(ind._owner, bt.Strategy) and \
+        isinstance(owner, (bt.Strategy, bt.Indicator))
+
+
+def extendperiods(strategy, indicators):
+    '''Extends the minimum periods of ``strategy`` with ``indicators``'''
+    dataids = [id(data) for data in strategy.datas]
+    for ind in indicators:
+        strategy._minperiod = max(strategy._minperiod, ind._minperiod)
+
+        # Look for the data feed clocking the indicator
+        clk = ind
+        while clk is not None and id(clk) not in dataids:
+            clk = getattr(clk, '_clock', None)
+
+        if clk is not None:
+            i = dataids.index(id(clk))
+            strategy._minperiods[i] = max(strategy._minperiods[i],
+                                          ind._minperiod)
+
+
+@contextlib.contextmanager
+def sharing():
+    '''
+    Context in which the indicators created share identical instances.
+    Returns the ``Registry``
+    '''
+    registry = Registry()
+    cache, cacheuse = MetaIndicator._icache, MetaIndicator._icacheuse
+    MetaIndicator._icache, MetaIndicator._icacheuse = registry, True
+    try:
+        yield registry
+    finally:
+        MetaIndicator._icache, MetaIndicator._icacheuse = cache, cacheuse
+
+
+class Cerebro(bt.Cerebro):
+    '''
+    ``bt.Cerebro`` sharing identical indicators between and inside the
+    strategies of each run. ``sharedstats`` has the counts of the last run
+    '''
+    sharedstats = dict(created=0, shared=0)
+
+    def runstrategies(self, iterstrat, predata=False):
+        with sharing() as registry:
+            try:
+                return super(Cerebro, self).runstrategies(iterstrat, predata)
+            finally:
+                self.sharedstats = dict(created=registry.created,
+                                        shared=registry.shared)
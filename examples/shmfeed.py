@@ -0,0 +1,308 @@
+'''
+Shared data feeds: the columns are loaded once and mapped by every worker
+
+Process pools get the data by pickling it: the columns handed to each
+worker (``initargs``) or, with ``cerebro.optstrategy``, the preloaded
+feeds sent with every task. Each worker ends up with its own copy.
+
+``SharedColumns`` writes the columns of a feed once to a file in shared
+memory (``/dev/shm``) and pickles as its location only. Each process maps
+the file once and its columns are read-only NumPy views of the mapping,
+whose pages are shared by all the processes. ``SharedData`` is a
+``memfeed.MemoryData`` which, instead of copying the columns into its line
+buffers when preloading, makes the views (sliced to ``fromdate``/``todate``)
+its line buffers. The memory of a worker does not grow with the data::
+
+    shared = shmfeed.share(bt.feeds.YahooFinanceCSVData(dataname=path))
+    with shared:
+        cerebro.adddata(shmfeed.SharedData(dataname=shared))
+        cerebro.optstrategy(TheStrategy, period=range(10, 30))
+        cerebro.run()
+
+The preloaded ``SharedData`` feed pickled with each optimization task
+carries the location of its views, not their values (``SharedArray``).
+
+The file is removed when the ``SharedColumns`` is closed (or collected) in
+the process which created it. The processes which mapped it keep their
+mappings.
+
+Check the memory of the workers against copied columns::
+
+    python shmfeed.py --bars 2000000 --cpus 4
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import array
+import collections.abc
+import mmap
+import multiprocessing
+import os
+import os.path
+import tempfile
+import time
+import weakref
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import memfeed
+
+
+SHMDIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Path -> SharedArray over the whole file, mapped once per process
+_maps = dict()
+
+
+def _attach(path):
+    whole = _maps.get(path)
+    if whole is None:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        whole = np.frombuffer(mm, dtype=np.float64).view(SharedArray)
+        whole._path = path
+        _maps[path] = whole
+    return whole
+
+
+def _view(path, start, stop):
+    return _attach(path)[start:stop]
+
+
+class SharedArray(np.ndarray):
+    '''
+    Read-only view of a shared file which pickles as its location (file,
+    offset and length) instead of its values
+    '''
+    _path = None
+
+    def __array_finalize__(self, obj):
+        self._path = getattr(obj, '_path', None)
+
+    def __reduce__(self):
+        whole = _maps.get(self._path)
+        if whole is not None and self.ndim == 1 and \
+           self.strides == (self.itemsize,):
+            start, rem = divmod(self.ctypes.data - whole.ctypes.data,
+                                self.itemsize)
+            if not rem and 0 <= start and start + len(self) <= len(whole):
+                return _view, (self._path, start, start + len(self))
+
+        # Not a view of the file (i.e.: the result of an operation)
+        return np.asarray(self).__reduce__()
+
+
+def _remove(path, pid):
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+
+class SharedColumns(collections.abc.Mapping):
+    '''
+    The columns of a feed (see ``memfeed.snapshot``) written to a file in
+    ``dirname`` (default: ``SHMDIR``). It is a read-only mapping of column
+    name to ``SharedArray`` in every process it is pickled to
+    '''
+    def __init__(self, columns, dirname=None):
+        self.names = [name for name in memfeed.COLUMNS if name in columns]
+        self.size = len(columns['datetime'])
+        if not self.size:
+            raise ValueError('There are no bars to share')
+
+        fd, self.path = tempfile.mkstemp(prefix='btshm-',
+                                         dir=dirname or SHMDIR)
+        with os.fdopen(fd, 'wb') as f:
+            for name in self.names:
+                col = columns[name]
+                if not isinstance(col, array.array):
+                    col = np.ascontiguousarray(col, dtype=np.float64)
+                f.write(col.tobytes())
+
+        self._finalizer = weakref.finalize(self, _remove, self.path,
+                                           os.getpid())
+
+    def __getstate__(self):
+        return dict(names=self.names, size=self.size, path=self.path)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._finalizer = None  # only the creator removes the file
+
+    def __getitem__(self, name):
+        i = self.names.index(name) if name in self.names else -1
+        if i < 0:
+            raise KeyError(name)
+        return _attach(self.path)[i * self.size:(i + 1) * self.size]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        '''Removes the file (if this process created it)'''
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        self.close()
+
+
+def share(data, dirname=None):
+    '''``SharedColumns`` with the bars of a (not yet started) feed'''
+    return SharedColumns(memfeed.snapshot(data), dirname=dirname)
+
+
+class SharedData(memfeed.MemoryData):
+    '''
+    ``memfeed.MemoryData`` which makes the ``SharedArray`` columns of its
+    ``dataname`` (a ``SharedColumns`` or a dict of views of one) its line
+    buffers when preloading, copying nothing. It falls back to copying
+    with filters, timezones or buffers which are not plain arrays
+    (``exactbars``)
+    '''
+    def start(self):
+        super(SharedData, self).start()
+        self._views = False
+
+    def preload(self):
+        views = (not self._filters and not self._tzinput and
+                 all(isinstance(col, SharedArray) for _, col in self._cols) and
+                 all(isinstance(line.array, array.array) and
+                     not line.extension for line in self.lines))
+        if not views:
+            return super(SharedData, self).preload()
+
+        # The dates are filtered as the feed does it: fromdate <= dt <= todate
+        dt = self.p.dataname['datetime']
+        lo = int(np.searchsorted(dt, self.fromdate, 'left'))
+        hi = int(np.searchsorted(dt, self.todate, 'right'))
+
+        loaded = set()
+        for line, col in self._cols:
+            line.array = col[lo:hi]
+            loaded.add(id(line))
+
+        for line in self.lines:
+            if id(line) not in loaded:
+                line.array = array.array(str('d'), [float('NaN')]) * (hi - lo)
+
+        self._idx = self._size
+        self._views = True
+        self.home()
+
+    def load(self):
+        if self._views:
+            return False  # every bar is already in the views
+
+        return super(SharedData, self).load()
+
+
+# Memory check
+def anonmem():
+    '''Anonymous memory (bytes) of this process, not mapped files (Linux)'''
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Anonymous:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class _Reader(bt.Strategy):
+    '''Reads every bar: no indicators, whose lines would grow with the bars'''
+    def start(self):
+        self.total = 0.0
+
+    def next(self):
+        self.total += self.data.close[0] - self.data.open[0]
+
+
+_check_data = None
+_check_mem = 0
+
+
+def _check_init(columns):
+    global _check_data, _check_mem
+    _check_mem = anonmem()
+    _check_data = columns  # unpickled before if not forked
+
+
+def _check_run(feedcls):
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(feedcls(dataname=_check_data))
+    cerebro.addstrategy(_Reader)
+    strat = cerebro.run()[0]
+    return anonmem() - _check_mem, strat.total
+
+
+def check(bars, cpus, seed=0):
+    '''
+    Runs one backtest per worker on ``bars`` synthetic bars with the
+    columns copied to the workers and with them shared. Returns, for each,
+    how much the memory of the workers grew from their start (mean, in
+    MB), the seconds taken and the results
+    '''
+    import synthdata
+
+    columns = synthdata.columns(bars, seed=seed)
+    results = dict()
+    for name, feedcls in (('copied', memfeed.MemoryData),
+                          ('shared', SharedData)):
+        t0 = time.perf_counter()
+        shared = SharedColumns(columns) if name == 'shared' else None
+        initargs = (shared if shared is not None else columns,)
+        pool = multiprocessing.Pool(cpus, _check_init, initargs,
+                                    maxtasksperchild=1)
+        try:
+            res = pool.map(_check_run, [feedcls] * cpus, 1)
+        finally:
+            pool.close()
+            pool.join()
+            if shared is not None:
+                shared.close()
+
+        results[name] = (sum(r[0] for r in res) / len(res) / 2.0 ** 20,
+                         time.perf_counter() - t0,
+                         [round(r[1], 6) for r in res])
+
+    return results
+
+
+def runcheck(args=None):
+    args = parse_args(args)
+    results = check(args.bars, args.cpus, seed=args.seed)
+    print('%-8s %14s %8s %14s' % ('Columns', 'Worker MB', 'Secs', 'Result'))
+    for name, (mem, secs, values) in sorted(results.items()):
+        print('%-8s %14.1f %8.2f %14.2f' % (name, mem, secs, values[0]))
+
+    same = results['copied'][2] == results['shared'][2]
+    print('Same results: %s' % same)
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Worker memory with copied and with shared columns')
+
+    parser.add_argument('--bars', required=False, default=1000000, type=int,
+                        help='Synthetic bars')
+
+    parser.add_argument('--cpus', required=False, default=2, type=int,
+                        help='Worker processes')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the synthetic data')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runcheck()
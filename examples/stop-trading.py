@@ -3,14 +3,22 @@ from __future__ import (absolute_import, division, print_function,
 
 import argparse
 import datetime
+import itertools
+import multiprocessing
 import os.path  # To manage paths
 import sys
 
 
 import backtrader as bt
 
+import feedcache
+import perfstats
+import runmatrix
+import shmfeed
+import stratlog
 
-class BaseStrategy(bt.Strategy):
+
+class BaseStrategy(stratlog.LoggerMixin, bt.Strategy):
     params = dict(
         fast_ma=10,
         slow_ma=20,
@@ -35,11 +43,11 @@ class ManualStopOrStopTrail(BaseStrategy):
             return  # discard any other notification
 
         if not self.position:  # we left the market
-            print('SELL@price: {:.2f}'.format(order.executed.price))
+            self.info('SELL@price: %.2f', order.executed.price)
             return
 
         # We have entered the market
-        print('BUY @price: {:.2f}'.format(order.executed.price))
+        self.info('BUY @price: %.2f', order.executed.price)
 
         if not self.p.trail:
             stop_price = order.executed.price * (1.0 - self.p.stop_loss)
@@ -60,7 +68,7 @@ class ManualStopOrStopTrailCheat(BaseStrategy):
     )
 
     def __init__(self):
-        #super().__init__()
+        super(ManualStopOrStopTrailCheat, self).__init__()  # the crossup
         self.broker.set_coc(True)
 
     def notify_order(self, order):
@@ -68,11 +76,11 @@ class ManualStopOrStopTrailCheat(BaseStrategy):
             return  # discard any other notification
 
         if not self.position:  # we left the market
-            print('SELL@price: {:.2f}'.format(order.executed.price))
+            self.info('SELL@price: %.2f', order.executed.price)
             return
 
         # We have entered the market
-        print('BUY @price: {:.2f}'.format(order.executed.price))
+        self.info('BUY @price: %.2f', order.executed.price)
 
     def next(self):
         if not self.position and self.crossup > 0:
@@ -98,19 +106,19 @@ class AutoStopOrStopTrail(BaseStrategy):
 
     def notify_order(self, order):
         if order.status == order.Cancelled:
-            print('CANCEL@price: {:.2f} {}'.format(
-                order.executed.price, 'buy' if order.isbuy() else 'sell'))
+            self.info('CANCEL@price: %.2f %s',
+                      order.executed.price, 'buy' if order.isbuy() else 'sell')
             return
 
         if not order.status == order.Completed:
             return  # discard any other notification
 
         if not self.position:  # we left the market
-            print('SELL@price: {:.2f}'.format(order.executed.price))
+            self.info('SELL@price: %.2f', order.executed.price)
             return
 
         # We have entered the market
-        print('BUY @price: {:.2f}'.format(order.executed.price))
+        self.info('BUY @price: %.2f', order.executed.price)
 
     def next(self):
         if not self.position and self.crossup > 0:
@@ -145,6 +153,250 @@ APPROACHES = dict(
 )
 
 
+def parsedate(a):
+    '''Date[time] in YYYY-MM-DD[THH:MM:SS] format (or a date) to datetime'''
+    if isinstance(a, datetime.datetime):
+        return a
+    if isinstance(a, datetime.date):
+        return datetime.datetime.combine(a, datetime.time())
+
+    dtfmt, tmfmt = '%Y-%m-%d', 'T%H:%M:%S'
+    strpfmt = dtfmt + tmfmt * ('T' in a)
+    return datetime.datetime.strptime(a, strpfmt)
+
+
+# Default dates of a single run (and of the rows of a matrix)
+FROMDATE = datetime.datetime(2017, 9, 11)
+TODATE = datetime.datetime(2018, 9, 13)
+
+MATRIX_FIELDS = ('approach', 'data', 'fromdate', 'todate')
+RESULT_FIELDS = ('bars', 'trades', 'won', 'startvalue', 'endvalue', 'pnl',
+                 'return', 'cagr', 'volatility', 'sharpe', 'sortino', 'maxdd',
+                 'maxddbars', 'exposure', 'turnover')
+
+
+def matrixjobs(matrix, args, modpath):
+    '''
+    The runs of a ``matrix`` (see runmatrix.py) with the keys:
+
+      - ``approach``: names in ``APPROACHES`` (default: all of them)
+      - ``data0``: paths relative to this script (default: ``--data0``)
+      - ``dates``: list of ``[fromdate, todate]`` (default: those given on
+        the command line or the single run ones). ``null`` for no limit
+      - ``strat``, ``broker``, ``sizer``: sections of kwargs, on top of
+        those given with ``--strat``, ``--broker``, ``--sizer``
+
+    Strat kwargs are only passed to the approaches which have that param
+    (i.e.: ``buy_limit``) and the runs which end up being the same are
+    only done once
+    '''
+    def values(key, default):
+        value = matrix.get(key, default)
+        return value if isinstance(value, list) else [value]
+
+    approaches = values('approach', sorted(APPROACHES))
+    for name in approaches:
+        if name not in APPROACHES:
+            raise ValueError('Unknown approach %s' % name)
+
+    dates = [(args.fromdate or FROMDATE, args.todate or TODATE)]
+    dates = [tuple(parsedate(d) if d else None for d in pair)
+             for pair in matrix.get('dates', dates)]
+
+    base = dict((s, runmatrix.parse_kwargs(getattr(args, s)))
+                for s in ('strat', 'broker', 'sizer'))
+    sections = dict((s, [dict(base[s], **kw)
+                         for kw in runmatrix.expand(matrix.get(s))])
+                    for s in ('strat', 'broker', 'sizer'))
+
+    known = set()
+    for name in approaches:
+        known.update(APPROACHES[name].params._getkeys())
+    for strat in sections['strat']:
+        unknown = set(strat) - known
+        if unknown:
+            raise ValueError('No approach has the params %s' %
+                             ', '.join(sorted(unknown)))
+
+    jobs, seen = [], set()
+    for name, data0, (fromdate, todate), strat, broker, sizer in \
+            itertools.product(approaches, values('data0', args.data0), dates,
+                              sections['strat'], sections['broker'],
+                              sections['sizer']):
+        params = APPROACHES[name].params._getkeys()
+        strat = dict((k, v) for k, v in strat.items() if k in params)
+
+        job = dict(approach=name, datapath=os.path.join(modpath, data0),
+                   fromdate=fromdate, todate=todate, strat=strat,
+                   broker=broker, sizer=sizer)
+        key = repr(sorted((k, sorted(v.items()) if isinstance(v, dict) else v)
+                          for k, v in job.items()))
+        if key not in seen:
+            seen.add(key)
+            jobs.append(job)
+
+    return jobs
+
+
+# Columns of the feeds shared by the matrix workers, by path (set by the
+# pool initializer)
+_matrix_data = None
+
+
+def _matrix_init(columns):
+    global _matrix_data
+    _matrix_data = columns
+
+
+def _matrix_run(job):
+    cerebro = bt.Cerebro(stdstats=False)
+
+    # The loaded columns get the same date filtering as the file would
+    data = shmfeed.SharedData(dataname=_matrix_data[job['datapath']],
+                              fromdate=job['fromdate'], todate=job['todate'])
+    cerebro.adddata(data)
+
+    cerebro.broker = bt.brokers.BackBroker(**job['broker'])
+    cerebro.addsizer(bt.sizers.FixedSize, **job['sizer'])
+    cerebro.addstrategy(APPROACHES[job['approach']], **job['strat'])
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
+
+    # Only warnings are written, but the last bars can be dumped on failure
+    with stratlog.configure(level=stratlog.WARN, ringsize=500):
+        strat = cerebro.run(**job['cerebro'])[0]
+
+    trades = strat.analyzers.trades.get_analysis()
+    startvalue = cerebro.broker.startingcash
+    endvalue = cerebro.broker.getvalue()
+    result = dict(bars=len(data),
+                  trades=trades.get('total', {}).get('closed', 0),
+                  won=trades.get('won', {}).get('total', 0),
+                  startvalue=startvalue, endvalue=endvalue,
+                  pnl=endvalue - startvalue)
+    stats = strat.analyzers.curve.get_analysis()
+    result.update((name, stats[name]) for name in perfstats.FIELDS)
+    result['return'] = endvalue / startvalue - 1.0
+    return result
+
+
+def runmatrixfile(args, modpath):
+    if args.out.lower().endswith('.parquet'):
+        # Fail now rather than after all the runs
+        import pandas
+        import pyarrow
+    matrix = runmatrix.load(args.matrix) or {}
+    jobs = matrixjobs(matrix, args, modpath)
+    cerebrokw = runmatrix.parse_kwargs(args.cerebro)
+    for job in jobs:
+        job['cerebro'] = cerebrokw
+
+    # Each file is parsed once, whole, and shared: the workers apply the
+    # dates
+    columns = dict()
+    for path in set(job['datapath'] for job in jobs):
+        columns[path] = shmfeed.SharedColumns(
+            feedcache.load(path, schema='yahoo'))
+
+    fields = list(MATRIX_FIELDS)
+    for section in ('strat', 'broker', 'sizer'):
+        for job in jobs:
+            for k in job[section]:
+                if '%s.%s' % (section, k) not in fields:
+                    fields.append('%s.%s' % (section, k))
+    fields.extend(RESULT_FIELDS)
+
+    print('%-12s %-8s %-10s %-10s %12s %9s %6s' % (
+        'Approach', 'Data', 'From', 'To', 'Final', 'Return', 'Trades'))
+
+    rows = []
+    cpus = args.cpus or multiprocessing.cpu_count()
+    chunksize = max(1, len(jobs) // (cpus * 4))
+    pool = multiprocessing.Pool(cpus, _matrix_init, (columns,))
+    try:
+        for job, result in zip(jobs, pool.imap(_matrix_run, jobs, chunksize)):
+            name = os.path.basename(job['datapath']).split('.')[0]
+            row = dict(result, approach=job['approach'], data=name,
+                       fromdate=job['fromdate'] and job['fromdate'].date(),
+                       todate=job['todate'] and job['todate'].date())
+            for section in ('strat', 'broker', 'sizer'):
+                for k, v in job[section].items():
+                    row['%s.%s' % (section, k)] = v
+            rows.append(row)
+
+            print('%-12s %-8s %-10s %-10s %12.2f %8.2f%% %6d' % (
+                row['approach'], row['data'], row['fromdate'], row['todate'],
+                row['endvalue'], row['return'] * 100.0, row['trades']))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        for shared in columns.values():
+            shared.close()
+
+    print('Runs: %d' % len(rows))
+    if args.out:
+        runmatrix.write(args.out, rows, fields)
+
+
+def runwalkforward(args, datapath, **kwargs):
+    import walkforward
+
+    StClass = APPROACHES[args.approach]
+    grid = []
+    for name in ('stop_loss', 'trail', 'buy_limit'):
+        text = getattr(args, name)
+        if not text:
+            continue
+        if name not in StClass.params._getkeys():
+            raise ValueError('%s has no param %s' % (StClass.__name__, name))
+        grid.append((name, walkforward.parse_grid(text)))
+
+    # The stop loss is ignored by the trailing stops: a single combination
+    # per trail value (with the default stop loss) is enough
+    combos = []
+    for params in walkforward.combinations(grid):
+        if params.get('trail'):
+            params.pop('stop_loss', None)
+        if params not in combos:
+            combos.append(params)
+
+    columns = feedcache.load(datapath, schema='yahoo', **kwargs)
+
+    def printwindow(result):
+        w = result['window']
+        dates = [bt.num2date(columns['datetime'][i]).date()
+                 for i in (w.isstart, w.oosstart, w.oosend - 1)]
+        params = ' '.join('%s=%g' % kv
+                          for kv in sorted(result['params'].items()))
+        print('%s %s %s %-40s %12.2f %8.2f%%' % (
+            dates[0], dates[1], dates[2], params, result['insample'],
+            result['return'] * 100.0))
+        sys.stdout.flush()
+
+    print('%-10s %-10s %-10s %-40s %12s %9s' % (
+        'IS from', 'OOS from', 'OOS to', 'Params', 'IS value', 'OOS ret'))
+
+    broker = runmatrix.parse_kwargs(args.broker)
+    results = walkforward.run(
+        StClass, columns, combos, args.insample, args.outsample,
+        warmup=args.warmup, strat=runmatrix.parse_kwargs(args.strat),
+        broker=broker, sizer=runmatrix.parse_kwargs(args.sizer),
+        cpus=args.cpus, callback=printwindow)
+
+    startcash = bt.brokers.BackBroker(**broker).startingcash
+    curve = walkforward.stitch(results, startcash)
+    print('Windows: %d, Out-of-sample bars: %d, Final value: %.2f (%.2f%%)' %
+          (len(results), len(curve), curve[-1][1],
+           (curve[-1][1] / startcash - 1.0) * 100.0))
+
+    if args.equity:
+        with open(args.equity, 'w') as f:
+            f.write('datetime,value\n')
+            for dt, value in curve:
+                f.write('%s,%.2f\n' % (bt.num2date(dt).date(), value))
+
+
 def runstrat(args=None):
     args = parse_args(args)
 
@@ -154,43 +406,52 @@ def runstrat(args=None):
     kwargs = dict()
 
     # Parse from/to-date
-    dtfmt, tmfmt = '%Y-%m-%d', 'T%H:%M:%S'
     for a, d in ((getattr(args, x), x) for x in ['fromdate', 'todate']):
         if a:
-            strpfmt = dtfmt + tmfmt * ('T' in a)
-            kwargs[d] = datetime.datetime.strptime(a, strpfmt)
+            kwargs[d] = parsedate(a)
 
-    #data0 = bt.feeds.BacktraderCSVData(dataname=args.data0, **kwargs)
+    # Datas are in a subfolder of the samples. Need to find where the script is
+    # because it could have been called from anywhere
     modpath = os.path.dirname(os.path.abspath(sys.argv[0]))
-    #datapath = os.path.join(modpath, 'data/PETR4.SA.csv')
-    datapath = os.path.join(modpath, 'data/ABEV3.SA.csv')
-
-    # Create a Data Feed
-    data = bt.feeds.YahooFinanceCSVData(
-        dataname=datapath,
-        # Do not pass values before this date
-        fromdate=datetime.datetime(2017, 9, 11),
-        # Do not pass values before this date
-        todate=datetime.datetime(2018, 9, 13),
-        # Do not pass values after this date
-        reverse=False)
+    datapath = os.path.join(modpath, args.data0)
+
+    if args.matrix:
+        runmatrixfile(args, modpath)
+        return
+
+    if args.walkforward:  # the whole history unless dates are given
+        runwalkforward(args, datapath, **kwargs)
+        return
+
+    # Do not pass values before/after these dates unless others are given
+    kwargs.setdefault('fromdate', FROMDATE)
+    kwargs.setdefault('todate', TODATE)
+
+    # Create a Data Feed (parsed once, then from the binary cache)
+    data = feedcache.YahooFinanceCSVData(datapath, reverse=False, **kwargs)
     cerebro.adddata(data)
 
     # Broker
-    cerebro.broker = bt.brokers.BackBroker(**eval('dict(' + args.broker + ')'))
+    cerebro.broker = bt.brokers.BackBroker(
+        **runmatrix.parse_kwargs(args.broker))
 
     # Sizer
-    cerebro.addsizer(bt.sizers.FixedSize, **eval('dict(' + args.sizer + ')'))
+    cerebro.addsizer(bt.sizers.FixedSize,
+                     **runmatrix.parse_kwargs(args.sizer))
 
     # Strategy
     StClass = APPROACHES[args.approach]
-    cerebro.addstrategy(StClass, **eval('dict(' + args.strat + ')'))
+    cerebro.addstrategy(StClass, **runmatrix.parse_kwargs(args.strat))
+
+    # Equity curve metrics, computed after the run
+    cerebro.addanalyzer(perfstats.Curve, _name='curve')
 
     # Execute
-    cerebro.run(**eval('dict(' + args.cerebro + ')'))
+    strat = cerebro.run(**runmatrix.parse_kwargs(args.cerebro))[0]
+    print(perfstats.report(strat.analyzers.curve.get_analysis()))
 
     if args.plot:  # Plot if requested to
-        cerebro.plot(**eval('dict(' + args.plot + ')'))
+        cerebro.plot(**runmatrix.parse_kwargs(args.plot))
 
 
 def parse_args(pargs=None):
@@ -201,12 +462,13 @@ def parse_args(pargs=None):
         )
     )
 
-    parser.add_argument('--data0', default='../data/PETR4.SA.csv',
-                        required=False, help='Data to read in')
+    parser.add_argument('--data0', default='../data/ABEV3.SA.csv',
+                        required=False,
+                        help='Data to read in (relative to this script)')
 
     # Strategy to choose
-    parser.add_argument('approach', choices=APPROACHES.keys(),
-                        help='Stop approach to use')
+    parser.add_argument('approach', choices=APPROACHES.keys(), nargs='?',
+                        help='Stop approach to use (not with --matrix)')
 
     # Defaults for dates
     parser.add_argument('--fromdate', required=False, default='',
@@ -231,7 +493,51 @@ def parse_args(pargs=None):
                         nargs='?', const='{}',
                         metavar='kwargs', help='kwargs in key=value format')
 
-    return parser.parse_args(pargs)
+    # Walk-forward optimization
+    parser.add_argument('--walkforward', required=False, action='store_true',
+                        help=('Optimize on rolling in-sample windows and '
+                              'trade the winners out-of-sample'))
+
+    parser.add_argument('--insample', required=False, default=500, type=int,
+                        help='Bars of each in-sample window')
+
+    parser.add_argument('--outsample', required=False, default=125, type=int,
+                        help='Bars of each out-of-sample window (the step)')
+
+    parser.add_argument('--warmup', required=False, default=50, type=int,
+                        help='Bars fed before each window to prime indicators')
+
+    parser.add_argument('--stop-loss', dest='stop_loss', required=False,
+                        default='0.01:0.05:0.01',
+                        help='stop_loss values, i.e.: 0.01:0.05:0.01,0.08')
+
+    parser.add_argument('--trail', required=False, default='0,1,2,3',
+                        help='trail values (0: no trailing), i.e.: 0,1:3')
+
+    parser.add_argument('--buy-limit', dest='buy_limit', required=False,
+                        default='',
+                        help='buy_limit values (0: market), i.e.: 0,0.005')
+
+    parser.add_argument('--cpus', required=False, default=None, type=int,
+                        help='Worker processes (default: number of cores)')
+
+    parser.add_argument('--equity', required=False, default='',
+                        help='Write the stitched out-of-sample equity to CSV')
+
+    # Run matrix
+    parser.add_argument('--matrix', required=False, default='',
+                        metavar='FILE',
+                        help=('YAML/JSON file with the runs to make in a '
+                              'process pool (see runmatrix.py)'))
+
+    parser.add_argument('--out', required=False, default='',
+                        help='Write the matrix results to a CSV/Parquet file')
+
+    args = parser.parse_args(pargs)
+    if not args.approach and not args.matrix:
+        parser.error('an approach is needed unless --matrix is given')
+
+    return args
 
 
 if __name__ == '__main__':
@@ -241,3 +547,7 @@ if __name__ == '__main__':
 #https://www.backtrader.com/blog/posts/2018-02-01-stop-trading/stop-trading.html
 
 #python stop-trading.py --fromdate=2017-10-1 --todate=2018-09-14 auto --plot --strat trail=3,buy_limit=0.005
+
+#python stop-trading.py auto --walkforward --buy-limit 0,0.005 --equity wf.csv
+
+#python stop-trading.py --matrix matrix.yaml --out results.csv
@@ -0,0 +1,194 @@
+'''
+Logging for the strategy callbacks
+
+Strategies mix in ``LoggerMixin`` and call ``self.debug``, ``self.info``,
+``self.warn`` or ``self.error`` with a format string and its arguments::
+
+    self.debug('Close, %.2f', self.dataclose[0])
+
+The arguments are only formatted when a record is actually written. A call
+for a disabled level costs a comparison (or, if a ring buffer is active, a
+tuple appended to a ``deque``): no ``isoformat``, no ``%`` and no I/O.
+
+The records go to the process wide logger installed with ``configure``:
+
+  - ``level``: records below it are not written to the sink
+  - ``ringsize``: the last ``ringsize`` records of *any* level are kept
+    unformatted in memory and can be dumped after the fact, i.e. when a run
+    fails
+  - ``sink``: a path or a stream. Records are written in batches of
+    ``batchsize`` lines
+  - ``binary``: the sink receives the unformatted records (pickled
+    batches), which ``readlog`` turns back into text later. Without a sink
+    they go to the binary buffer of stdout
+
+Used as a context manager, ``configure`` restores the previous logger on
+exit, flushing its sink and dumping the ring buffer to stderr if an
+exception went through::
+
+    with stratlog.configure(level=stratlog.WARN, ringsize=500):
+        cerebro.run()
+
+By default everything is printed to stdout as the examples always did.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import pickle
+import sys
+
+# Import the backtrader platform
+import backtrader as bt
+
+
+DEBUG, INFO, WARN, ERROR = 10, 20, 30, 40
+
+LEVELS = dict(DEBUG=DEBUG, INFO=INFO, WARN=WARN, ERROR=ERROR)
+
+
+def formatrecord(record):
+    '''Text of a ``(level, dt, fmt, args)`` record as the examples print it'''
+    level, dt, fmt, args = record
+    txt = fmt % args if args else fmt
+    if dt is None:
+        return txt
+    return '%s, %s' % (bt.num2date(dt).date().isoformat(), txt)
+
+
+class Logger(object):
+    '''
+    Keeps the level, the ring buffer and the (batched) sink of the strategy
+    records. See the module documentation for the parameters
+    '''
+    def __init__(self, level=DEBUG, ringsize=0, sink=None, batchsize=256,
+                 binary=False):
+        self.level = LEVELS.get(level, level)
+        self.ringsize = ringsize
+        self.ring = collections.deque(maxlen=ringsize) if ringsize else None
+        self.binary = binary
+
+        self._ownsink = isinstance(sink, str)
+        if self._ownsink:
+            sink = open(sink, 'ab' if binary else 'a')
+        self.sink = sink
+        self.batchsize = batchsize
+        self.batch = []
+        self._previous = None
+
+    def record(self, level, dt, fmt, args):
+        '''Stores a record. Formatting is deferred until it is written'''
+        rec = (level, dt, fmt, args)
+        if self.ring is not None:
+            self.ring.append(rec)
+
+        if level < self.level:
+            return
+
+        self.batch.append(rec)
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        sink = self.sink or sys.stdout
+        if self.binary:
+            if sink is sys.stdout:  # pickles are bytes: to its buffer
+                sys.stdout.flush()
+                sink = sys.stdout.buffer
+            pickle.dump(batch, sink, pickle.HIGHEST_PROTOCOL)
+        else:
+            sink.write(''.join(formatrecord(r) + '\n' for r in batch))
+        sink.flush()
+
+    def dump(self, stream=None):
+        '''Writes the (formatted) contents of the ring buffer'''
+        stream = stream or sys.stderr
+        for rec in self.ring or ():
+            stream.write(formatrecord(rec) + '\n')
+        stream.flush()
+
+    def close(self):
+        self.flush()
+        if self._ownsink:
+            self.sink.close()
+            self._ownsink = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        global logger
+        if exctype is not None and self.ring:
+            sys.stderr.write('Last %d log records:\n' % len(self.ring))
+            self.dump()
+
+        self.close()
+        if self._previous is not None:
+            logger = self._previous
+            self._previous = None
+
+
+# Default: everything printed to stdout as soon as it is logged
+logger = Logger(level=DEBUG, batchsize=1)
+
+
+def configure(level=DEBUG, ringsize=0, sink=None, batchsize=256,
+              binary=False):
+    '''
+    Installs (and returns) a new process wide logger. The previous one is
+    flushed and restored when the new one is used as a context manager
+    '''
+    global logger
+    previous = logger
+    previous.flush()
+
+    logger = Logger(level=level, ringsize=ringsize, sink=sink,
+                    batchsize=batchsize, binary=binary)
+    logger._previous = previous
+    return logger
+
+
+def readlog(path):
+    '''Yields the text lines of a log written with ``binary=True``'''
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                break
+
+            for rec in batch:
+                yield formatrecord(rec)
+
+
+class LoggerMixin(object):
+    '''
+    Logging methods for strategies. Records are stamped with the datetime
+    of the first data feed
+    '''
+    def _logrecord(self, level, fmt, args):
+        lg = logger
+        if level < lg.level and lg.ring is None:
+            return  # disabled: nothing is evaluated nor formatted
+
+        lg.record(level, self.datas[0].datetime[0], fmt, args)
+
+    def debug(self, fmt, *args):
+        self._logrecord(DEBUG, fmt, args)
+
+    def info(self, fmt, *args):
+        self._logrecord(INFO, fmt, args)
+
+    def warn(self, fmt, *args):
+        self._logrecord(WARN, fmt, args)
+
+    def error(self, fmt, *args):
+        self._logrecord(ERROR, fmt, args)
+
+    def log(self, fmt, *args):
+        ''' Logging function for this strategy'''
+        self._logrecord(INFO, fmt, args)
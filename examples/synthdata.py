@@ -0,0 +1,353 @@
+'''
+Synthetic OHLCV series of any length for scaling and soak tests
+
+Prices follow a geometric brownian motion whose volatility switches between
+regimes (a Markov chain: calm, normal, stressed). Sessions may open with a
+gap over the previous close, intrabar highs and lows spread around the
+open/close body and volume clusters (log-volume is an AR(1) process which
+also rises with the size of the move). A slow pull of the log price back
+to the starting price keeps very long series in a tradable range.
+
+Bars are produced in chunks of ``CHUNK`` bars and streamed to disk, so the
+memory in use does not depend on the length of the series. Each chunk has
+its own random generator seeded with ``(seed, chunk number)``, so a given
+seed always produces the same series and a shorter series is the start of
+a longer one.
+
+Frequencies are given as ``1d`` (business days) or as intraday steps
+(``1min``, ``5min``, ``1h``, ``30s``) inside a ``10:00-17:00`` session.
+
+Output formats:
+
+  - ``yahoo``: ``Date,Open,High,Low,Close,Adj Close,Volume`` as in ``data/``
+  - ``alphavantage``: the layout kept by alpha_vantage_update.py
+  - ``binary``: the columnar ``.npy`` used by feedcache.py, which ``load``
+    memory-maps for ``memfeed.MemoryData``
+
+The CSV formats carry dates only (their feeds would merge the bars of a
+day): intraday series are written in ``binary`` only.
+
+Usage::
+
+    python synthdata.py --bars 100000000 --freq 1min --seed 7 \\
+        --format binary --out soak.npy
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import array
+import datetime
+import math
+import os
+import os.path
+import re
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+import alpha_vantage_update
+import memfeed
+
+
+CHUNK = 1 << 16  # bars generated at once
+
+FORMATS = ('yahoo', 'alphavantage', 'binary')
+
+YAHOO_HEADER = ['Date', 'Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+
+# Annualized volatility of each regime and mean regime length (in days)
+REGIMES = (0.10, 0.20, 0.40)
+REGIME_DAYS = 60.0
+
+SESSION = (datetime.time(10, 0), datetime.time(17, 0))
+TRADING_DAYS = 252
+
+_DTBASE = np.datetime64('0001-01-01', 's')  # backtrader's day number 1
+
+# Daily bars are stamped at the end of the session, as the CSV feeds do
+_EOD = bt.utils.dateintern.TIME_MAX
+_EODFRAC = math.fsum((_EOD.hour / 24.0, _EOD.minute / 1440.0,
+                      _EOD.second / 86400.0, _EOD.microsecond / 86400e6))
+
+
+def parsefreq(freq):
+    '''Bar length in seconds for ``1d``, ``5min``, ``1h``, ``30s`` ...'''
+    m = re.match(r'^(\d*)(d|h|min|s)$', freq)
+    if not m:
+        raise ValueError('Invalid frequency: %s' % freq)
+
+    n = int(m.group(1) or 1)
+    return n * dict(d=86400, h=3600, min=60, s=1)[m.group(2)]
+
+
+class Generator(object):
+    '''
+    Iterates over the chunks of a synthetic series. Each chunk is a dict of
+    NumPy arrays: ``datetime`` (``datetime64[s]``), ``open``, ``high``,
+    ``low``, ``close`` and ``volume``
+
+      - ``bars``: length of the series
+      - ``seed``: seed of the random generators
+      - ``freq``: bar frequency (see ``parsefreq``)
+      - ``start``: first trading day (moved forward to a weekday)
+      - ``price``: first open
+      - ``drift``: annualized drift
+      - ``reversion``: annualized speed of the pull back to ``price``
+      - ``regimes``: annualized volatility of each regime
+      - ``gapprob``: probability of a gap at the opening of a session
+      - ``gapsize``: size of the gaps in bar volatilities
+      - ``volume``: mean volume of a day, split among its bars
+    '''
+    def __init__(self, bars, seed=0, freq='1d',
+                 start=datetime.date(2000, 1, 3), price=100.0, drift=0.05,
+                 reversion=0.1, regimes=REGIMES, gapprob=0.05, gapsize=3.0,
+                 volume=1e6):
+        self.bars = bars
+        self.seed = seed
+        self.step = parsefreq(freq)
+        self.price = price
+        self.regimes = np.asarray(regimes, dtype=np.float64)
+        self.gapprob = gapprob
+        self.gapsize = gapsize
+        self.volume = volume
+
+        while start.weekday() >= 5:
+            start += datetime.timedelta(days=1)
+        # Business days are counted from the Monday of the first week
+        self.offset = start.weekday()
+        self.monday = np.datetime64(
+            start - datetime.timedelta(days=self.offset), 'D')
+
+        if self.step >= 86400:
+            self.perday = 1
+            self.opening = 0
+        else:
+            t0, t1 = [t.hour * 3600 + t.minute * 60 for t in SESSION]
+            self.perday = (t1 - t0) // self.step
+            self.opening = t0
+            if not self.perday:
+                raise ValueError('Bars longer than the session: %s' % freq)
+
+        # Per bar drift and volatilities
+        dt = 1.0 / (TRADING_DAYS * self.perday)
+        self.sqdt = np.sqrt(dt)
+        self.mu = drift * dt
+        self.phi = 1.0 - reversion * dt
+        self.pswitch = 1.0 / (REGIME_DAYS * self.perday)
+
+        last = self.timestamps(np.array([bars - 1]))[0]
+        if last > np.datetime64('9999-12-31'):
+            raise ValueError('%d bars of %s go beyond the year 9999' % (
+                bars, freq))
+
+    def timestamps(self, idx):
+        '''Timestamps of the bars with the given indices'''
+        day, slot = np.divmod(idx, self.perday)
+        weeks, dow = np.divmod(day + self.offset, 5)
+        days = self.monday + (7 * weeks + dow).astype('timedelta64[D]')
+
+        secs = self.opening + slot * self.step
+        return days.astype('datetime64[s]') + secs.astype('timedelta64[s]')
+
+    def datenums(self, dts):
+        '''backtrader date numbers of the ``datetime64`` timestamps'''
+        nums = (dts.astype('datetime64[s]') - _DTBASE) / \
+            np.timedelta64(1, 'D') + 1.0
+        if self.perday == 1:
+            nums += _EODFRAC
+        return nums
+
+    def __iter__(self):
+        close, regime, logvol = self.price, 1, 0.0
+        for n, first in enumerate(range(0, self.bars, CHUNK)):
+            rng = np.random.default_rng((self.seed, n))
+            chunk, (close, regime, logvol) = self._chunk(
+                rng, first, close, regime, logvol)
+
+            size = min(CHUNK, self.bars - first)
+            if size < CHUNK:
+                chunk = dict((k, v[:size]) for k, v in chunk.items())
+            yield chunk
+
+    def _chunk(self, rng, first, close, regime, logvol):
+        # Every draw has the full chunk size, so that the values of a bar do
+        # not depend on where the series ends
+        z = rng.standard_normal(CHUNK)
+        switch = rng.random(CHUNK) < self.pswitch
+        jump = rng.integers(1, len(self.regimes), CHUNK)
+        gaps = rng.random(CHUNK) < self.gapprob
+        gapz = rng.standard_normal(CHUNK)
+        wicks = np.abs(rng.standard_normal((2, CHUNK)))
+        volz = rng.standard_normal(CHUNK)
+
+        # Regime chain: at each switch move to one of the other regimes
+        regimes = (regime + np.cumsum(np.where(switch, jump, 0))) % \
+            len(self.regimes)
+        sigma = self.regimes[regimes] * self.sqdt
+
+        # Gaps only at the opening of a session
+        idx = np.arange(first, first + CHUNK)
+        gaps &= (idx % self.perday) == 0
+        gapret = np.where(gaps, self.gapsize * sigma * gapz, 0.0)
+        ret = self.mu - 0.5 * sigma * sigma + sigma * z
+
+        logp0 = np.log(self.price)
+        logc = logp0 + ar1(gapret + ret, self.phi, np.log(close) - logp0)
+        c = np.exp(logc)
+        o = np.exp(logc - ret)  # previous close plus the gap
+        h = np.maximum(o, c) * np.exp(0.5 * sigma * wicks[0])
+        l = np.minimum(o, c) * np.exp(-0.5 * sigma * wicks[1])
+
+        # Clustered volume: AR(1) log-volume plus the size of the move
+        logv = ar1(0.3 * volz, 0.95, logvol)
+        v = np.round(self.volume / self.perday *
+                     np.exp(logv + 0.5 * np.abs(z) * sigma / self.regimes[1] /
+                            self.sqdt))
+
+        chunk = dict(datetime=self.timestamps(idx), open=o, high=h, low=l,
+                     close=c, volume=v)
+        return chunk, (c[-1], regimes[-1], logv[-1])
+
+
+def ar1(noise, phi, x0, block=128):
+    '''
+    ``x[t] = phi * x[t - 1] + noise[t]`` with ``x[-1] = x0``, computed in
+    blocks in closed form (``phi ** -k`` stays small inside a block)
+    '''
+    out = np.empty(len(noise))
+    powers = phi ** np.arange(1, block + 1)
+    for i in range(0, len(noise), block):
+        e = noise[i:i + block]
+        p = powers[:len(e)]
+        out[i:i + block] = p * (x0 + np.cumsum(e / p))
+        x0 = out[i + len(e) - 1]
+    return out
+
+
+def _csvlines(chunk, header):
+    names = dict(Open='open', High='high', Low='low', Close='close',
+                 Volume='volume')
+    names['Adj Close'] = 'close'
+    names.update((h, h.split(' ')[-1]) for h in header if '. ' in h)
+
+    cols = [np.datetime_as_string(chunk['datetime'], unit='D').tolist()]
+    for h in header[1:]:
+        col = chunk[names[h]]
+        cols.append((col.astype(np.int64) if h.endswith('olume') else
+                     np.round(col, 6)).tolist())
+
+    return ''.join('%s\n' % ','.join(map(str, row)) for row in zip(*cols))
+
+
+def write(path, bars, fmt='yahoo', **kwargs):
+    '''
+    Streams a series of ``bars`` (see ``Generator`` for the ``kwargs``) to
+    ``path`` in ``fmt`` (one of ``FORMATS``). The file is written aside and
+    renamed when complete
+    '''
+    if fmt not in FORMATS:
+        raise ValueError('Unsupported format: %s' % fmt)
+
+    gen = Generator(bars, **kwargs)
+    if fmt != 'binary' and gen.perday > 1:
+        raise ValueError('The %s format has no time of the day: intraday '
+                         'bars are written in binary only' % fmt)
+
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if fmt == 'binary':
+            table = np.lib.format.open_memmap(
+                tmppath, mode='w+', dtype=np.float64,
+                shape=(len(memfeed.COLUMNS), bars))
+            first = 0
+            for chunk in gen:
+                last = first + len(chunk['close'])
+                for i, name in enumerate(memfeed.COLUMNS):
+                    if name == 'datetime':
+                        table[i, first:last] = gen.datenums(
+                            chunk['datetime'])
+                    elif name == 'openinterest':
+                        table[i, first:last] = 0.0
+                    else:
+                        table[i, first:last] = chunk[name]
+                table.flush()  # bounded: written pages can be dropped
+                first = last
+            del table
+        else:
+            header = (YAHOO_HEADER if fmt == 'yahoo' else
+                      alpha_vantage_update.HEADER)
+            with open(tmppath, 'w') as f:
+                f.write(','.join(header) + '\n')
+                for chunk in gen:
+                    f.write(_csvlines(chunk, header))
+
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    return path
+
+
+def load(path):
+    '''Memory-mapped columns (see memfeed) of a ``binary`` file'''
+    table = np.load(path, mmap_mode='r')
+    return dict((name, table[i]) for i, name in enumerate(memfeed.COLUMNS))
+
+
+def columns(bars, **kwargs):
+    '''The series as in-memory columns for ``memfeed.MemoryData``'''
+    gen = Generator(bars, **kwargs)
+    cols = dict((name, array.array(str('d'))) for name in memfeed.COLUMNS)
+    for chunk in gen:
+        for name in memfeed.COLUMNS:
+            if name == 'datetime':
+                col = gen.datenums(chunk['datetime'])
+            elif name == 'openinterest':
+                col = np.zeros(len(chunk['close']))
+            else:
+                col = chunk[name]
+            cols[name].frombytes(np.ascontiguousarray(col, np.float64)
+                                 .tobytes())
+    return cols
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Generate a synthetic OHLCV series')
+
+    parser.add_argument('--bars', required=False, default=1000000, type=int,
+                        help='Number of bars')
+
+    parser.add_argument('--freq', required=False, default='1d',
+                        help='Bar frequency: 1d, 1h, 5min, 1min, 30s ...')
+
+    parser.add_argument('--seed', required=False, default=0, type=int,
+                        help='Seed of the random generators')
+
+    parser.add_argument('--start', required=False, default='2000-01-03',
+                        help='First day in YYYY-MM-DD format')
+
+    parser.add_argument('--price', required=False, default=100.0,
+                        type=float, help='Starting price')
+
+    parser.add_argument('--format', required=False, default='yahoo',
+                        choices=FORMATS, help='Output format')
+
+    parser.add_argument('--out', required=False, default='synthetic.csv',
+                        help='Output file')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start = datetime.datetime.strptime(args.start, '%Y-%m-%d').date()
+    write(args.out, args.bars, fmt=args.format, seed=args.seed,
+          freq=args.freq, start=start, price=args.price)
+    print('%d bars written to %s' % (args.bars, args.out))
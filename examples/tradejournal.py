@@ -0,0 +1,330 @@
+'''
+Columnar journal of the orders and trades of a run, and analytics over
+many of them
+
+The strategies report their fills and trades as printed lines (``BUY
+EXECUTED, ...``, ``OPERATION PROFIT, ...``), which can only be grepped.
+``Journal`` is an analyzer which records every order notification (each
+state change of an order) and every closed trade into preallocated typed
+arrays and, when the run stops, writes them to a compressed columnar file
+(NumPy ``.npz``)::
+
+    cerebro.addanalyzer(tradejournal.Journal, path='journals/')
+
+``path`` is the file or, if it is a directory, the directory in which
+each run writes its own file (as sweeps do: the params of the strategy are
+saved with the columns). Nothing is printed.
+
+``load`` concatenates the journals of many runs and the summaries are
+computed over all their trades at once (NumPy, no Python loop per trade):
+
+  - ``summary``: trades, win rate, expectancy (mean net PnL of a trade),
+    average win/loss, profit factor and net PnL
+  - ``holding``: histogram of the holding periods (bars)
+  - ``groupby``: trades, wins and net PnL per symbol (or per run)
+
+From the command line::
+
+    python universe.py petr4_backtrader:TestStrategy --journal journals/
+    python tradejournal.py journals/ --bins 1,2,5,10,20,50
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import os.path
+
+import numpy as np
+
+# Import the backtrader platform
+import backtrader as bt
+
+
+ORDER_FIELDS = (
+    ('dt', 'f8'),  # date number of the notification
+    ('symbol', 'i4'),  # index in the symbols of the journal
+    ('ref', 'i8'),
+    ('side', 'i1'),  # 0: buy, 1: sell (bt.Order.Buy/Sell)
+    ('exectype', 'i1'),  # bt.Order.ExecTypes
+    ('status', 'i1'),  # bt.Order.Status
+    ('size', 'f8'),  # executed so far, created if nothing is
+    ('price', 'f8'),  # executed so far, created if nothing is
+    ('value', 'f8'),
+    ('comm', 'f8'),
+)
+
+TRADE_FIELDS = (
+    ('symbol', 'i4'),
+    ('ref', 'i8'),
+    ('long', 'i1'),
+    ('dtopen', 'f8'),
+    ('dtclose', 'f8'),
+    ('barlen', 'i4'),
+    ('size', 'f8'),  # size when opened
+    ('price', 'f8'),  # average entry price
+    ('pnl', 'f8'),
+    ('pnlcomm', 'f8'),
+    ('comm', 'f8'),
+)
+
+HOLDING_BINS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Columns(object):
+    '''
+    Rows of ``fields`` (``[(name, dtype), ...]``) in a preallocated
+    structured array which doubles when full
+    '''
+    def __init__(self, fields, capacity=1024):
+        self.rows = np.zeros(capacity, dtype=list(fields))
+        self.size = 0
+
+    def append(self, row):
+        if self.size == len(self.rows):
+            rows = np.zeros(2 * len(self.rows), dtype=self.rows.dtype)
+            rows[:self.size] = self.rows
+            self.rows = rows
+
+        self.rows[self.size] = row
+        self.size += 1
+
+    def columns(self):
+        '''Name -> array of the rows appended'''
+        rows = self.rows[:self.size]
+        return dict((name, np.ascontiguousarray(rows[name]))
+                    for name in rows.dtype.names)
+
+
+def _jsonable(value):
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+class Journal(bt.Analyzer):
+    '''
+    Records the orders and closed trades of the strategy and writes them to
+    ``path`` (a file or a directory) when the run stops. ``capacity`` is
+    the number of rows preallocated (doubled as needed)
+    '''
+    params = dict(path='', capacity=1024)
+
+    def start(self):
+        self.orders = Columns(ORDER_FIELDS, self.p.capacity)
+        self.trades = Columns(TRADE_FIELDS, self.p.capacity)
+        self.sizes = dict()  # trade ref -> size when opened
+        self.symbols = [self.symbolname(i, data)
+                        for i, data in enumerate(self.strategy.datas)]
+        self.dataids = dict((id(data), i)
+                            for i, data in enumerate(self.strategy.datas))
+        self.written = ''
+
+    @staticmethod
+    def symbolname(i, data):
+        '''ABEV3 for data/ABEV3.SA.csv, else the name of the feed'''
+        if isinstance(data.p.dataname, str):
+            import universe
+            return universe.symbolname(data.p.dataname)
+        return data._name or 'data%d' % i
+
+    def notify_order(self, order):
+        done = order.executed.size != 0
+        info = order.executed if done else order.created
+        self.orders.append((
+            order.data.datetime[0], self.dataids.get(id(order.data), -1),
+            order.ref, order.ordtype, order.exectype, order.status,
+            info.size, info.price, order.executed.value,
+            order.executed.comm))
+
+    def notify_trade(self, trade):
+        if trade.justopened:
+            self.sizes[trade.ref] = trade.size
+
+        if trade.isclosed:
+            self.trades.append((
+                self.dataids.get(id(trade.data), -1), trade.ref,
+                trade.long, trade.dtopen, trade.dtclose, trade.barlen,
+                self.sizes.pop(trade.ref, 0.0), trade.price, trade.pnl,
+                trade.pnlcomm, trade.commission))
+
+    def stop(self):
+        if self.p.path:
+            self.written = self.write(self.p.path)
+
+    def write(self, path):
+        '''Writes the journal to ``path`` (see the class). Returns the file'''
+        if os.path.isdir(path):
+            for n in itertools.count():
+                name = os.path.join(path, 'journal-%d-%d.npz' % (
+                    os.getpid(), n))
+                if not os.path.exists(name):
+                    path = name
+                    break
+
+        params = dict((k, _jsonable(v))
+                      for k, v in self.strategy.params._getitems())
+        arrays = dict(symbols=np.array(self.symbols, dtype=str),
+                      strategy=np.array(type(self.strategy).__name__),
+                      params=np.array(json.dumps(params, sort_keys=True)))
+        for prefix, cols in (('orders', self.orders), ('trades', self.trades)):
+            for name, col in cols.columns().items():
+                arrays['%s.%s' % (prefix, name)] = col
+
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        return path
+
+    def get_analysis(self):
+        return dict(orders=self.orders.size, trades=self.trades.size,
+                    path=self.written)
+
+
+def journals(paths):
+    '''The journal files in ``paths`` (files, directories or globs)'''
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(glob.glob(os.path.join(path, '*.npz'))))
+        elif os.path.exists(path):
+            result.append(path)
+        else:
+            result.extend(sorted(glob.glob(path)))
+    return result
+
+
+def load(paths):
+    '''
+    The journals in ``paths`` as one, a dict with:
+
+      - ``orders``, ``trades``: name -> concatenated column, with a ``run``
+        column (index in ``runs``) and ``symbol`` indexing ``symbols``
+      - ``symbols``: the names of the symbols of all the runs
+      - ``runs``: ``(path, strategy, params)`` of each journal
+    '''
+    runs, names = [], []
+    parts = dict(orders=[], trades=[])
+    for run, path in enumerate(journals(paths)):
+        with np.load(path) as npz:
+            names.append([str(name) for name in npz['symbols']])
+            runs.append((path, str(npz['strategy']),
+                         json.loads(str(npz['params']))))
+            for prefix in parts:
+                cols = dict((key.split('.', 1)[1], npz[key])
+                            for key in npz.files
+                            if key.startswith(prefix + '.'))
+                cols['run'] = np.full(len(cols['symbol']), run, dtype='i4')
+                parts[prefix].append(cols)
+
+    # The symbols of each run renumbered into those of all the runs
+    symbols = sorted(set(itertools.chain([''], *names)))
+    index = dict((name, i) for i, name in enumerate(symbols))
+    tables = [np.array([index[name] for name in runnames] + [index['']],
+                       dtype='i4') for runnames in names]  # -1: unknown
+
+    result = dict(runs=runs, symbols=symbols)
+    for prefix, fields in (('orders', ORDER_FIELDS), ('trades', TRADE_FIELDS)):
+        merged = dict()
+        for name, dtype in list(fields) + [('run', 'i4')]:
+            merged[name] = np.concatenate(
+                [tables[c['run'][0]][c[name]] if name == 'symbol' and
+                 len(c[name]) else c[name] for c in parts[prefix]] or
+                [np.zeros(0, dtype=dtype)])
+
+        result[prefix] = merged
+
+    return result
+
+
+def summary(trades):
+    '''Win rate, expectancy and the like of the ``trades`` columns'''
+    pnl = trades['pnlcomm']
+    won, lost = pnl[pnl > 0.0], pnl[pnl <= 0.0]
+    count = len(pnl)
+    grossloss = -lost.sum()
+    return dict(
+        trades=count, won=len(won), lost=len(lost),
+        winrate=len(won) / count if count else float('nan'),
+        expectancy=pnl.mean() if count else float('nan'),
+        avgwin=won.mean() if len(won) else float('nan'),
+        avgloss=lost.mean() if len(lost) else float('nan'),
+        profitfactor=won.sum() / grossloss if grossloss else float('inf'),
+        pnl=pnl.sum())
+
+
+def holding(trades, bins=HOLDING_BINS):
+    '''
+    Counts of trades per holding period: ``[(low, high, count), ...]``,
+    ``high`` excluded, the last bin open ended
+    '''
+    edges = list(bins) + [np.inf]
+    counts = np.histogram(trades['barlen'], bins=[0] + edges)[0]
+    lows = [0] + list(bins)
+    return list(zip(lows, edges, counts.tolist()))
+
+
+def groupby(trades, key='symbol'):
+    '''
+    Trades, wins and net PnL per value of the ``key`` column (an index, as
+    ``symbol`` or ``run``): ``[(value, trades, won, pnl), ...]``
+    '''
+    keys = trades[key]
+    if not len(keys):
+        return []
+
+    size = int(keys.max()) + 1
+    count = np.bincount(keys, minlength=size)
+    won = np.bincount(keys, weights=trades['pnlcomm'] > 0.0, minlength=size)
+    pnl = np.bincount(keys, weights=trades['pnlcomm'], minlength=size)
+    return [(int(i), int(count[i]), int(won[i]), float(pnl[i]))
+            for i in np.nonzero(count)[0]]
+
+
+def runreport(args=None):
+    args = parse_args(args)
+
+    journal = load(args.paths)
+    trades = journal['trades']
+    print('Runs: %d, Orders: %d' % (len(journal['runs']),
+                                    len(journal['orders']['ref'])))
+
+    s = summary(trades)
+    print('Trades: %d, Won: %d, Win rate: %.2f%%, Expectancy: %.2f, '
+          'Avg win: %.2f, Avg loss: %.2f, Profit factor: %.2f, PnL: %.2f' % (
+              s['trades'], s['won'], s['winrate'] * 100.0, s['expectancy'],
+              s['avgwin'], s['avgloss'], s['profitfactor'], s['pnl']))
+
+    print('\n%-12s %8s' % ('Bars held', 'Trades'))
+    bins = [int(b) for b in args.bins.split(',')]
+    for low, high, count in holding(trades, bins):
+        span = '%d+' % low if high == np.inf else '%d-%d' % (low, high - 1)
+        print('%-12s %8d' % (span, count))
+
+    print('\n%-12s %8s %6s %12s' % ('Symbol', 'Trades', 'Won', 'PnL'))
+    for i, count, won, pnl in groupby(trades, 'symbol'):
+        print('%-12s %8d %6d %12.2f' % (journal['symbols'][i], count, won,
+                                        pnl))
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Summaries of trade journals')
+
+    parser.add_argument('paths', nargs='+',
+                        help='Journal files, directories or globs')
+
+    parser.add_argument('--bins', required=False,
+                        default=','.join(str(b) for b in HOLDING_BINS),
+                        help='Lower bounds (bars) of the holding periods')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runreport()
@@ -0,0 +1,307 @@
+'''
+Runs one strategy over a universe of symbols, one backtest per symbol
+
+Each symbol is backtested independently (own cerebro, own cash) in a worker
+of a process pool sized to the cores. Rows of the report are printed as
+soon as each symbol finishes and the merged per-symbol report is printed
+(and optionally written to a CSV file) at the end.
+
+With ``--charts DIR`` each worker also renders the chart of its symbol
+(see chartrender.py) without opening any window.
+
+With ``--journal DIR`` the orders and trades of each symbol are written to
+a columnar journal in ``DIR`` (see tradejournal.py).
+
+With ``--store DIR`` the symbols are read from a bar store (see
+barstore.py) instead of CSV files: only the years between ``--fromdate``
+and ``--todate`` are read. Without ``--symbols`` all those in the store
+are run.
+
+With ``--prune`` the indicators which neither the strategy logic nor (with
+``--charts``) the charts read are not calculated (see deadind.py).
+
+The strategy is given as ``module:Class`` and the symbols either by name
+(looked up in ``data/`` as ``NAME.csv`` or ``NAME.SA.csv``), as paths or as a
+glob::
+
+    python universe.py bollinger_bands_emuriba:TestStrategy \\
+        --symbols ABEV3,PETR4,VALE3 --fromdate 2015-01-01 --stake 1000
+
+    python universe.py petr4_backtrader:TestStrategy --glob '../data/*.csv'
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import contextlib
+import csv
+import datetime
+import glob
+import importlib
+import multiprocessing
+import os
+import os.path
+import sys
+
+# Import the backtrader platform
+import backtrader as bt
+
+import runmatrix
+import stratlog
+
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data')
+
+FIELDS = ('symbol', 'bars', 'startvalue', 'endvalue', 'pnl', 'return',
+          'trades', 'won')
+
+
+def loadclass(spec):
+    '''Returns the class for a ``module:Class`` specification'''
+    modname, clsname = spec.split(':')
+    return getattr(importlib.import_module(modname), clsname)
+
+
+def symbolpath(symbol, datadir=DATADIR):
+    '''Returns the CSV file for a symbol name or path'''
+    if os.path.exists(symbol):
+        return symbol
+
+    for fmt in ('%s.csv', '%s.SA.csv'):
+        path = os.path.join(datadir, fmt % symbol)
+        if os.path.exists(path):
+            return path
+
+    raise ValueError('No data found for symbol %s in %s' % (symbol, datadir))
+
+
+def symbolname(path):
+    '''ABEV3 for data/ABEV3.SA.csv'''
+    name = os.path.basename(path)
+    for ext in ('.csv', '.SA'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def runsymbol(job):
+    '''
+    Backtests a single symbol. ``job`` is a tuple with the symbol path and
+    the dict of run options. Returns a dict with the ``FIELDS`` of the
+    report
+    '''
+    path, opts = job
+
+    # Observers (value, buy/sell, trades) are only needed for the charts
+    cerebro = bt.Cerebro(stdstats=bool(opts['charts']))
+    cerebro.addstrategy(loadclass(opts['strategy']), **opts['strat'])
+
+    kwargs = dict(reverse=False, fromdate=opts['fromdate'],
+                  todate=opts['todate'])
+    if opts['store']:
+        import barstore
+        data = barstore.Store(opts['store']).feed(
+            path, fromdate=opts['fromdate'], todate=opts['todate'])
+    elif opts['cache']:
+        import feedcache
+        data = feedcache.YahooFinanceCSVData(path, **kwargs)
+    else:
+        data = bt.feeds.YahooFinanceCSVData(dataname=path, **kwargs)
+    cerebro.adddata(data)
+
+    cerebro.broker.setcash(opts['cash'])
+    cerebro.addsizer(bt.sizers.FixedSize, stake=opts['stake'])
+    cerebro.broker.setcommission(commission=opts['commission'])
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='trades')
+    if opts['journal']:
+        import tradejournal
+        cerebro.addanalyzer(tradejournal.Journal, path=os.path.join(
+            opts['journal'], '%s.npz' % symbolname(path)))
+
+    pruning = contextlib.nullcontext()
+    if opts['prune']:
+        import deadind
+        # Keep what the charts plot if they are rendered
+        pruning = deadind.pruning(plot=bool(opts['charts']))
+
+    with pruning:
+        if opts['quiet']:
+            # Only warnings are written, but the last bars can be dumped on
+            # failure
+            with stratlog.configure(level=stratlog.WARN, ringsize=500):
+                strat = cerebro.run()[0]
+        else:
+            strat = cerebro.run()[0]
+
+    if opts['charts']:
+        import chartrender
+        chartrender.render(
+            chartrender.capture(strat, title=symbolname(path)),
+            os.path.join(opts['charts'],
+                         '%s.%s' % (symbolname(path), opts['chartformat'])))
+
+    trades = strat.analyzers.trades.get_analysis()
+    closed = trades.get('total', {}).get('closed', 0)
+    won = trades.get('won', {}).get('total', 0)
+
+    endvalue = cerebro.broker.getvalue()
+    row = dict(symbol=symbolname(path), bars=len(data), trades=closed,
+               won=won, startvalue=opts['cash'], endvalue=endvalue,
+               pnl=endvalue - opts['cash'])
+    row['return'] = endvalue / opts['cash'] - 1.0
+    return row
+
+
+def run(strategy, paths, cpus=None, callback=None, **opts):
+    '''
+    Backtests ``strategy`` (``module:Class``) on every CSV in ``paths`` (or
+    symbol of the bar store in ``store``) in a process pool and returns the
+    report rows sorted by symbol. ``callback(row)`` is called as each
+    symbol finishes
+    '''
+    opts = dict(dict(strat={}, fromdate=None, todate=None, cash=10000.0,
+                     stake=10, commission=0.0, cache=False, quiet=True,
+                     prune=False, charts='', chartformat='png',
+                     journal='', store=''),
+                **opts)
+    opts['strategy'] = strategy
+    jobs = [(path, opts) for path in paths]
+
+    rows = []
+    pool = multiprocessing.Pool(cpus or multiprocessing.cpu_count())
+    try:
+        # chunksize 1: symbols differ in length and rows stream back early
+        for row in pool.imap_unordered(runsymbol, jobs, 1):
+            rows.append(row)
+            if callback is not None:
+                callback(row)
+    finally:
+        pool.close()
+        pool.join()
+
+    rows.sort(key=lambda r: r['symbol'])
+    return rows
+
+
+def printrow(row):
+    print('%-10s %6d %12.2f %12.2f %10.2f %8.2f%% %6d %4d' % (
+        row['symbol'], row['bars'], row['startvalue'], row['endvalue'],
+        row['pnl'], row['return'] * 100.0, row['trades'], row['won']))
+    sys.stdout.flush()
+
+
+def runstrat(args=None):
+    args = parse_args(args)
+
+    if args.store:
+        import barstore
+        paths = ([s for s in args.symbols.split(',') if s] or
+                 barstore.Store(args.store).symbols())
+    else:
+        paths = [symbolpath(s) for s in args.symbols.split(',') if s]
+        if args.glob:
+            paths.extend(sorted(glob.glob(args.glob)))
+        if not paths:
+            paths = sorted(glob.glob(os.path.join(DATADIR, '*.csv')))
+
+    for dirname in (args.charts, args.journal):
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    kwargs = dict()
+    for d in ['fromdate', 'todate']:
+        a = getattr(args, d)
+        if a:
+            kwargs[d] = datetime.datetime.strptime(a, '%Y-%m-%d')
+
+    print('%-10s %6s %12s %12s %10s %9s %6s %4s' % (
+        'Symbol', 'Bars', 'Start', 'Final', 'PnL', 'Return', 'Trades', 'Won'))
+
+    rows = run(args.strategy, paths, cpus=args.cpus, callback=printrow,
+               strat=runmatrix.parse_kwargs(args.strat),
+               cash=args.cash, stake=args.stake, commission=args.commission,
+               cache=args.cache, quiet=not args.verbose, prune=args.prune,
+               charts=args.charts, chartformat=args.chart_format,
+               journal=args.journal, store=args.store, **kwargs)
+
+    pnl = sum(r['pnl'] for r in rows)
+    print('Symbols: %d, Total PnL: %.2f' % (len(rows), pnl))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def parse_args(pargs=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Backtest a strategy over a universe of symbols')
+
+    parser.add_argument('strategy',
+                        help='Strategy as module:Class, i.e.: '
+                             'bollinger_bands_emuriba:TestStrategy')
+
+    parser.add_argument('--symbols', required=False, default='',
+                        help='Comma separated symbols or CSV paths')
+
+    parser.add_argument('--glob', required=False, default='',
+                        help='Glob of CSV files (default: all in data/)')
+
+    parser.add_argument('--fromdate', required=False, default='',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--todate', required=False, default='',
+                        help='Date in YYYY-MM-DD format')
+
+    parser.add_argument('--cash', required=False, default=10000.0,
+                        type=float, help='Starting cash per symbol')
+
+    parser.add_argument('--stake', required=False, default=10, type=int,
+                        help='FixedSize stake')
+
+    parser.add_argument('--commission', required=False, default=0.0,
+                        type=float, help='Commission')
+
+    parser.add_argument('--strat', required=False, default='',
+                        metavar='kwargs', help='kwargs in key=value format')
+
+    parser.add_argument('--cpus', required=False, default=None, type=int,
+                        help='Worker processes (default: number of cores)')
+
+    parser.add_argument('--cache', required=False, action='store_true',
+                        help='Load the feeds through feedcache')
+
+    parser.add_argument('--store', required=False, default='',
+                        metavar='DIR',
+                        help='Read the symbols from this bar store '
+                             '(see barstore.py)')
+
+    parser.add_argument('--prune', required=False, action='store_true',
+                        help='Skip the indicators the strategy does not read')
+
+    parser.add_argument('--verbose', required=False, action='store_true',
+                        help='Let the strategies log every bar to stdout')
+
+    parser.add_argument('--out', required=False, default='',
+                        help='Write the report to this CSV file')
+
+    parser.add_argument('--charts', required=False, default='',
+                        metavar='DIR',
+                        help='Render a chart per symbol into this directory')
+
+    parser.add_argument('--journal', required=False, default='',
+                        metavar='DIR',
+                        help='Write the orders and trades of each symbol to '
+                             'a journal in this directory')
+
+    parser.add_argument('--chart-format', required=False, default='png',
+                        choices=['png', 'svg', 'html'],
+                        help='Format of the charts')
+
+    return parser.parse_args(pargs)
+
+
+if __name__ == '__main__':
+    runstrat()
@@ -0,0 +1,294 @@
+'''
+Walk-forward optimization of a strategy over rolling windows
+
+The history is split into windows which move forward by ``outsample``
+bars::
+
+    | insample (optimize) | outsample (trade) |
+                          | insample (optimize) | outsample (trade) |
+                                                ...
+
+For each window the parameter grid is backtested on the in-sample bars,
+the combination with the highest final value wins and it is then run on
+the out-of-sample bars which follow. The out-of-sample runs, which never
+saw their own bars while being chosen, are stitched into a single equity
+curve by compounding their returns.
+
+All the backtests (every combination of every window) go to one process
+pool. The in-sample batch of each window is queued as the workers run
+short of work and the out-of-sample run of a window is queued as soon as
+its in-sample results are in, so it does not wait for the later windows.
+The feed is parsed once and its columns are shared with the workers (see
+shmfeed.py).
+
+Each backtest is fed ``warmup`` extra bars before its window so the
+indicators are primed, but the strategy does not enter the market before
+the window starts: ``next`` is only called from then on and the equity is
+only recorded from then on.
+
+See ``stop-trading.py --walkforward`` for a command line::
+
+    python stop-trading.py auto --walkforward --insample 500 \\
+        --outsample 125 --stop-loss 0.01:0.05:0.01 --trail 0,1,2
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import itertools
+import multiprocessing
+import queue
+
+# Import the backtrader platform
+import backtrader as bt
+
+import shmfeed
+import stratlog
+
+
+# In-sample bars [isstart, oosstart) and out-of-sample [oosstart, oosend)
+Window = collections.namedtuple('Window',
+                                'index isstart oosstart oosend')
+
+
+def windows(size, insample, outsample):
+    '''
+    The rolling windows over ``size`` bars. The last out-of-sample slice is
+    shorter if the bars do not fill it
+    '''
+    if insample < 1 or outsample < 1:
+        raise ValueError('insample and outsample must be at least 1 bar')
+    if size <= insample:
+        raise ValueError('%d bars do not fill an in-sample window of %d' %
+                         (size, insample))
+
+    result = []
+    for oosstart in range(insample, size, outsample):
+        result.append(Window(len(result), oosstart - insample, oosstart,
+                             min(oosstart + outsample, size)))
+    return result
+
+
+def combinations(grid):
+    '''
+    The combinations of ``grid``, a sequence of ``(param, values)``, as
+    dicts in grid order
+    '''
+    names = [name for name, _ in grid]
+    return [dict(zip(names, values))
+            for values in itertools.product(*(vals for _, vals in grid))]
+
+
+def parse_grid(text, conv=float):
+    '''
+    Parses a comma separated list of values in which each entry may also be a
+    ``start:stop[:step]`` range (``stop`` included), i.e.: ``0.01:0.05:0.01``.
+    The values of a range are ``start + i * step``, so float steps do not
+    drift
+    '''
+    values = []
+    for tok in text.split(','):
+        if ':' not in tok:
+            values.append(conv(tok))
+            continue
+
+        bounds = [conv(x) for x in tok.split(':')]
+        start, stop = bounds[:2]
+        step = bounds[2] if len(bounds) > 2 else conv(1)
+        if step <= 0:
+            raise ValueError('The step of %s must be positive' % tok)
+
+        count = int((stop - start) / step + 1e-9) + 1
+        values.extend(start + i * step for i in range(count))
+
+    return values
+
+
+class Equity(bt.Analyzer):
+    '''Broker value at each bar from the date number ``start`` on'''
+    params = dict(start=0.0)
+
+    def start(self):
+        self.values = []
+
+    def next(self):
+        dt = self.data.datetime[0]
+        if dt >= self.p.start:
+            self.values.append((dt, self.strategy.broker.getvalue()))
+
+    def get_analysis(self):
+        return self.values
+
+
+_windowed = dict()
+
+
+def windowed(cls):
+    '''
+    Subclass of strategy ``cls`` which does not act before the date number
+    in its ``tradefrom`` param
+    '''
+    if cls not in _windowed:
+        class Windowed(cls):
+            params = dict(tradefrom=0.0)
+
+            def next(self):
+                if self.data.datetime[0] >= self.p.tradefrom:
+                    super(Windowed, self).next()
+
+        Windowed.__name__ = str(cls.__name__)
+        _windowed[cls] = Windowed
+
+    return _windowed[cls]
+
+
+# Columns of the feed shared by the workers (set by the pool initializer)
+_wf_data = None
+
+
+def _wf_init(columns):
+    global _wf_data
+    _wf_data = columns
+
+
+def _wf_run(job):
+    '''
+    Backtests ``params`` on the bars [``tradefrom`` - warmup, ``end``).
+    Returns the job key and the recorded equity
+    '''
+    key, opts, params, start, tradefrom, end = job
+
+    columns = dict((name, col[start:end]) for name, col in _wf_data.items())
+    tradedt = columns['datetime'][tradefrom - start]
+
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(shmfeed.SharedData(dataname=columns))
+    cerebro.broker = bt.brokers.BackBroker(**opts['broker'])
+    cerebro.addsizer(bt.sizers.FixedSize, **opts['sizer'])
+
+    kwargs = dict(opts['strat'], **params)
+    cerebro.addstrategy(windowed(opts['strategy']), tradefrom=tradedt,
+                        **kwargs)
+    cerebro.addanalyzer(Equity, start=tradedt, _name='equity')
+
+    # Only warnings are written, but the last bars can be dumped on failure
+    with stratlog.configure(level=stratlog.WARN, ringsize=500):
+        strat = cerebro.run()[0]
+
+    return key, strat.analyzers.equity.get_analysis()
+
+
+def run(strategy, columns, grid, insample, outsample, warmup=0, strat=None,
+        broker=None, sizer=None, cpus=None, callback=None):
+    '''
+    Walk-forward optimization of ``strategy`` (a class) over the feed
+    ``columns`` (see ``memfeed.snapshot``) for the ``grid`` of params
+    (``[(name, values), ...]`` or the list of its combinations, as dicts,
+    with the redundant ones already dropped). ``strat``, ``broker`` and
+    ``sizer`` are the kwargs for the fixed params, the ``BackBroker`` and
+    the ``FixedSize`` sizer.
+
+    ``callback(result)`` is called, in window order, as the windows
+    finish. Returns the results of the windows in order, dicts with:
+
+      - ``window``: the ``Window``
+      - ``params``: the winning combination
+      - ``insample``: its final in-sample value
+      - ``equity``: the out-of-sample ``(date number, value)`` list
+      - ``return``: the out-of-sample return
+    '''
+    opts = dict(strategy=strategy, strat=strat or {}, broker=broker or {},
+                sizer=sizer or {})
+    startcash = bt.brokers.BackBroker(**opts['broker']).startingcash
+
+    wins = windows(len(columns['datetime']), insample, outsample)
+    if grid and isinstance(grid[0], dict):
+        combos = list(grid)
+    else:
+        combos = combinations(grid)
+
+    def job(key, params, tradefrom, end):
+        return (key, opts, params, max(0, tradefrom - warmup), tradefrom, end)
+
+    cpus = cpus or multiprocessing.cpu_count()
+    shared = shmfeed.SharedColumns(columns)
+    pool = multiprocessing.Pool(cpus, _wf_init, (shared,))
+    try:
+        # Finished backtests, handed over by the result thread of the pool
+        done = queue.Queue()
+
+        def submit(job):
+            pool.apply_async(_wf_run, (job,), callback=done.put,
+                             error_callback=done.put)
+
+        values = dict((w.index, [None] * len(combos)) for w in wins)
+        left = dict((w.index, len(combos)) for w in wins)
+        best = dict()
+        results = [None] * len(wins)
+        nextwin = 0  # next window whose in-sample batch is to be queued
+        nextcb = 0  # next window for the callback
+        running = 0  # queued in-sample backtests
+        while nextcb < len(wins):
+            # The in-sample batch of a window is only queued when the
+            # workers run short of backtests, so that the out-of-sample run
+            # of a window does not wait behind those of all the later ones
+            while nextwin < len(wins) and running <= cpus:
+                w = wins[nextwin]
+                for i, params in enumerate(combos):
+                    submit(job((w.index, i), params, w.isstart, w.oosstart))
+                running += len(combos)
+                nextwin += 1
+
+            item = done.get()
+            if isinstance(item, BaseException):
+                raise item
+
+            (index, i), equity = item
+            value = equity[-1][1] if equity else startcash
+            w = wins[index]
+            if i is not None:  # in-sample
+                running -= 1
+                values[index][i] = value
+                left[index] -= 1
+                if not left[index]:
+                    # Highest value, the first in grid order on ties
+                    best[index] = max(range(len(combos)),
+                                      key=lambda i: (values[index][i], -i))
+                    submit(job((index, None), combos[best[index]],
+                               w.oosstart, w.oosend))
+                continue
+
+            result = dict(window=w, params=combos[best[index]],
+                          insample=values[index][best[index]], equity=equity)
+            result['return'] = value / startcash - 1.0
+            results[index] = result
+            while nextcb < len(wins) and results[nextcb] is not None:
+                if callback is not None:
+                    callback(results[nextcb])
+                nextcb += 1
+
+        pool.close()
+    except BaseException:
+        pool.terminate()  # failed or interrupted: drop the queued backtests
+        raise
+    finally:
+        pool.join()
+        shared.close()
+
+    return results
+
+
+def stitch(results, startcash=10000.0):
+    '''
+    The out-of-sample equity curves of ``results`` (each run with
+    ``startcash``) chained into one ``[(date number, value), ...]``: each
+    window is scaled to start with the value the previous one ended with
+    '''
+    curve = []
+    value = startcash
+    for result in results:
+        curve.extend((dt, value * v / startcash) for dt, v in result['equity'])
+        if curve:
+            value = curve[-1][1]
+
+    return curve